@@ -0,0 +1,46 @@
+"""
+ASGI config for TheHaloMod project.
+
+It exposes the ASGI callable as a module-level variable named ``application``, to
+be served by an ASGI server, eg. by gunicorn with uvicorn's workers::
+
+    gunicorn -k uvicorn.workers.UvicornH11Worker TheHaloMod.asgi:application
+
+Served this way, the compute-heavy views are async (see
+``halomod_app/async_views.py``), and the progress of computations is streamed
+straight from here, since Django (before 4.2) iterates streaming responses in the
+event loop. For the same reason, batches of the API are computed in a thread and
+sent whole, rather than streamed.
+"""
+import os
+import sys
+
+# Add the path to this file into pythonpath
+_PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _PROJECT_DIR)
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "TheHaloMod.settings.local")
+os.environ.setdefault("ASYNC_VIEWS", "1")
+
+from django.core.asgi import get_asgi_application  # noqa
+from django.urls import Resolver404, resolve  # noqa
+
+django_application = get_asgi_application()
+
+from halomod_app import progress  # noqa
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "http":
+        try:
+            match = resolve(scope["path"])
+        except Resolver404:
+            match = None
+
+        if match is not None and match.url_name == "progress":
+            if progress.valid_job_id(match.kwargs["job_id"]):
+                return await progress.serve_events(
+                    match.kwargs["job_id"], receive, send
+                )
+
+    return await django_application(scope, receive, send)
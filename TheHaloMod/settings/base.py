@@ -4,7 +4,6 @@
 # THIRD_PARTY IMPORTS
 # ===============================================================================
 import dill
-from django.contrib.sessions import serializers
 from django.core.cache.backends import locmem
 from pathlib import Path
 import environ
@@ -24,8 +23,7 @@ DEBUG = env.bool("DJANGO_DEBUG", False)
 TEMPLATE_DEBUG = DEBUG
 CRISPY_FAIL_SILENTLY = not DEBUG
 
-# Change the Pickle Serializer to use dill.
-serializers.pickle = dill  # noqa
+# Local-memory caches pickle with dill, like sessions (see SESSION_SERIALIZER).
 locmem.pickle = dill  # noqa
 
 # ===============================================================================
@@ -179,27 +177,161 @@ TEMPLATES = [
 # MISCELLANEOUS
 # ===============================================================================
 MIDDLEWARE = [
-    "whitenoise.middleware.WhiteNoiseMiddleware",
+    "halomod_app.middleware.StaticFilesMiddleware",
+    "halomod_app.middleware.TimingMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
+    "halomod_app.middleware.AdmissionControlMiddleware",
+    "halomod_app.middleware.ComputeQuotaMiddleware",
     "django.middleware.common.BrokenLinkEmailsMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
 
 ROOT_URLCONF = "TheHaloMod.urls"
-SESSION_SERIALIZER = "django.contrib.sessions.serializers.PickleSerializer"
+# Sessions hold whole models, which only dill can pickle.
+SESSION_SERIALIZER = "halomod_app.sessions.DillSerializer"
 
 # Python dotted path to the WSGI application used by Django's runserver.
 WSGI_APPLICATION = "TheHaloMod.wsgi.application"
+ASGI_APPLICATION = "TheHaloMod.asgi.application"
+# Whether the compute-heavy views are served by their async versions (see
+# halomod_app/async_views.py). Set by TheHaloMod/asgi.py, when served under ASGI.
+ASYNC_VIEWS = env.bool("ASYNC_VIEWS", default=False)
 SESSION_SAVE_EVERY_REQUEST = True
 
 # Use a local-memory cache session engine. If we don't do this,
 # the session objects (which can be quite large, since we're pickling full halomodel
 # instances) are saved to the db. This is bad firstly because it's slow, and secondly
 # because the db get's filled up with stuff we never want to commit to git.
-# On the actual site, we should probably use memcached instead of the locmem cache.
-SESSION_ENGINE = "django.contrib.sessions.backends.cache"
+# In production, the cache is shared between the web workers (see production.py).
+# Sessions are stored in the cache already pickled, so that the time it takes can be
+# measured (see halomod_app/sessions.py).
+SESSION_ENGINE = "halomod_app.sessions"
+
+# ===============================================================================
+# RESULT CACHING
+# ===============================================================================
+# How long (in seconds) computed model quantities, and finished download archives,
+# are kept in the default cache. Both are keyed by the fingerprint of the model
+# parameters, so they never go stale -- this just bounds the memory they use.
+RESULT_CACHE_TIMEOUT = env.int("RESULT_CACHE_TIMEOUT", default=3600)
+EXPORT_CACHE_TIMEOUT = env.int("EXPORT_CACHE_TIMEOUT", default=3600)
+# The rendered (unbound) input form only depends on its initial values, and on the
+# code, so it can be kept for much longer.
+FORM_CACHE_TIMEOUT = env.int("FORM_CACHE_TIMEOUT", default=24 * 3600)
+# Where the arrays of computed quantities are kept: in the cache itself ("cache"), or
+# in shared memory ("shm"), read by every worker without copying, with only
+# references to them in the cache. Arrays in shared memory take at most
+# SHM_STORE_BYTES, the oldest being evicted first.
+RESULT_STORE = env("RESULT_STORE", default="cache")
+SHM_STORE_BYTES = env.int("SHM_STORE_BYTES", default=256 * 2**20)
+# Concurrent requests for the same uncached quantity wait for one of them to compute
+# it. They wait (checking every COALESCE_POLL_INTERVAL seconds) for at most
+# COALESCE_TIMEOUT seconds, after which they compute it themselves.
+COALESCE_TIMEOUT = env.int("COALESCE_TIMEOUT", default=300)
+COALESCE_POLL_INTERVAL = env.float("COALESCE_POLL_INTERVAL", default=0.1)
+
+# ===============================================================================
+# COMPUTE POOL
+# ===============================================================================
+# Number of processes (per web worker) used to build models concurrently, eg. when
+# importing several parameter files at once.
+COMPUTE_WORKERS = env.int("COMPUTE_WORKERS", default=2)
+# Number of processes (per web worker) drawing plots. Matplotlib isn't thread-safe,
+# so with threaded web workers plots must be drawn in these. If 0, plots are drawn
+# in the web worker itself, one at a time.
+RENDER_WORKERS = env.int("RENDER_WORKERS", default=2)
+
+# Maximum number of models in a single request to the batch API.
+API_BATCH_MAX_ITEMS = env.int("API_BATCH_MAX_ITEMS", default=1000)
+
+# How long (in seconds) the progress of a computation is kept (and followed), and how
+# often (in seconds) it is checked while streaming it to the client.
+PROGRESS_TIMEOUT = env.int("PROGRESS_TIMEOUT", default=600)
+PROGRESS_POLL_INTERVAL = env.float("PROGRESS_POLL_INTERVAL", default=0.25)
+
+# ===============================================================================
+# COMPUTE QUOTAS AND SCHEDULING
+# ===============================================================================
+# Compute-heavy requests (plots, downloads, creating models and the API) are charged
+# the seconds they take, per session and per IP address, over windows of
+# QUOTA_WINDOW seconds. Clients over their quota get a 429 until the window ends.
+QUOTA_WINDOW = env.int("QUOTA_WINDOW", default=600)
+QUOTA_SESSION_SECONDS = env.float("QUOTA_SESSION_SECONDS", default=300)
+QUOTA_IP_SECONDS = env.float("QUOTA_IP_SECONDS", default=900)
+# Number of compute-heavy requests run at once by each web worker. The others wait,
+# interactive ones (plots) ahead of bulk ones (downloads).
+COMPUTE_SLOTS = env.int("COMPUTE_SLOTS", default=2)
+
+# Maximum number of compute-heavy requests in flight at once, over all the workers
+# sharing the cache. Beyond that, requests get a 503 asking them to retry after the
+# typical duration of a request (or ADMISSION_RETRY_AFTER seconds, before there is
+# one). Leases on capacity expire after ADMISSION_TIMEOUT seconds.
+ADMISSION_CAPACITY = env.int("ADMISSION_CAPACITY", default=8)
+ADMISSION_RETRY_AFTER = env.int("ADMISSION_RETRY_AFTER", default=2)
+ADMISSION_TIMEOUT = env.int("ADMISSION_TIMEOUT", default=600)
+
+# Seconds after which gunicorn kills a worker that is still serving a request (the
+# entrypoint passes the same WORKER_TIMEOUT to gunicorn's --timeout).
+WORKER_TIMEOUT = env.int("WORKER_TIMEOUT", default=600)
+
+# A model that crashes or times out CIRCUIT_FAILURES times within CIRCUIT_WINDOW
+# seconds is refused straight away for the next CIRCUIT_COOLDOWN seconds. A
+# computation times out if it hasn't finished after CIRCUIT_COMPUTE_TIMEOUT seconds
+# (eg. because its worker was killed), which is the workers' timeout by default.
+CIRCUIT_FAILURES = env.int("CIRCUIT_FAILURES", default=3)
+CIRCUIT_WINDOW = env.int("CIRCUIT_WINDOW", default=3600)
+CIRCUIT_COOLDOWN = env.int("CIRCUIT_COOLDOWN", default=900)
+CIRCUIT_COMPUTE_TIMEOUT = env.int("CIRCUIT_COMPUTE_TIMEOUT", default=WORKER_TIMEOUT)
+
+# ===============================================================================
+# REQUEST TIMINGS
+# ===============================================================================
+# The time spent in each phase of a request (loading the session, computing,
+# drawing...) is logged, and sent in a Server-Timing header if SERVER_TIMING is set
+# (by default, only when debugging, since it tells anyone how long each phase takes).
+# Percentiles per endpoint are computed over its last TIMING_SAMPLES requests.
+SERVER_TIMING = env.bool("SERVER_TIMING", default=DEBUG)
+TIMING_SAMPLES = env.int("TIMING_SAMPLES", default=1000)
+
+# ===============================================================================
+# QUANTITY PROFILING
+# ===============================================================================
+# The time taken to compute each quantity is recorded, with the configuration of
+# its model, in this SQLite database (set it empty to not record them). Only the
+# last QUANTITY_PROFILE_ROWS are kept. See `python manage.py profile_quantities`.
+QUANTITY_PROFILE = env(
+    "QUANTITY_PROFILE", default=str(ROOT_DIR / "media" / "profile.sqlite3")
+)
+QUANTITY_PROFILE_ROWS = env.int("QUANTITY_PROFILE_ROWS", default=100000)
+
+# ===============================================================================
+# METRICS
+# ===============================================================================
+# Metrics are served at /metrics in the Prometheus text format. They are kept per
+# process: with several workers, set METRICS_DIR to a directory (emptied on startup)
+# to which each writes its metrics every METRICS_FLUSH_INTERVAL seconds, so that
+# /metrics serves the total over all of them.
+METRICS_DIR = env("METRICS_DIR", default="")
+METRICS_FLUSH_INTERVAL = env.float("METRICS_FLUSH_INTERVAL", default=5)
+
+# ===============================================================================
+# TRANSFER FILE UPLOADS
+# ===============================================================================
+# Uploaded transfer functions are parsed and stored (by their content hash) here.
+TRANSFER_STORE_DIR = env(
+    "TRANSFER_STORE_DIR", default=str(ROOT_DIR / "media" / "transfer")
+)
+TRANSFER_UPLOAD_MAX_BYTES = env.int("TRANSFER_UPLOAD_MAX_BYTES", default=5 * 2**20)
+
+# ===============================================================================
+# PARAMETER FILE IMPORTS
+# ===============================================================================
+# At most this many parameter files can be imported at once (including those in
+# zips), each of at most IMPORT_MAX_FILE_BYTES (uncompressed).
+IMPORT_MAX_FILES = env.int("IMPORT_MAX_FILES", default=100)
+IMPORT_MAX_FILE_BYTES = env.int("IMPORT_MAX_FILE_BYTES", default=2**20)
 
 # ==============================================================================
 # SECURITY
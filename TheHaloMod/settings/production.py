@@ -20,6 +20,21 @@ ALLOWED_HOSTS = env.list("DJANGO_ALLOWED_HOSTS", default=["*"])
 
 # CACHES
 # ------------------------------------------------------------------------------
+# Sessions live in the cache, so it must be shared by all the gunicorn workers (set
+# by WEB_CONCURRENCY): a SQLite database on the local disk, fronted in memory.
+CACHES = {
+    "default": {
+        "BACKEND": "halomod_app.sqlite_cache.SQLiteCache",
+        "LOCATION": env(
+            "CACHE_LOCATION", default=str(ROOT_DIR / "media" / "cache.sqlite3")
+        ),
+        "OPTIONS": {
+            "MAX_ENTRIES": env.int("CACHE_MAX_ENTRIES", default=10000),
+            "FRONT_BYTES": env.int("CACHE_FRONT_BYTES", default=64 * 2**20),
+        },
+    }
+}
+# Or, with a redis server:
 # CACHES = {
 #     "default": {
 #         "BACKEND": "django_redis.cache.RedisCache",
@@ -33,6 +48,12 @@ ALLOWED_HOSTS = env.list("DJANGO_ALLOWED_HOSTS", default=["*"])
 #     }
 # }
 
+# METRICS
+# ------------------------------------------------------------------------------
+# Gathered from all the gunicorn workers (see halomod_app.metrics). The entrypoint
+# empties it on startup.
+METRICS_DIR = env("METRICS_DIR", default="/tmp/thm-metrics")
+
 # SECURITY
 # ------------------------------------------------------------------------------
 # https://docs.djangoproject.com/en/dev/ref/settings/#secure-proxy-ssl-header
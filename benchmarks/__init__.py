@@ -0,0 +1 @@
+"""Benchmarks of TheHaloMod's hot paths."""
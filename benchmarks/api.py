@@ -0,0 +1,85 @@
+"""Benchmark the throughput of the JSON compute API under concurrent clients.
+
+Each client (a thread) posts compute requests to ``api/compute/`` through Django's
+test client, i.e. through the full middleware stack, but without a web server. Run
+from the repository root with::
+
+    python -m benchmarks.api
+
+By default, all requests are for the same (cached) model, which measures the
+overhead of the API itself. With ``--uncached``, every request is for a distinct
+model, so each one builds and computes a framework.
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def setup():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "TheHaloMod.settings.local")
+
+    import django
+
+    django.setup()
+
+
+def run(clients: int, requests: int, quantities: list, uncached: bool = False):
+    """Post ``requests`` compute requests from ``clients`` concurrent clients.
+
+    Returns
+    -------
+    dict
+        The wall time, throughput (requests/s) and mean latency (s).
+    """
+    from django.test import Client
+
+    def request(i):
+        # Distinct redshifts give distinct models, when we want to miss the cache.
+        model = {"z": 1e-3 * (i + 1) + time.time() % 1} if uncached else {}
+        body = json.dumps({"model": model, "quantities": quantities})
+
+        t0 = time.perf_counter()
+        response = Client(SERVER_NAME="localhost").post(
+            "/api/compute/", body, content_type="application/json"
+        )
+        assert response.status_code == 200, response.content
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        latencies = list(pool.map(request, range(requests)))
+    wall = time.perf_counter() - t0
+
+    return {
+        "wall": wall,
+        "throughput": requests / wall,
+        "latency": sum(latencies) / len(latencies),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--quantities", nargs="+", default=["m", "dndm", "k", "power"])
+    parser.add_argument("--uncached", action="store_true")
+    args = parser.parse_args(argv)
+
+    setup()
+
+    # Warm up: import everything, and fill the cache for the default model.
+    run(1, 1, args.quantities)
+
+    print(f"{'clients':>8} {'req/s':>10} {'latency [ms]':>13}")
+    for clients in args.clients:
+        result = run(clients, args.requests, args.quantities, args.uncached)
+        print(
+            f"{clients:>8} {result['throughput']:10.1f} "
+            f"{1000 * result['latency']:13.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
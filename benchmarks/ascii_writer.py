@@ -0,0 +1,87 @@
+"""Benchmark the vectorized text writer against ``np.savetxt``.
+
+Both write a table of random columns into a deflated zip member, as the ASCII data
+download does. Run from the repository root with::
+
+    python -m benchmarks.ascii_writer
+"""
+import argparse
+import io
+import timeit
+import tracemalloc
+import zipfile
+
+import numpy as np
+
+from halomod_app.exports import DEFAULT_PRECISION, TEXT_COMPRESSLEVEL, write_columns
+
+
+def savetxt_zip(columns, precision=DEFAULT_PRECISION):
+    """The original implementation: stack, transpose, savetxt, then zip.
+
+    It is zipped at the same level as :func:`fast_zip`, so that only the writing of
+    the text is compared.
+    """
+    buff = io.BytesIO()
+    with zipfile.ZipFile(
+        buff, "w", zipfile.ZIP_DEFLATED, compresslevel=TEXT_COMPRESSLEVEL
+    ) as archive:
+        s = io.BytesIO()
+        np.savetxt(s, np.array(columns).T, fmt=f"%.{precision}e")
+        archive.writestr("table.txt", s.getvalue())
+    return buff.getvalue()
+
+
+def fast_zip(columns, precision=DEFAULT_PRECISION):
+    """The vectorized writer, streaming straight into the zip member."""
+    buff = io.BytesIO()
+    with zipfile.ZipFile(
+        buff, "w", zipfile.ZIP_DEFLATED, compresslevel=TEXT_COMPRESSLEVEL
+    ) as archive:
+        with archive.open("table.txt", "w") as s:
+            write_columns(s, columns, precision=precision)
+    return buff.getvalue()
+
+
+def peak_memory(func, *args, **kwargs) -> int:
+    """Peak memory (in bytes) allocated while calling func."""
+    tracemalloc.start()
+    func(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def run(nrows: int, ncols: int, precision: int, repeat: int = 5) -> dict:
+    """Time and measure the memory of both writers on a random table."""
+    rng = np.random.default_rng(0)
+    columns = [10 ** rng.uniform(-40, 40, nrows) for _ in range(ncols)]
+
+    out = {}
+    for name, func in [("savetxt", savetxt_zip), ("fast", fast_zip)]:
+        time = min(
+            timeit.repeat(lambda: func(columns, precision), number=1, repeat=repeat)
+        )
+        out[name] = {"time": time, "peak_memory": peak_memory(func, columns, precision)}
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--precision", type=int, default=DEFAULT_PRECISION)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    print(f"{'rows x cols':>14} {'writer':>8} {'time [ms]':>10} {'peak [MiB]':>11}")
+    # Sizes of a typical mass vector, a high-resolution one, and a huge one.
+    for nrows, ncols in [(1800, 15), (20000, 15), (200000, 4)]:
+        result = run(nrows, ncols, args.precision, args.repeat)
+        for name, r in result.items():
+            print(
+                f"{f'{nrows} x {ncols}':>14} {name:>8} {1000 * r['time']:10.1f} "
+                f"{r['peak_memory'] / 2**20:11.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
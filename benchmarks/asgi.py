@@ -0,0 +1,223 @@
+"""Load test the ASGI deployment of the site against the WSGI one.
+
+The site is served by gunicorn on a local port, first with its sync workers (WSGI),
+then with uvicorn's workers (ASGI, see ``TheHaloMod/asgi.py``), and the same load is
+run against each: ``--clients`` clients requesting plots one after another (whose
+latency is measured), while other clients hold connections open, either following
+progress streams (``--idle``) or downloading the data archive slowly (``--slow``).
+Plots are served from the result cache after the first, so this measures what a
+worker is kept from doing by connections that need no computing. Run from the
+repository root with::
+
+    python -m benchmarks.asgi
+
+Sessions are kept in the cache, so with the default (local-memory) cache only one
+worker can be used. For more, use settings with a shared cache (eg.
+``--settings TheHaloMod.settings.production``, with ``DJANGO_SECRET_KEY`` set).
+"""
+import argparse
+import asyncio
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+
+PLOTS = ["dndm", "dndlnm", "ngtm", "power", "transfer_function"]
+
+INTERFACES = {
+    "wsgi": ("TheHaloMod.wsgi:application", []),
+    "asgi": ("TheHaloMod.asgi:application", ["-k", "uvicorn.workers.UvicornH11Worker"]),
+}
+
+
+async def get(
+    port: int,
+    path: str,
+    cookie: str = "",
+    read_delay: float = 0,
+    deadline: float = None,
+):
+    """Make a GET request, reading the response slowly if ``read_delay`` is given.
+
+    Returns
+    -------
+    The status, headers (as text) and length of the body of the response, or None
+    if the deadline passed before it was read.
+    """
+    sock = socket.socket()
+    if read_delay:
+        # Make the server wait on us, rather than on the kernel's buffers.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, ("127.0.0.1", port))
+    reader, writer = await asyncio.open_connection(sock=sock, limit=4096)
+
+    writer.write(
+        f"GET {path} HTTP/1.1\r\nHost: localhost\r\nCookie: {cookie}\r\n"
+        "Connection: close\r\n\r\n".encode()
+    )
+    try:
+        head = (await reader.readuntil(b"\r\n\r\n")).decode("latin1")
+        length = 0
+        while True:
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            chunk = await reader.read(1024 if read_delay else 65536)
+            if not chunk:
+                break
+            length += len(chunk)
+            if read_delay:
+                await asyncio.sleep(read_delay)
+    finally:
+        writer.close()
+
+    return int(head.split()[1]), head, length
+
+
+async def _hold(port: int, path: str, cookie: str, read_delay: float, until: float):
+    """Keep requesting a path until the deadline, as a client holding a connection."""
+    while time.monotonic() < until:
+        try:
+            await get(port, path, cookie, read_delay, deadline=until)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            await asyncio.sleep(0.1)
+
+
+async def _measure(port: int, cookie: str, requests: int, latencies: list):
+    for i in range(requests):
+        t0 = time.perf_counter()
+        status, _, _ = await get(port, f"/plot/{PLOTS[i % len(PLOTS)]}.png", cookie)
+        latencies.append((status, time.perf_counter() - t0))
+
+
+async def load(
+    port: int,
+    clients: int,
+    requests: int,
+    idle: int,
+    slow: int,
+    download: str = "/download/allData.zip",
+) -> dict:
+    """Run the load against a server, returning the latencies of the plots."""
+    # A session with the default model in it, with its plots computed.
+    _, head, _ = await get(port, "/")
+    cookie = "; ".join(re.findall(r"(?i)^set-cookie: ([^;]+)", head, re.MULTILINE))
+    for plot in PLOTS:
+        await get(port, f"/plot/{plot}.png", cookie)
+
+    until = time.monotonic() + 3600
+    holders = [
+        asyncio.ensure_future(
+            _hold(port, f"/progress/{uuid.uuid4().hex}/", cookie, 0, until)
+        )
+        for _ in range(idle)
+    ] + [
+        asyncio.ensure_future(_hold(port, download, cookie, 0.01, until))
+        for _ in range(slow)
+    ]
+    # Let them connect first.
+    await asyncio.sleep(1)
+
+    latencies = []
+    t0 = time.perf_counter()
+    await asyncio.gather(
+        *[_measure(port, cookie, requests, latencies) for _ in range(clients)]
+    )
+    elapsed = time.perf_counter() - t0
+
+    for holder in holders:
+        holder.cancel()
+    await asyncio.gather(*holders, return_exceptions=True)
+
+    ok = sorted(t for status, t in latencies if status == 200)
+    return {
+        "throughput": len(ok) / elapsed,
+        "errors": len(latencies) - len(ok),
+        "p50": statistics.median(ok) if ok else float("nan"),
+        "p95": ok[int(0.95 * (len(ok) - 1))] if ok else float("nan"),
+        "max": ok[-1] if ok else float("nan"),
+    }
+
+
+def serve(interface: str, port: int, workers: int, threads: int, settings: str):
+    """Start gunicorn serving the site, waiting until it answers."""
+    app, args = INTERFACES[interface]
+    if interface == "wsgi" and threads > 1:
+        args = ["--threads", str(threads)]
+
+    env = {
+        **os.environ,
+        "DJANGO_SETTINGS_MODULE": settings,
+        "ASYNC_VIEWS": str(int(interface == "asgi")),
+        # Don't throttle or turn away the load itself.
+        "QUOTA_SESSION_SECONDS": "1000000000",
+        "QUOTA_IP_SECONDS": "1000000000",
+        "ADMISSION_CAPACITY": "1000",
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}"]
+        + ["--workers", str(workers), "--timeout", "600", "--log-level", "warning"]
+        + args
+        + [app],
+        env=env,
+    )
+
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.5)
+
+    server.terminate()
+    raise RuntimeError(f"The {interface} server didn't start")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--interfaces", nargs="+", default=list(INTERFACES))
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=1, help="of WSGI workers")
+    parser.add_argument("--settings", default="TheHaloMod.settings.local")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=10, help="per client")
+    parser.add_argument("--idle", type=int, default=20, help="progress streams")
+    parser.add_argument("--slow", type=int, default=2, help="slow downloads")
+    parser.add_argument("--download", default="/download/allData.zip")
+    args = parser.parse_args(argv)
+
+    print(
+        f"{'interface':>9} {'req/s':>8} {'errors':>7} {'p50 [s]':>8} "
+        f"{'p95 [s]':>8} {'max [s]':>8}"
+    )
+    for interface in args.interfaces:
+        server = serve(interface, args.port, args.workers, args.threads, args.settings)
+        try:
+            result = asyncio.run(
+                load(
+                    args.port,
+                    args.clients,
+                    args.requests,
+                    args.idle,
+                    args.slow,
+                    args.download,
+                )
+            )
+        finally:
+            server.terminate()
+            server.wait()
+
+        print(
+            f"{interface:>9} {result['throughput']:8.2f} {result['errors']:7d} "
+            f"{result['p50']:8.3f} {result['p95']:8.3f} {result['max']:8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Benchmark the shared SQLite cache backend against the local-memory one.
+
+Each simulated request reads a session-sized value from the cache and writes it
+back (as the session middleware does, since SESSION_SAVE_EVERY_REQUEST is set), or
+only reads it. The requests are made by one or more processes at once, standing in
+for gunicorn workers: with the SQLite backend they all share one database, while
+with the local-memory backend each has its own cache (which is why it can't be used
+with several workers). Run from the repository root with::
+
+    python -m benchmarks.cache
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+
+def setup():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "TheHaloMod.settings.local")
+
+    import django
+
+    django.setup()
+
+
+def make_cache(backend: str, location: str):
+    if backend == "locmem":
+        from django.core.cache.backends.locmem import LocMemCache
+
+        return LocMemCache("benchmark", {"OPTIONS": {"MAX_ENTRIES": 10000}})
+    else:
+        from halomod_app.sqlite_cache import SQLiteCache
+
+        return SQLiteCache(location, {"OPTIONS": {"MAX_ENTRIES": 10000}})
+
+
+def _worker(backend, location, worker, sessions, requests, size, write, queue):
+    setup()
+
+    import numpy as np
+
+    cache = make_cache(backend, location)
+    value = {"objects": {"default": np.random.random(size // 8)}}
+    keys = [f"session-{worker}-{i}" for i in range(sessions)]
+    for key in keys:
+        cache.set(key, value)
+
+    t0 = time.perf_counter()
+    for i in range(requests):
+        key = keys[i % sessions]
+        session = cache.get(key)
+        if write:
+            cache.set(key, session)
+    queue.put(time.perf_counter() - t0)
+
+
+def run(
+    backend: str,
+    workers: int,
+    sessions: int = 10,
+    requests: int = 200,
+    size: int = 500_000,
+    write: bool = True,
+) -> dict:
+    """Make ``requests`` requests from each of ``workers`` processes at once.
+
+    Returns
+    -------
+    dict
+        The throughput (requests/s over all workers) and mean latency (s).
+    """
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        location = os.path.join(tmp, "cache.sqlite3")
+        procs = [
+            ctx.Process(
+                target=_worker,
+                args=(backend, location, i, sessions, requests, size, write, queue),
+            )
+            for i in range(workers)
+        ]
+        for p in procs:
+            p.start()
+        times = [queue.get() for _ in procs]
+        for p in procs:
+            p.join()
+
+    return {
+        "throughput": workers * requests / max(times),
+        "latency": sum(times) / (workers * requests),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--size", type=int, default=500_000, help="bytes per value")
+    args = parser.parse_args(argv)
+
+    print(
+        f"{'backend':>8} {'mode':>11} {'workers':>8} {'req/s':>10} "
+        f"{'latency [ms]':>13}"
+    )
+    for backend in ["locmem", "sqlite"]:
+        for write in [False, True]:
+            for workers in args.workers:
+                result = run(
+                    backend,
+                    workers,
+                    requests=args.requests,
+                    size=args.size,
+                    write=write,
+                )
+                print(
+                    f"{backend:>8} {'read+write' if write else 'read':>11} "
+                    f"{workers:>8} {result['throughput']:10.1f} "
+                    f"{1000 * result['latency']:13.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
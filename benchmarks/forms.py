@@ -0,0 +1,58 @@
+"""Benchmark the construction of the calculator's input form.
+
+Every request to ``create/`` and ``edit/`` constructs a ``FrameworkInput``: unbound
+to show the form, and bound to the submitted data to validate it. This reports the
+time taken to construct (but not clean or render) the form in each case. Run from the
+repository root with::
+
+    python -m benchmarks.forms
+"""
+import argparse
+import os
+import time
+import timeit
+
+
+def setup():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "TheHaloMod.settings.local")
+
+    import django
+
+    django.setup()
+
+
+def run(repeat: int = 5, number: int = 20) -> dict:
+    """Time the construction of FrameworkInput, per request."""
+    t0 = time.perf_counter()
+    from halomod_app.forms import FrameworkInput
+
+    out = {"import": time.perf_counter() - t0}
+
+    data = FrameworkInput.data_from_framework_dict({}, "default")
+
+    cases = {
+        "unbound": lambda: FrameworkInput(),
+        "initial": lambda: FrameworkInput(model_label="default", initial=data),
+        "bound": lambda: FrameworkInput(data=data, compute_model=False),
+    }
+    for name, func in cases.items():
+        out[name] = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    setup()
+    result = run(args.repeat, args.number)
+
+    print(f"{'case':>10} {'time [ms]':>10}")
+    for name, t in result.items():
+        print(f"{name:>10} {1000 * t:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+"""Run the benchmarks of the app's hot paths, and compare them with a baseline.
+
+Each case is timed in-process (with local-memory caches, and no network access),
+over enough calls to take at least 0.2s, repeated ``--repeat`` times. The cases are:
+
+``hmf_driver.{construct,clone}.{default,wdm,camb_free}``
+    Building a model with :func:`~halomod_app.utils.hmf_driver`, from scratch and
+    from a previous model (as editing one does, see :data:`CLONE_CHANGE`), with the
+    default parameters, warm dark matter, and the Eisenstein & Hu transfer function
+    (no CAMB).
+``create_canvas.{png,svg,pdf}.{1,8}``
+    Plotting the mass function of 1 or 8 models (whose quantities are computed).
+``archive.{data_output,halogen}.{1,8}``, ``archive.header_txt.{1,8}``
+    Writing the downloads of 1 or 8 models, from their (cached) results, but not
+    from the archive cache.
+``session.{dumps,loads}.{1,8}``
+    Pickling and unpickling a session holding 1 or 8 (computed) models.
+``forms.{unbound,bound,validate}``
+    Constructing a ``FrameworkInput``, and validating it (without building the
+    model).
+
+The results are written as JSON to ``--output``, and compared with those in
+``--baseline``: cases more than ``--threshold`` slower than the baseline are
+reported as regressions (and the exit status is 1, as it is if any case fails).
+Run from the repository root with::
+
+    python -m benchmarks.suite
+
+and, to store the results as the new baseline::
+
+    python -m benchmarks.suite --save-baseline
+
+Timings depend on the machine, so only compare results from the same one.
+"""
+import argparse
+import datetime
+import functools
+import json
+import os
+import platform
+import statistics
+import sys
+import timeit
+from pathlib import Path
+
+BASELINE = Path(__file__).parent / "baseline.json"
+
+# Quantities written to the data download (the full set takes minutes per model).
+DATA_QUANTITIES = [
+    "dndm",
+    "dndlnm",
+    "ngtm",
+    "sigma",
+    "power",
+    "transfer_function",
+    "power_auto_tracer",
+]
+
+CONFIGS = {
+    "default": {},
+    "wdm": {"wdm_mass": 3.0, "wdm_model": "Viel05"},
+    "camb_free": {"transfer_model": "EH"},
+}
+
+# The change made to a model when cloning it, as when editing its mass function.
+CLONE_CHANGE = {"hmf_model": "ST"}
+
+MODEL_COUNTS = (1, 8)
+
+
+def setup():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "TheHaloMod.settings.local")
+    # Don't record the benchmarks' computations in the quantity profile.
+    os.environ.setdefault("QUANTITY_PROFILE", "")
+
+    import django
+
+    django.setup()
+
+
+def _config(name: str) -> tuple:
+    """The framework and parameters of a configuration (as the form gives them)."""
+    from halomod import TracerHaloModel
+    from halomod.wdm import HaloModelWDM
+
+    params = CONFIGS[name]
+    return HaloModelWDM if "wdm_mass" in params else TracerHaloModel, params
+
+
+@functools.lru_cache()
+def _model(name: str):
+    from halomod_app import utils
+
+    cls, params = _config(name)
+    return utils.hmf_driver(cls=cls, **params)
+
+
+@functools.lru_cache()
+def _models(n: int) -> dict:
+    """``n`` models (at different redshifts), with their downloadable data computed."""
+    from halomod_app import exports, utils
+
+    base = utils.hmf_driver()
+    objects = {"default": base}
+    for i in range(1, n):
+        objects[f"z{i}"] = utils.hmf_driver(previous=base, z=0.1 * i)
+
+    exports.evaluate(objects, exports.quantities_for("ascii", DATA_QUANTITIES))
+    exports.evaluate(objects, exports.quantities_for("halogen"))
+    return objects
+
+
+def _driver_cases() -> dict:
+    from halomod_app import utils
+
+    cases = {}
+    for name in CONFIGS:
+        cls, params = _config(name)
+        cases[f"hmf_driver.construct.{name}"] = functools.partial(
+            utils.hmf_driver, cls=cls, **params
+        )
+        cases[f"hmf_driver.clone.{name}"] = functools.partial(
+            utils.hmf_driver, cls=cls, previous=_model(name), **params, **CLONE_CHANGE
+        )
+    return cases
+
+
+def _canvas_cases() -> dict:
+    from halomod_app import utils
+
+    return {
+        f"create_canvas.{fmt}.{n}": functools.partial(
+            lambda n, fmt: utils.create_canvas(
+                _models(n), "dndm", utils.KEYMAP["dndm"], fmt
+            ),
+            n,
+            fmt,
+        )
+        for fmt in ["png", "svg", "pdf"]
+        for n in MODEL_COUNTS
+    }
+
+
+def _archive_cases() -> dict:
+    from halomod_app import exports, views
+
+    def archive(fmt, n):
+        objects = _models(n)
+        quantities = exports.quantities_for(fmt, DATA_QUANTITIES)
+        return exports.WRITERS[fmt](exports.evaluate(objects, quantities))
+
+    cases = {}
+    for n in MODEL_COUNTS:
+        cases[f"archive.data_output.{n}"] = functools.partial(archive, "ascii", n)
+        cases[f"archive.header_txt.{n}"] = lambda n=n: views.parameters_archive(
+            _models(n)
+        )
+        cases[f"archive.halogen.{n}"] = functools.partial(archive, "halogen", n)
+    return cases
+
+
+def _session_cases() -> dict:
+    from halomod_app.sessions import SessionStore
+
+    serializer = SessionStore().serializer()
+
+    @functools.lru_cache()
+    def pickled(n):
+        return serializer.dumps({"objects": _models(n), "current_plot": "dndm"})
+
+    cases = {}
+    for n in MODEL_COUNTS:
+        cases[f"session.dumps.{n}"] = lambda n=n: serializer.dumps(
+            {"objects": _models(n), "current_plot": "dndm"}
+        )
+        cases[f"session.loads.{n}"] = lambda n=n: serializer.loads(pickled(n))
+    return cases
+
+
+def _form_cases() -> dict:
+    from halomod_app.forms import FrameworkInput
+
+    data = FrameworkInput.data_from_framework_dict({}, "default")
+
+    def validate():
+        form = FrameworkInput(data=data, compute_model=False)
+        assert form.is_valid(), form.errors
+
+    return {
+        "forms.unbound": lambda: FrameworkInput(),
+        "forms.bound": lambda: FrameworkInput(data=data, compute_model=False),
+        "forms.validate": validate,
+    }
+
+
+CASES = [_driver_cases, _canvas_cases, _archive_cases, _session_cases, _form_cases]
+
+
+def run(selected=None, repeat: int = 5, verbose: bool = True) -> dict:
+    """Time each case whose name contains one of ``selected`` (by default, all).
+
+    A case that raises is reported, and the others are still run.
+
+    Returns
+    -------
+    dict
+        For each case, the ``min`` and ``median`` seconds per call over the
+        repeats, and the number of calls in each; or the ``error`` it raised.
+    """
+    out = {}
+    for group in CASES:
+        try:
+            cases = group()
+        except Exception as e:
+            # Setting up the group failed, so none of its cases can be run.
+            cases = {group.__name__.strip("_"): e}
+
+        for name, func in cases.items():
+            if selected and not any(s in name for s in selected):
+                continue
+
+            try:
+                if isinstance(func, Exception):
+                    raise func
+
+                # Warm up (eg. computing the models, or starting the renderers).
+                func()
+
+                timer = timeit.Timer(func)
+                number, _ = timer.autorange()
+                times = [t / number for t in timer.repeat(repeat, number)]
+            except Exception as e:
+                out[name] = {"error": f"{type(e).__name__}: {e}"}
+                if verbose:
+                    print(f"{name:<32} ERROR: {out[name]['error']}", file=sys.stderr)
+                continue
+
+            out[name] = {
+                "min": min(times),
+                "median": statistics.median(times),
+                "number": number,
+            }
+            if verbose:
+                print(f"{name:<32} {1000 * min(times):12.3f} ms", file=sys.stderr)
+    return out
+
+
+def metadata() -> dict:
+    """Where and with what the benchmarks were run."""
+    import halomod
+    import hmf
+    import matplotlib
+    import numpy
+
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "machine": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "versions": {
+            m.__name__: m.__version__ for m in [hmf, halomod, numpy, matplotlib]
+        },
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Compare results with a baseline, case by case.
+
+    Returns
+    -------
+    list
+        For each case: its name, its time and the baseline's (min seconds per call,
+        or None if missing from, or failed in, either), and whether it is a
+        regression (slower by more than ``threshold``, as a fraction).
+    """
+    out = []
+    for name in sorted(set(results) | set(baseline)):
+        new = results.get(name, {}).get("min")
+        old = baseline.get(name, {}).get("min")
+        regression = new is not None and old is not None and new > old * (1 + threshold)
+        out.append((name, new, old, regression))
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "cases", nargs="*", help="only run the cases whose names contain these"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--baseline", default=str(BASELINE))
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store the results as the baseline, rather than comparing with it",
+    )
+    args = parser.parse_args(argv)
+
+    setup()
+    results = {"meta": metadata(), "results": run(args.cases, args.repeat)}
+
+    path = Path(args.baseline if args.save_baseline else args.output)
+    path.write_text(json.dumps(results, indent=2) + "\n")
+    print(f"Results written to {path}")
+
+    errors = {k: v["error"] for k, v in results["results"].items() if "error" in v}
+    for name, error in errors.items():
+        print(f"{name} failed: {error}")
+    if args.save_baseline:
+        return 1 if errors else 0
+
+    baseline = Path(args.baseline)
+    if not baseline.exists():
+        print(f"No baseline at {baseline} to compare with.")
+        return 0
+    baseline = json.loads(baseline.read_text())["results"]
+
+    print(f"{'case':<32} {'time [ms]':>12} {'baseline [ms]':>14} {'change':>8}")
+    regressions = 0
+    for name, new, old, regression in compare(
+        results["results"],
+        {
+            k: v
+            for k, v in baseline.items()
+            if not args.cases or k in results["results"]
+        },
+        args.threshold,
+    ):
+        change = f"{100 * (new / old - 1):+7.1f}%" if new and old else "     n/a"
+        print(
+            f"{name:<32} {1000 * new if new else float('nan'):12.3f} "
+            f"{1000 * old if old else float('nan'):14.3f} {change:>8}"
+            + ("  REGRESSION" if regression else "")
+        )
+        regressions += regression
+
+    if regressions:
+        print(
+            f"{regressions} case(s) slower than the baseline by over {args.threshold:.0%}"
+        )
+    if errors:
+        print(f"{len(errors)} case(s) failed")
+    return 1 if regressions or errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,321 @@
+"""A stateless JSON API for computing halo-model quantities.
+
+Unlike the rest of the site, the API doesn't use the session at all: each request
+gives the framework (with the same keys as
+:meth:`~halomod_app.forms.FrameworkInput.cleaned_data_to_framework_dict`) and the
+quantities it wants. The framework is validated by the input form, with the same
+bounds, and parameters that aren't given take the form's initial values. Results are
+shared with the rest of the site through the result cache, so a framework is only
+built if some requested quantity isn't cached yet.
+"""
+import io
+import json
+import logging
+from concurrent.futures import as_completed
+
+import numpy as np
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from . import compute as compute_pool
+from . import circuit, forms, results, utils
+
+logger = logging.getLogger(__name__)
+
+# Everything that can be asked for: the x-axes, and the quantities that are plotted.
+QUANTITIES = list(utils.XLABELS) + list(utils.KEYMAP)
+
+FORMATS = ("json", "npz")
+
+
+class APIError(ValueError):
+    """An error in an API request, reported to the client with a 400 response."""
+
+
+def validate_framework(params: dict) -> tuple:
+    """Validate a framework dict with the input form, as if it were submitted.
+
+    Returns
+    -------
+    cls, params
+        The framework class, and its full parameters as the form gives them.
+
+    Raises
+    ------
+    APIError
+        If any parameter is invalid (eg. out of bounds), or isn't in the form.
+    """
+    for name, (lower, upper, _) in forms.FrameworkInput.range_fields.items():
+        if (lower in params) != (upper in params):
+            raise APIError(f"'{lower}' and '{upper}' must be given together.")
+
+    form = forms.FrameworkInput(
+        data=forms.FrameworkInput.data_from_framework_dict(params, "api"),
+        compute_model=False,
+        store_uploads=False,
+    )
+    if not form.is_valid():
+        raise APIError(
+            "Invalid model: "
+            + "; ".join(f"{k}: {' '.join(v)}" for k, v in form.errors.items())
+        )
+
+    cls, out = form.halomod_cls, form.halomod_dct
+    unknown = [k for k in params if k not in out]
+    unknown += [
+        f"{k}.{name}"
+        for k, v in params.items()
+        if k.endswith("_params") and k in out and isinstance(v, dict)
+        for name in v
+        if name not in out[k]
+    ]
+    if unknown:
+        raise APIError(f"Parameters not in the input form: {unknown}")
+
+    return cls, out
+
+
+def parse_spec(spec) -> tuple:
+    """Validate the specification of a computation.
+
+    Parameters
+    ----------
+    spec
+        A dict with keys ``model`` (the framework dict) and ``quantities`` (a list of
+        names in :data:`QUANTITIES`).
+
+    Returns
+    -------
+    cls, params, quantities
+        The framework class, its parameters, and the quantities to compute.
+
+    Raises
+    ------
+    APIError
+        If the specification is malformed, or the framework is invalid (see
+        :func:`validate_framework`).
+    """
+    if not isinstance(spec, dict):
+        raise APIError("Each request must be a JSON object.")
+
+    params = spec.get("model", {})
+    if not isinstance(params, dict):
+        raise APIError("'model' must be an object of framework parameters.")
+
+    quantities = spec.get("quantities")
+    if not isinstance(quantities, list) or not quantities:
+        raise APIError("'quantities' must be a non-empty list.")
+
+    unknown = [q for q in quantities if q not in QUANTITIES]
+    if unknown:
+        raise APIError(f"Unknown quantities: {unknown}. Available: {QUANTITIES}")
+
+    cls, params = validate_framework(params)
+    return cls, params, list(dict.fromkeys(quantities))
+
+
+def compute(cls, params: dict, quantities: list) -> tuple:
+    """Compute quantities of a framework, using the result cache.
+
+    Raises
+    ------
+    APIError
+        If the framework can't be built from the parameters.
+    ~halomod_app.circuit.CircuitOpen
+        If the framework has repeatedly failed to compute.
+    """
+    try:
+        return results.get_framework_quantities(cls, params, quantities)
+    except circuit.CircuitOpen:
+        raise
+    except Exception as e:
+        logger.info(f"API computation failed for {cls.__name__}({params}): {e}")
+        raise APIError(f"Could not compute the model: {e}")
+
+
+def to_json(arr):
+    """An array as a JSON-able list, with non-finite values as null."""
+    if arr is None:
+        return None
+    arr = np.asarray(arr, dtype=float)
+    return np.where(np.isfinite(arr), arr, None).tolist()
+
+
+def _error(message: str, status: int = 400) -> JsonResponse:
+    return JsonResponse({"error": message}, status=status)
+
+
+@csrf_exempt
+@require_POST
+def compute_view(request):
+    """Compute quantities of a single framework.
+
+    The body is a JSON object with keys ``model``, ``quantities`` and (optionally)
+    ``format``, which is either "json" (the default) or "npz" for a binary numpy
+    archive of the arrays.
+    """
+    try:
+        spec = json.loads(request.body)
+        cls, params, quantities = parse_spec(spec)
+        fmt = spec.get("format", "json")
+        if fmt not in FORMATS:
+            raise APIError(f"'format' must be one of {FORMATS}.")
+
+        fingerprint, data = compute(cls, params, quantities)
+    except json.JSONDecodeError as e:
+        return _error(f"The body must be JSON: {e}")
+    except APIError as e:
+        return _error(str(e))
+    except circuit.CircuitOpen as e:
+        response = _error(str(e), status=503)
+        response["Retry-After"] = str(e.retry_after)
+        return response
+
+    if fmt == "npz":
+        buff = io.BytesIO()
+        np.savez(buff, **{q: v for q, v in data.items() if v is not None})
+        response = HttpResponse(buff.getvalue(), content_type="application/x-npz")
+        response["X-Fingerprint"] = fingerprint
+        return response
+
+    return JsonResponse(
+        {
+            "fingerprint": fingerprint,
+            "quantities": {q: to_json(v) for q, v in data.items()},
+        }
+    )
+
+
+def _ndjson(obj: dict) -> bytes:
+    return (json.dumps(obj) + "\n").encode()
+
+
+def _group_results(group: dict, error: str = None):
+    """The result lines of every item of a group of identical frameworks."""
+    for item in group["items"]:
+        if error is not None:
+            yield _ndjson({**item["ref"], "error": error})
+        else:
+            yield _ndjson(
+                {
+                    **item["ref"],
+                    "fingerprint": group["fingerprint"],
+                    "cached": group["cached"],
+                    "quantities": {
+                        q: to_json(group["data"][q]) for q in item["quantities"]
+                    },
+                }
+            )
+
+
+def run_batch(lines: list):
+    """Compute a batch of frameworks, yielding each result as an NDJSON line.
+
+    Identical frameworks (by fingerprint) are only computed once, for all the
+    quantities asked of them. Frameworks whose quantities are all cached are answered
+    straight away; the rest are computed in the process pool, and answered in the
+    order they finish. Each line refers to its item by ``index`` (its line number in
+    the batch) and, if given, ``id``. Failed items get an ``error`` instead of
+    ``quantities``.
+    """
+    groups = {}
+    for index, line in enumerate(lines):
+        ref = {"index": index}
+        try:
+            spec = json.loads(line)
+            if isinstance(spec, dict) and "id" in spec:
+                ref["id"] = spec["id"]
+            cls, params, quantities = parse_spec(spec)
+        except (json.JSONDecodeError, APIError) as e:
+            yield _ndjson({**ref, "error": str(e)})
+            continue
+
+        fingerprint = utils.framework_fingerprint(cls, params)
+        group = groups.setdefault(
+            fingerprint,
+            {
+                "fingerprint": fingerprint,
+                "cls": cls,
+                "params": params,
+                "quantities": {},
+                "items": [],
+            },
+        )
+        group["quantities"].update(dict.fromkeys(quantities))
+        group["items"].append({"ref": ref, "quantities": quantities})
+
+    futures = {}
+    for fingerprint, group in groups.items():
+        group["data"] = results.get_cached(fingerprint, group["quantities"])
+        missing = [q for q in group["quantities"] if q not in group["data"]]
+        group["cached"] = not missing
+
+        if not missing:
+            yield from _group_results(group)
+            continue
+
+        try:
+            group["attempt"] = circuit.begin(fingerprint)
+        except circuit.CircuitOpen as e:
+            yield from _group_results(group, error=str(e))
+            continue
+
+        future = compute_pool.get_executor().submit(
+            compute_pool.evaluate, group["cls"], group["params"], missing
+        )
+        futures[future] = group
+
+    try:
+        for future in as_completed(futures):
+            group = futures.pop(future)
+            try:
+                new = future.result()
+            except Exception as e:
+                circuit.end(group["fingerprint"], group["attempt"], e)
+                logger.info(f"Batch computation of {group['fingerprint']} failed: {e}")
+                yield from _group_results(
+                    group, error=f"Could not compute the model: {e}"
+                )
+                continue
+
+            circuit.end(group["fingerprint"], group["attempt"])
+            results.store(group["fingerprint"], new)
+            group["data"].update(new)
+            yield from _group_results(group)
+    finally:
+        # If the client went away before the end, the computations still running
+        # haven't failed.
+        for group in futures.values():
+            circuit.end(group["fingerprint"], group["attempt"])
+
+
+def batch_lines(request) -> tuple:
+    """The items of a batch request, and the error response to give instead, if any."""
+    lines = [line for line in request.body.splitlines() if line.strip()]
+    if not lines:
+        return lines, _error("The body must have one JSON object per line.")
+    if len(lines) > settings.API_BATCH_MAX_ITEMS:
+        return lines, _error(
+            f"A batch can have at most {settings.API_BATCH_MAX_ITEMS} items "
+            f"(got {len(lines)})."
+        )
+    return lines, None
+
+
+@csrf_exempt
+@require_POST
+def batch_view(request):
+    """Compute many frameworks at once.
+
+    The body has one JSON object per line, each as for :func:`compute_view` (but
+    always returned as JSON), optionally with an ``id`` to identify it in the
+    results. The response streams one JSON object per line, as each item finishes
+    (see :func:`run_batch`).
+    """
+    lines, error = batch_lines(request)
+    if error is not None:
+        return error
+
+    return StreamingHttpResponse(run_batch(lines), content_type="application/x-ndjson")
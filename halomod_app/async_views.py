@@ -0,0 +1,130 @@
+"""Async versions of the compute-heavy views, served under ASGI.
+
+Under ASGI (see ``TheHaloMod/asgi.py``, which sets ``ASYNC_VIEWS``), these replace
+the views of the same names in :mod:`~halomod_app.views`. They load the session,
+compute and build archives in threads, and draw plots in the renderer pool (see
+:mod:`~halomod_app.render`), awaiting each without holding a thread meanwhile. So a
+request waiting for a compute slot, or a slow client downloading a large archive,
+costs the web worker little more than its connection.
+"""
+import logging
+
+from asgiref.sync import sync_to_async
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseNotAllowed,
+    HttpResponseRedirect,
+)
+
+from . import api, circuit, exports, progress, render, results, utils, views
+
+logger = logging.getLogger(__name__)
+
+
+def offload(func):
+    """Run a blocking function in a thread, as a coroutine function."""
+    return sync_to_async(func, thread_sensitive=False)
+
+
+async def _session_get(request, key, default=None):
+    # Loading the session unpickles all its models.
+    return await offload(request.session.get)(key, default)
+
+
+async def plots(request, filetype, plottype):
+    """Async version of :func:`~halomod_app.views.plots`."""
+    objects = await _session_get(request, "objects", {})
+
+    if filetype not in ["png", "svg", "pdf", "zip"]:
+        logger.error(f"Strange 'filetype' extension requested: {filetype}. 404ing...")
+        raise Http404
+
+    if not objects:
+        return HttpResponseRedirect("/")
+    keymap = views.plot_keymap(objects)
+
+    if filetype == "svg":
+        request.session["current_plot"] = plottype
+
+    job = await offload(views.plot_job)(request, objects, plottype, keymap)
+    if job is not None:
+        await offload(progress.compute)(job, objects)
+
+    try:
+        lines, errors = await offload(utils.plot_lines)(
+            objects, plottype, getter=results.get_quantity
+        )
+        image = await render.arender(lines, keymap[plottype], filetype)
+    except Exception as e:
+        if job is not None:
+            await offload(job.finish)(error=str(e))
+        raise
+
+    if job is not None:
+        await offload(job.finish)(
+            error="; ".join(f"{k}: {v}" for k, v in errors.items()) or None
+        )
+
+    return views.plot_response(request, image, errors, filetype, plottype)
+
+
+async def header_txt(request):
+    """Async version of :func:`~halomod_app.views.header_txt`."""
+    objects = await _session_get(request, "objects")
+    if objects is None:
+        return HttpResponseRedirect("/")
+
+    return views.parameters_response(await offload(views.parameters_archive)(objects))
+
+
+async def _data_download(request, fmt):
+    objects = await _session_get(request, "objects")
+    if objects is None:
+        return HttpResponseRedirect("/")
+
+    choice, invalid = views.export_choice(request)
+    if invalid is not None:
+        return invalid
+
+    try:
+        return await offload(exports.archive_response)(
+            fmt,
+            objects,
+            selected=choice.selected_quantities(),
+            precision=choice.cleaned_data["precision"],
+        )
+    except circuit.CircuitOpen as e:
+        return views.circuit_open_response(e)
+
+
+async def data_output(request):
+    """Async version of :func:`~halomod_app.views.data_output`."""
+    return await _data_download(request, "ascii")
+
+
+async def halogen(request):
+    """Async version of :func:`~halomod_app.views.halogen`."""
+    return await _data_download(request, "halogen")
+
+
+async def batch(request):
+    """Async version of :func:`~halomod_app.api.batch_view`.
+
+    Django (before 4.2) sends streaming responses from the event loop, where the
+    batch would be computed as it's sent, blocking every other request. So the batch
+    is computed in a thread instead, and the results are sent once all have finished.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    lines, error = api.batch_lines(request)
+    if error is not None:
+        return error
+
+    content = await offload(list)(api.run_batch(lines))
+    return HttpResponse(b"".join(content), content_type="application/x-ndjson")
+
+
+# The API is used by scripts, not forms (django's csrf_exempt only wraps sync views).
+batch.csrf_exempt = True
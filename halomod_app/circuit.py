@@ -0,0 +1,196 @@
+"""A circuit breaker for models that repeatedly fail to compute.
+
+Some parameter sets make a computation crash, or run until the worker is killed for
+taking too long, every time they are tried -- and users tend to try them again,
+often from several tabs. Failures are counted per model fingerprint, and once a
+model has failed ``CIRCUIT_FAILURES`` times (within ``CIRCUIT_WINDOW`` seconds) its
+circuit is opened: for the next ``CIRCUIT_COOLDOWN`` seconds, computing it raises
+:class:`CircuitOpen` straight away.
+
+A worker that is killed can't record its own failure, so each computation records
+an attempt when it starts (see :func:`begin`), with a token and its start time, and
+withdraws it when it finishes (see :func:`end`). An attempt that is still recorded
+``CIRCUIT_COMPUTE_TIMEOUT`` seconds after it started (by default, the workers'
+``WORKER_TIMEOUT``) counts as a failure. Errors in
+the model itself (eg. invalid parameters) are quick and are reported to the user as
+usual, so only crashes (see :data:`CRASHES`) count.
+"""
+import logging
+import time
+import uuid
+from concurrent.futures import BrokenExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds that the set of attempts of a model may be locked for, at most.
+_LOCK_TIMEOUT = 5
+
+# Exceptions that count as failures of the computation, rather than of the model.
+CRASHES = (MemoryError, RecursionError, TimeoutError, BrokenExecutor)
+
+
+class CircuitOpen(Exception):
+    """Raised instead of computing a model that has repeatedly failed to compute."""
+
+    def __init__(self, fingerprint: str, retry_after: int):
+        # Passed on as the args, so that it can be pickled (eg. in the session).
+        super().__init__(fingerprint, retry_after)
+        self.fingerprint = fingerprint
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return (
+            "This model has repeatedly crashed or timed out while being computed, so "
+            f"it won't be tried again for {max(1, round(self.retry_after / 60))} "
+            "minutes. Try different parameters (eg. smaller ranges) instead."
+        )
+
+
+def _failures_key(fingerprint: str) -> str:
+    return f"thm-circuit:{fingerprint}"
+
+
+def _open_key(fingerprint: str) -> str:
+    return f"thm-circuit-open:{fingerprint}"
+
+
+def _attempts_key(fingerprint: str) -> str:
+    return f"thm-circuit-attempts:{fingerprint}"
+
+
+def _attempt_key(fingerprint: str, token: str) -> str:
+    return f"thm-circuit-attempt:{fingerprint}:{token}"
+
+
+def _attempts_lock_key(fingerprint: str) -> str:
+    return f"thm-circuit-attempts-lock:{fingerprint}"
+
+
+def check(fingerprint: str):
+    """Raise :class:`CircuitOpen` if the model's circuit is open."""
+    until = cache.get(_open_key(fingerprint))
+    if until is not None:
+        raise CircuitOpen(fingerprint, int(until - time.time()) + 1)
+
+
+def _fail(fingerprint: str):
+    """Count a failure of a model, opening its circuit if it has failed too often."""
+    key = _failures_key(fingerprint)
+    cache.add(key, 0, settings.CIRCUIT_WINDOW)
+    try:
+        failures = cache.incr(key)
+    except ValueError:
+        # It expired in between.
+        cache.set(key, 1, settings.CIRCUIT_WINDOW)
+        failures = 1
+
+    if failures >= settings.CIRCUIT_FAILURES:
+        logger.warning(f"Opening the circuit of model {fingerprint}")
+        metrics.CIRCUITS_OPENED.inc()
+        cache.set(
+            _open_key(fingerprint),
+            time.time() + settings.CIRCUIT_COOLDOWN,
+            settings.CIRCUIT_COOLDOWN,
+        )
+        cache.delete(key)
+
+
+def _sweep(fingerprint: str):
+    """Count the model's attempts that have timed out as failures."""
+    tokens = cache.get(_attempts_key(fingerprint)) or set()
+    started = cache.get_many([_attempt_key(fingerprint, t) for t in tokens])
+
+    now = time.time()
+    for key, start in started.items():
+        # Only whoever removes the attempt counts it, if several sweep at once.
+        if now - start > settings.CIRCUIT_COMPUTE_TIMEOUT and cache.delete(key):
+            logger.warning(f"Computation of model {fingerprint} timed out")
+            metrics.CRASHES.inc(error="timeout")
+            _fail(fingerprint)
+
+
+def _add_attempt(fingerprint: str, token: str, timeout: int):
+    """Add an attempt to the set of the model's attempts, dropping those that ended.
+
+    The set is locked (across processes) while it's modified, so that concurrent
+    attempts don't lose each other's tokens. The lock holds a token of its holder,
+    so that a holder whose lock expired doesn't release another's.
+    """
+    lock = _attempts_lock_key(fingerprint)
+    lock_token = uuid.uuid4().hex
+    deadline = time.monotonic() + 2 * _LOCK_TIMEOUT
+    while not cache.add(lock, lock_token, _LOCK_TIMEOUT):
+        if time.monotonic() > deadline:
+            # Losing the attempt only loses the chance to count it as timed out.
+            logger.warning(f"Timed out waiting for the attempts of {fingerprint}")
+            break
+        time.sleep(0.005)
+
+    try:
+        key = _attempts_key(fingerprint)
+        tokens = cache.get(key) or set()
+        started = cache.get_many([_attempt_key(fingerprint, t) for t in tokens])
+        tokens = {t for t in tokens if _attempt_key(fingerprint, t) in started}
+        cache.set(key, tokens | {token}, timeout)
+    finally:
+        if cache.get(lock) == lock_token:
+            cache.delete(lock)
+
+
+def begin(fingerprint: str) -> str:
+    """Record the start of an attempt to compute a model, or refuse it.
+
+    Returns
+    -------
+    str
+        The token of the attempt, to give to :func:`end`.
+
+    Raises
+    ------
+    CircuitOpen
+        If the model's circuit is open, or has just been opened because of the
+        attempts that have timed out.
+    """
+    check(fingerprint)
+    _sweep(fingerprint)
+    check(fingerprint)
+
+    token = uuid.uuid4().hex
+    # Long enough to still be there after timing out, to be counted then.
+    timeout = settings.CIRCUIT_COMPUTE_TIMEOUT + settings.CIRCUIT_WINDOW
+    cache.set(_attempt_key(fingerprint, token), time.time(), timeout)
+    _add_attempt(fingerprint, token, timeout)
+    return token
+
+
+def end(fingerprint: str, token: str, error: Exception = None):
+    """Record the end of an attempt started with :func:`begin`.
+
+    It counts as a failure if it crashed, unless it had already been counted as
+    timed out.
+    """
+    finished = cache.delete(_attempt_key(fingerprint, token))
+
+    if isinstance(error, CRASHES):
+        logger.warning(f"Computation of model {fingerprint} crashed: {error!r}")
+        if finished:
+            metrics.CRASHES.inc(error=type(error).__name__)
+            _fail(fingerprint)
+
+
+@contextmanager
+def guard(fingerprint: str):
+    """Run a computation of a model within the circuit breaker."""
+    token = begin(fingerprint)
+    try:
+        yield
+    except Exception as e:
+        end(fingerprint, token, e)
+        raise
+    end(fingerprint, token)
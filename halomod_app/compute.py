@@ -0,0 +1,95 @@
+"""A pool of worker processes for building halo models outside the request thread.
+
+Halo models are CPU-bound to build, so building several at once (eg. when importing a
+set of parameter files) is done in separate processes. The pool is created lazily,
+once per web worker, and lives as long as the worker does.
+"""
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import dill
+import numpy as np
+from django.conf import settings
+
+from . import transfer  # noqa: registers the FromStore transfer model
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """The process pool of this worker, creating it on first use."""
+    global _executor
+    with _executor_lock:
+        # A pool is broken for good if one of its processes dies (eg. out of memory).
+        if _executor is None or getattr(_executor, "_broken", False):
+            # Spawn rather than fork, since the web worker may already be running
+            # threads, which don't survive a fork.
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.COMPUTE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+    return _executor
+
+
+def _build(cls, kwargs: dict) -> bytes:
+    # Halo models are pickled with dill everywhere else too (eg. in the session),
+    # since plain pickle can't handle all of their attributes.
+    return dill.dumps(utils.hmf_driver(cls=cls, **kwargs))
+
+
+def evaluate(cls, kwargs: dict, quantities) -> dict:
+    """Build a framework and compute some of its quantities.
+
+    This is meant to be run in the pool (see :func:`get_executor`), so that only the
+    arrays, not the whole framework, are sent back.
+
+    Returns
+    -------
+    dict
+        Mapping of each quantity to its array (or None if the model doesn't
+        define it).
+    """
+    obj = utils.hmf_driver(cls=cls, **kwargs)
+
+    out = {}
+    for q in quantities:
+        val = getattr(obj, q)
+        out[q] = None if val is None else np.asarray(val)
+    return out
+
+
+def build_models(specs: dict) -> dict:
+    """Build several halo models concurrently.
+
+    Parameters
+    ----------
+    specs
+        Mapping of a label to a ``(cls, kwargs)`` tuple defining each model, as in
+        ``FrameworkInput.halomod_cls`` and ``FrameworkInput.halomod_dct``.
+
+    Returns
+    -------
+    dict
+        Mapping of each label to either the built model, or the exception raised
+        while building it.
+    """
+    executor = get_executor()
+    futures = {
+        label: executor.submit(_build, cls, kwargs)
+        for label, (cls, kwargs) in specs.items()
+    }
+
+    out = {}
+    for label, future in futures.items():
+        try:
+            out[label] = dill.loads(future.result())
+        except Exception as e:
+            logger.exception(f"Error building model {label}.")
+            out[label] = e
+    return out
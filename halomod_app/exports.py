@@ -0,0 +1,475 @@
+"""Building of the downloadable archives of model data.
+
+All export formats are built from the same evaluated data: each (model, quantity)
+pair is evaluated once (via the result cache), and the finished archive is itself
+cached by the fingerprints of the models in it, so that repeated downloads don't
+touch hmf at all.
+"""
+import hashlib
+import io
+import json
+import logging
+import zipfile
+from fractions import Fraction
+from functools import lru_cache
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+
+from . import metrics, results, timing, utils
+
+logger = logging.getLogger(__name__)
+
+# For each format: the content type and the filename of the download.
+FORMATS = {
+    "ascii": ("application/zip", "THM-output-data.zip"),
+    "npz": ("application/octet-stream", "THM-output-data.npz"),
+    "parquet": ("application/zip", "THM-output-parquet.zip"),
+    "halogen": ("application/zip", "halogen.zip"),
+}
+
+# Formats written as text tables, for which the float precision can be chosen.
+TEXT_FORMATS = ("ascii", "halogen")
+
+# Digits after the decimal point in text tables. 16 (ie. 17 significant digits) is
+# enough for every double-precision float to be read back exactly.
+DEFAULT_PRECISION = 16
+MAX_PRECISION = 17
+
+# Above this precision, the digits of a float no longer fit exactly in a float, so
+# they are computed in double-double arithmetic instead (see format_sci).
+_VECTORIZED_PRECISION = 14
+
+# Deflating text is far slower than formatting it, while higher levels only shrink
+# float tables by a few percent, so text archives use the fastest level.
+TEXT_COMPRESSLEVEL = 1
+
+
+def _axis_quantities(kind: str) -> list:
+    """All quantities in KEYMAP that are defined on the given axis."""
+    return [k for k in utils.KEYMAP if utils.KEYMAP[k]["xlab"] == utils.XLABELS[kind]]
+
+
+def quantities_for(fmt: str, selected=None) -> list:
+    """The model quantities (including x-axes) that a given format needs.
+
+    Parameters
+    ----------
+    fmt
+        The export format.
+    selected
+        The quantities in :data:`utils.KEYMAP` to export. By default, all of them.
+        Ignored for the fixed-content "halogen" format.
+    """
+    if fmt == "halogen":
+        return ["m", "ngtm", "k", "power"]
+
+    selected = list(utils.KEYMAP) if selected is None else list(selected)
+    axes = [
+        kind
+        for kind, xlab in utils.XLABELS.items()
+        if any(utils.KEYMAP[q]["xlab"] == xlab for q in selected)
+    ]
+    return axes + selected
+
+
+def evaluate(objects: dict, quantities) -> dict:
+    """Evaluate each quantity of each model exactly once.
+
+    Returns
+    -------
+    dict
+        Mapping from model label to a dict of quantity arrays.
+    """
+    return {
+        label: results.get_quantities(o, quantities) for label, o in objects.items()
+    }
+
+
+def axis_tables(data: dict) -> dict:
+    """Collect evaluated data into one column table per axis family.
+
+    Each key of :data:`utils.XLABELS` that was evaluated gives a table (a dict of
+    equal-length 1D arrays), with a ``label`` column naming the model of each row,
+    the x-axis column itself, and a column for every evaluated quantity defined on
+    that axis. Quantities that are ``None`` for a particular model are filled with
+    NaN.
+    """
+    tables = {}
+    for kind in utils.XLABELS:
+        if not all(kind in d for d in data.values()):
+            continue
+
+        columns = {"label": [], kind: []}
+        for label, d in data.items():
+            x = d[kind]
+            columns["label"].append(np.full(len(x), label))
+            columns[kind].append(x)
+
+            for q in _axis_quantities(kind):
+                if q in d:
+                    columns.setdefault(q, []).append(
+                        np.full(len(x), np.nan) if d[q] is None else d[q]
+                    )
+
+        tables[kind] = {k: np.concatenate(v) for k, v in columns.items()}
+
+    return tables
+
+
+def _zip(files: dict, compression=zipfile.ZIP_DEFLATED) -> bytes:
+    buff = io.BytesIO()
+    with zipfile.ZipFile(buff, "w", compression) as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return buff.getvalue()
+
+
+def _scale(a: np.ndarray, power: np.ndarray) -> np.ndarray:
+    """Compute ``a * 10**power`` elementwise, as accurately as possible.
+
+    Dividing by a (positive) power of ten, rather than multiplying by a negative one,
+    keeps the result correctly rounded whenever the power of ten is exact. Very large
+    powers are applied in two steps so as not to overflow.
+    """
+    first = np.clip(power, -300, 300)
+    with np.errstate(over="ignore", under="ignore"):
+        for p in (first, power - first):
+            a = np.where(p >= 0, a * 10.0 ** np.abs(p), a / 10.0 ** np.abs(p))
+    return a
+
+
+# Bound on the error of the digits computed in double-double arithmetic (in units
+# of the last digit), which is in fact many orders of magnitude smaller.
+_TOLERANCE = 1e-9
+
+
+@lru_cache(maxsize=None)
+def _power_dd(e2: int, k: int) -> tuple:
+    """``2**e2 * 10**k`` as a double-double: the sum of two floats, ``hi + lo``."""
+    exact = Fraction(2) ** e2 * Fraction(10) ** k
+    hi = float(exact)
+    return hi, float(exact - Fraction(hi))
+
+
+def _split(a: np.ndarray) -> tuple:
+    """Split floats into two halves of 26 bits, whose products are exact (Dekker)."""
+    c = 134217729.0 * a  # 2**27 + 1
+    hi = c - (c - a)
+    return hi, a - hi
+
+
+def _digits_fast(a: np.ndarray, exp: np.ndarray, precision: int) -> tuple:
+    """The digits of ``a / 10**exp``, rounded to ``precision`` decimal places.
+
+    The digits are computed in floating point, so may be off by one.
+    """
+    digits = np.rint(_scale(a, precision - exp)).astype(np.int64)
+    return digits, digits, np.zeros(len(a), dtype=bool)
+
+
+def _digits_exact(a: np.ndarray, exp: np.ndarray, precision: int) -> tuple:
+    """The digits of ``a / 10**exp``, correctly rounded to ``precision`` places.
+
+    ``a`` is multiplied by ``10**-exp`` in double-double arithmetic, which is exact
+    to far better than the unit of the last digit. Only values within that error of
+    a tie (halfway between two roundings) are left undecided.
+
+    Returns
+    -------
+    digits
+        The digits, as an integer.
+    truncated
+        The digits rounded down instead (to check the exponent with).
+    undecided
+        Whether the rounding of each value was left undecided.
+    """
+    m, e2 = np.frexp(a)
+
+    # The (exact) scale of each value, looked up once for each distinct one.
+    keys, inverse = np.unique(
+        e2.astype(np.int64) * 4096 + (precision - exp), return_inverse=True
+    )
+    e2s, ks = np.divmod(keys + 2048, 4096)
+    table = np.array(
+        [_power_dd(int(e), int(k) - 2048) for e, k in zip(e2s, ks)]
+    ).reshape(-1, 2)
+    hi, lo = table[inverse.ravel()].T
+
+    # m * hi exactly, as p + err (Dekker's two-product), then add m * lo.
+    p = m * hi
+    mh, ml = _split(m)
+    hh, hl = _split(hi)
+    err = ((mh * hh - p) + mh * hl + ml * hh) + ml * hl
+    rest = err + m * lo
+
+    # Round p + rest to an integer: p's integer part is exact, and the remainder is
+    # small enough to be added to its fraction exactly.
+    whole = np.floor(p)
+    rem = (p - whole) + rest
+    below = np.floor(rem)
+    frac = rem - below
+
+    whole = whole.astype(np.int64)
+    digits = whole + below.astype(np.int64) + (frac > 0.5)
+
+    # Values just short of an integer (within the error) are rounded down to it: if
+    # they were short of a power of ten, they round up to it anyway.
+    truncated = whole + np.floor(rem + _TOLERANCE).astype(np.int64)
+    return digits, truncated, np.abs(frac - 0.5) < _TOLERANCE
+
+
+def format_sci(x, precision: int = DEFAULT_PRECISION) -> np.ndarray:
+    """Format an array of floats in scientific notation, in vectorized form.
+
+    This is equivalent to ``"% .{precision}e" % value`` for each value, right-aligned
+    in a column of equal width. The digits are computed for the whole array at once
+    rather than value by value. Up to a precision of 14 this is done in floating
+    point, and the final digit may occasionally differ by one unit (ie. the value is
+    still accurate to within a unit in the last place). Above that, the digits no
+    longer fit exactly in a float, so they are computed in double-double arithmetic,
+    and are exact: the (rare) values too close to a tie to tell are formatted by
+    themselves.
+
+    Parameters
+    ----------
+    x
+        The 1D array of values to format.
+    precision
+        The number of digits after the decimal point, between 1 and
+        :data:`MAX_PRECISION`.
+
+    Returns
+    -------
+    np.ndarray
+        A ``(len(x), width)`` array of ASCII bytes, each row holding one value,
+        right-aligned and with a leading sign (or space) column.
+    """
+    if not 1 <= precision <= MAX_PRECISION:
+        raise ValueError(f"precision must be between 1 and {MAX_PRECISION}")
+
+    x = np.asarray(x, dtype=float)
+    get_digits = _digits_exact if precision > _VECTORIZED_PRECISION else _digits_fast
+
+    finite = np.isfinite(x)
+    a = np.where(finite, np.abs(x), 0.0)
+    nonzero = np.flatnonzero(a > 0)
+
+    # Decimal exponent, and the (precision + 1) significant digits as an integer.
+    exp = np.zeros(len(x), dtype=np.int64)
+    digits = np.zeros(len(x), dtype=np.int64)
+    undecided = np.zeros(len(x), dtype=bool)
+    exp[nonzero] = np.floor(np.log10(a[nonzero]))
+
+    # log10 can be off by one near powers of ten, in which case the exponent is
+    # corrected and the digits found again.
+    todo = nonzero
+    for _ in range(3):
+        if not len(todo):
+            break
+        digits[todo], truncated, undecided[todo] = get_digits(
+            a[todo], exp[todo], precision
+        )
+        high = truncated >= 10 ** (precision + 1)
+        low = truncated < 10**precision
+        exp[todo] += high.astype(np.int64) - low
+        todo = todo[high | low]
+
+    # Rounding up to the next power of ten, eg. 9.99 to 10.0, carries to the exponent.
+    carry = digits >= 10 ** (precision + 1)
+    digits[carry] //= 10
+    exp[carry] += 1
+
+    def _ascii(ints, ndigits):
+        powers = 10 ** np.arange(ndigits - 1, -1, -1, dtype=np.int64)
+        return (ints[:, None] // powers % 10).astype(np.uint8) + ord("0")
+
+    mantissa = _ascii(digits, precision + 1)
+
+    # Laid out with three-digit exponents, a space to the left of the sign.
+    out = np.empty((len(x), precision + 9), dtype=np.uint8)
+    out[:, 0] = ord(" ")
+    out[:, 1] = np.where(np.signbit(x), ord("-"), ord(" "))
+    out[:, 2] = mantissa[:, 0]
+    out[:, 3] = ord(".")
+    out[:, 4 : precision + 4] = mantissa[:, 1:]
+    out[:, precision + 4] = ord("e")
+    out[:, precision + 5] = np.where(exp < 0, ord("-"), ord("+"))
+    out[:, precision + 6 :] = _ascii(np.abs(exp), 3)
+
+    # As in C, exponents have at least two digits, and only as many more as needed:
+    # drop the leading zero of the others, shifting them right by one.
+    short = np.flatnonzero(np.abs(exp) < 100)
+    out[short, 1 : precision + 7] = out[short, : precision + 6]
+    out[short, 0] = ord(" ")
+    if len(short) == len(x):
+        out = out[:, 1:]
+
+    # NaN and inf can't be written digit-by-digit, nor can values whose rounding
+    # was left undecided, so write them by themselves, right-aligned.
+    for i in np.flatnonzero(~finite | undecided):
+        text = f"{x[i]: .{precision}e}" if finite[i] else f"{x[i]}"
+        out[i] = ord(" ")
+        out[i, -len(text) :] = np.frombuffer(text.encode(), dtype=np.uint8)
+
+    return out
+
+
+def write_columns(f, columns, precision: int = DEFAULT_PRECISION, chunksize=4096):
+    """Write equal-length columns to a binary file-like object as a text table.
+
+    The output is readable by ``np.loadtxt`` and is equivalent to
+    ``np.savetxt(f, np.array(columns).T)``, but each column is formatted in
+    vectorized form (see :func:`format_sci`), and rows are written in chunks, so
+    neither the transposed array nor the full text are ever held in memory.
+    """
+    if not len(columns):
+        return
+
+    n = len(columns[0])
+    for start in range(0, n, chunksize):
+        stop = min(start + chunksize, n)
+        space = np.full((stop - start, 1), ord(" "), dtype=np.uint8)
+
+        table = []
+        for c in columns:
+            table += [format_sci(c[start:stop], precision), space]
+        table[-1] = np.full((stop - start, 1), ord("\n"), dtype=np.uint8)
+
+        f.write(np.hstack(table).tobytes())
+
+
+def write_ascii(data: dict, precision: int = DEFAULT_PRECISION) -> bytes:
+    """A zip of mass-, k- and r-based text files for each model."""
+    buff = io.BytesIO()
+    with zipfile.ZipFile(
+        buff, "w", zipfile.ZIP_DEFLATED, compresslevel=TEXT_COMPRESSLEVEL
+    ) as archive:
+        for label, d in data.items():
+            for kind, xlab in utils.XLABELS.items():
+                if kind not in d:
+                    continue
+
+                items = [q for q in _axis_quantities(kind) if q in d]
+
+                with archive.open(f"{kind}Vector_{label}.txt", "w") as s:
+                    s.write(f"# [0] {xlab} ".encode())
+                    for j, q in enumerate(items):
+                        if d[q] is not None:
+                            s.write(f"[{j+1}] {utils.KEYMAP[q]['ylab']}\t".encode())
+                    s.write("\n".encode())
+
+                    write_columns(
+                        s,
+                        [d[kind]] + [d[q] for q in items if d[q] is not None],
+                        precision=precision,
+                    )
+
+    return buff.getvalue()
+
+
+def write_npz(data: dict) -> bytes:
+    """A single .npz file, with one table per axis family.
+
+    Arrays are stored under keys of the form ``<axis>/<column>``, eg. ``m/dndm``.
+    """
+    buff = io.BytesIO()
+    np.savez_compressed(
+        buff,
+        **{
+            f"{kind}/{column}": values
+            for kind, table in axis_tables(data).items()
+            for column, values in table.items()
+        },
+    )
+    return buff.getvalue()
+
+
+def write_parquet(data: dict) -> bytes:
+    """A zip of Parquet files, one per axis family."""
+    files = {}
+    for kind, table in axis_tables(data).items():
+        s = io.BytesIO()
+        utils.pyarrow.parquet.write_table(utils.pyarrow.table(table), s)
+        files[f"{kind}Vector.parquet"] = s.getvalue()
+        s.close()
+
+    # Parquet is already compressed.
+    return _zip(files, compression=zipfile.ZIP_STORED)
+
+
+def write_halogen(data: dict, precision: int = DEFAULT_PRECISION) -> bytes:
+    """A zip of the n(>m) and matter power spectrum files read by HALOgen."""
+    buff = io.BytesIO()
+    with zipfile.ZipFile(
+        buff, "w", zipfile.ZIP_DEFLATED, compresslevel=TEXT_COMPRESSLEVEL
+    ) as archive:
+        for label, d in data.items():
+            with archive.open(f"ngtm_{label}.txt", "w") as s:
+                write_columns(s, [d["m"], d["ngtm"]], precision=precision)
+
+            with archive.open(f"matterpower_{label}.txt", "w") as s:
+                write_columns(s, [d["k"], d["power"]], precision=precision)
+
+    return buff.getvalue()
+
+
+WRITERS = {
+    "ascii": write_ascii,
+    "npz": write_npz,
+    "parquet": write_parquet,
+    "halogen": write_halogen,
+}
+
+
+def archive_key(fmt: str, objects: dict, quantities: list, precision=None) -> str:
+    """Cache key of an archive, from its models' labels and fingerprints."""
+    models = [(label, utils.model_fingerprint(o)) for label, o in objects.items()]
+    digest = hashlib.sha1(
+        json.dumps([models, quantities, precision]).encode()
+    ).hexdigest()
+    return f"thm-export:{fmt}:{digest}"
+
+
+def build_archive(
+    fmt: str, objects: dict, selected=None, precision: int = DEFAULT_PRECISION
+) -> bytes:
+    """Get the finished archive of the given format for a set of models.
+
+    Only the ``selected`` quantities (by default, all of them) are computed and
+    written. ``precision`` is the number of digits after the decimal point used in
+    text formats. The archive is served from the cache if it has been built before
+    for exactly the same models and options.
+    """
+    quantities = quantities_for(fmt, selected)
+    options = {"precision": precision} if fmt in TEXT_FORMATS else {}
+
+    key = archive_key(fmt, objects, quantities, **options)
+    content = cache.get(key)
+    metrics.CACHE_LOOKUPS.inc(
+        cache="export", result="miss" if content is None else "hit"
+    )
+
+    if content is None:
+        data = evaluate(objects, quantities)
+        with timing.timed("export"):
+            content = WRITERS[fmt](data, **options)
+        cache.set(key, content, settings.EXPORT_CACHE_TIMEOUT)
+    else:
+        logger.debug(f"Serving {fmt} archive from cache ({key})")
+
+    return content
+
+
+def archive_response(
+    fmt: str, objects: dict, selected=None, precision: int = DEFAULT_PRECISION
+) -> HttpResponse:
+    """A download response containing the archive of the given format."""
+    content_type, filename = FORMATS[fmt]
+    response = HttpResponse(
+        build_archive(fmt, objects, selected, precision), content_type=content_type
+    )
+    response["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
@@ -2,8 +2,10 @@
 Defines custom meta-forms and other utilities to make forms easier.
 """
 
+import copy
 import logging
 import re
+import threading
 from collections import OrderedDict
 
 from crispy_forms.bootstrap import Tab
@@ -19,6 +21,9 @@ logger = logging.getLogger(__name__)
 
 DEFAULTS = TracerHaloModel.get_all_parameter_defaults()
 
+# Held while compiling forms, so that concurrent first requests compile them once.
+compile_lock = threading.RLock()
+
 
 class RangeSlider(forms.TextInput):
     def __init__(self, minimum, maximum, step, elem_name, *args, **kwargs):
@@ -36,8 +41,37 @@ class RangeSlider(forms.TextInput):
         except IndexError:
             return """[ """ + self.minimum + """,""" + self.maximum + """ ]"""
 
+    # Rendered widgets, shared by all instances, since the same sliders are rendered
+    # with the same few values over and over.
+    _rendered = {}
+    max_rendered = 1024
+
     def render(self, name, value, attrs=None, renderer=None):
+        key = (
+            name,
+            value,
+            self.minimum,
+            self.maximum,
+            self.step,
+            self.elem_name,
+            tuple(sorted({**self.attrs, **(attrs or {})}.items())),
+        )
 
+        try:
+            return self._rendered[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable attributes: just don't cache.
+            return self._render_slider(name, value, attrs)
+
+        html = self._render_slider(name, value, attrs)
+        if len(self._rendered) >= self.max_rendered:
+            self._rendered.clear()
+        self._rendered[key] = html
+        return html
+
+    def _render_slider(self, name, value, attrs=None):
         s = super(RangeSlider, self).render(name, value, attrs)
         elem_id = re.findall(r'id_([A-Za-z0-9_\./\\-]*)"', s)[0]
         val = self.get_initial(value)
@@ -224,49 +258,87 @@ class ComponentModelForm(forms.Form):
     field_kwargs = {}
 
     def __init__(self, *args, **kwargs):
+        self.compile()
         super().__init__(*args, **kwargs)
 
-        if self.label is None:
-            self.label = utils.camel_to_words(self.__class__.__name__.split("Form")[0])
+        self.label, self.kind, self._initial = self.__class__.__dict__["_spec"]
+
+    @classmethod
+    def compile(cls):
+        """Build the fields of the form, once per class.
+
+        The fields depend only on the class (its choices, and the defaults of each
+        model), so they're set as the ``base_fields`` of the class, which Django
+        copies for each instance. Instances then only need to bind their data.
+        """
+        # Check the class' own dict, so that subclasses get their own fields.
+        if "_spec" in cls.__dict__:
+            return
+
+        with compile_lock:
+            if "_spec" not in cls.__dict__:
+                cls._compile()
 
-        if self.kind is None:
-            self.kind = self.__class__.__name__.split("Form")[0].lower()
+    @classmethod
+    def _compile(cls):
+        label = cls.label or utils.camel_to_words(cls.__name__.split("Form")[0])
+        kind = cls.kind or cls.__name__.split("Form")[0].lower()
 
         # Get initial model choice based on defaults of TracerHaloModel.
-        if self._initial is None:
-            df = DEFAULTS.get(self.kind + "_model")
+        initial = cls._initial
+        if initial is None:
+            df = DEFAULTS.get(kind + "_model")
             if isinstance(df, str):
-                self._initial = df
+                initial = df
             elif df is None:
-                self._initial = "None"
+                initial = "None"
             else:
-                self._initial = df.__name__
+                initial = df.__name__
+
+        # All the possible parameters of each model. A model that can't be found
+        # (eg. removed from hmf/halomod) is left out, rather than breaking the form.
+        choices, model_fields = [], {}
+        for choice in cls.choices:
+            try:
+                model_fields.update(cls._get_model_fields(kind, choice[0]))
+            except (AttributeError, ImportError):
+                logger.exception(
+                    f"Could not get the fields of {kind} model {choice[0]}"
+                )
+                continue
+            choices.append(choice)
+
+        fields = dict(cls.declared_fields)
 
         # Fill the fields
-        if not self.multi:
-            self.fields[f"{self.kind}_model"] = forms.ChoiceField(
-                label=self.label,
-                choices=self.choices,
-                initial=self._initial,
+        if not cls.multi:
+            fields[f"{kind}_model"] = forms.ChoiceField(
+                label=label,
+                choices=choices,
+                initial=initial,
                 required=True,
             )
         else:
-            self.fields[f"{self.kind}_model"] = forms.MultipleChoiceField(
-                label=self.label,
-                choices=self.choices,
-                initial=[self._initial],
+            fields[f"{kind}_model"] = forms.MultipleChoiceField(
+                label=label,
+                choices=choices,
+                initial=[initial],
                 required=True,
             )
+        fields.update(model_fields)
+
+        for fieldname, field in cls.add_fields.items():
+            name = f"{kind}_{fieldname}"
+            fields[name] = copy.deepcopy(field)
+            fields[name].component = kind
+            fields[name].paramname = fieldname
 
-        # Add all the possible parameters for this model
-        for choice in self.choices:
-            self._add_default_model(choice[0])
+        # Useful for getting which fields are necessary for a given framework.
+        for field in fields.values():
+            field.module = cls.module
 
-        for fieldname, field in self.add_fields.items():
-            name = f"{self.kind}_{fieldname}"
-            self.fields[name] = field
-            self.fields[name].component = self.kind
-            self.fields[name].paramname = fieldname
+        cls.base_fields = fields
+        cls._spec = (label, kind, initial)
 
     def _process_extras(self, extra: list) -> Div:
         """Prepend extra fields to those inherently in the model."""
@@ -309,19 +381,26 @@ class ComponentModelForm(forms.Form):
             tab.append(row)
         return tab
 
-    def _add_default_model(self, model):
+    @classmethod
+    def get_model(cls, model):
+        """The component class of a model choice."""
+        return getattr(cls.module, model)
+
+    @classmethod
+    def _get_model_fields(cls, kind, model) -> dict:
         # Allow a "None" class
         if model == "None" or model is None:
-            return
+            return {}
 
-        cls = getattr(self.module, model)
+        model_cls = cls.get_model(model)
 
-        for key, val in getattr(cls, "_defaults", {}).items():
-            name = f"{self.kind}_{model}_{key}"
+        fields = {}
+        for key, val in getattr(model_cls, "_defaults", {}).items():
+            name = f"{kind}_{model}_{key}"
 
             if (
-                key in self.ignore_fields
-                or model + "_" + key in self.ignore_fields
+                key in cls.ignore_fields
+                or model + "_" + key in cls.ignore_fields
                 or isinstance(val, dict)
                 or val is None
             ):
@@ -333,16 +412,18 @@ class ComponentModelForm(forms.Form):
                 str: forms.ChoiceField,
             }
 
-            fkw = self.field_kwargs.get(key, {})
+            # Copy, since the field_kwargs are shared by all models of the class.
+            fkw = dict(cls.field_kwargs.get(key, {}))
             thisfield = fkw.pop("type", field_types.get(type(val), forms.FloatField))
 
-            self.fields[name] = thisfield(
+            fields[name] = thisfield(
                 label=fkw.pop("label", key), initial=str(val), required=False, **fkw
             )
 
-            self.fields[name].component = self.kind
-            self.fields[name].model = model
-            self.fields[name].paramname = key
+            fields[name].component = kind
+            fields[name].model = model
+            fields[name].paramname = key
+        return fields
 
     def _get_model_param_divs(self):
         param_div = Div(css_class="col-4")
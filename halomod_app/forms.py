@@ -1,19 +1,26 @@
 """All the forms on TheHaloMod"""
 
+import hashlib
+import json
 import logging
+import zipfile
+from pathlib import Path
 
 import hmf
 import numpy as np
 from crispy_forms.bootstrap import TabHolder
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Submit, Div, HTML, Field
+import toml
 from django import forms
+from django.conf import settings
 from django.utils.safestring import mark_safe
 from hmf import growth_factor, transfer_models, fitting_functions, filters, wdm
 from hmf.halos import mass_definitions
 from .form_utils import (
     CompositeForm,
     ComponentModelForm,
+    compile_lock,
     FrameworkForm,
     RangeSliderField,
 )
@@ -24,6 +31,8 @@ from halomod import halo_exclusion
 from halomod import hod
 from halomod import wdm as hm_wdm
 from halomod import TracerHaloModel
+from . import exports
+from . import transfer
 from . import utils
 from copy import copy
 
@@ -91,27 +100,24 @@ class TransferForm(ComponentModelForm):
             "BBKS (1986)",
         ),
         ("BondEfs", "Bond-Efstathiou"),
+        ("FromStore", "From file"),
     ]
     module = transfer_models
     ignore_fields = ["camb_params"]
 
     field_kwargs = {
-        "fname": {
+        "key": {
             "type": forms.FileField,
-            "label": "",
+            "label": "Transfer file (k, T)",
         }
     }
 
-    def clean_transfer_fname(self):
-        thefile = self.cleaned_data.get("transfer_fname", None)
-        if thefile is not None:
-            try:
-                np.genfromtxt(thefile)
-            except Exception:
-                raise forms.ValidationError(
-                    "Uploaded transfer file is of the wrong format"
-                )
-        return thefile
+    @classmethod
+    def get_model(cls, model):
+        # Uploaded files are stored by TheHaloMod itself, rather than hmf.
+        if model == "FromStore":
+            return transfer.FromStore
+        return super().get_model(model)
 
 
 class TransferFramework(FrameworkForm):
@@ -452,6 +458,8 @@ class FrameworkInput(CompositeForm):
         model_label=None,
         current_models=None,
         edit=False,
+        compute_model=True,
+        store_uploads=True,
         *args,
         **kwargs,
     ):
@@ -464,15 +472,16 @@ class FrameworkInput(CompositeForm):
             self.derivative_model = None
         self.edit = edit
 
-        super().__init__(*args, **kwargs)
+        # Whether to build the model (with hmf_driver) when cleaning. If False, only
+        # halomod_cls and halomod_dct are set, and the model can be built elsewhere.
+        self.compute_model = compute_model
 
-        # Add form.modules to fields (useful for getting which ones are necessary)
-        for form in self.forms:
-            if not hasattr(form, "module"):
-                continue
+        # Whether to store uploaded files (eg. transfer functions) when cleaning. If
+        # False, they're only parsed, and their keys are those they'd be stored under.
+        self.store_uploads = store_uploads
 
-            for field in form.fields:
-                self.fields[field].module = form.module
+        self.compile()
+        super().__init__(*args, **kwargs)
 
         # If this is not an edit, we can't use the same label!
         if not edit and model_label:
@@ -483,10 +492,54 @@ class FrameworkInput(CompositeForm):
         self.helper.form_class = "form-horizontal"
         self.helper.form_method = "post"
 
+        # The <form> tag (with its CSRF token) is written by the template, so that
+        # the rest of the rendered form is the same for everyone and can be cached.
+        self.helper.form_tag = False
+
         self.helper.help_text_inline = True
         self.helper.label_class = "col-3 control-label"
         self.helper.field_class = "col-8"
 
+        # The layout is the same for every instance, so it's only built once.
+        self.helper.layout = self.__class__.__dict__["_layout_tree"]
+        self.helper.form_action = ""
+
+    @property
+    def initial_fingerprint(self) -> str:
+        """A fingerprint of everything that the rendering of the unbound form uses.
+
+        This is the initial values (eg. from a previous model) and the label. Keys
+        that aren't fields, like the CSRF token of a previous form, aren't rendered
+        and so are left out.
+        """
+        initial = self.initial
+        if hasattr(initial, "lists"):
+            # A QueryDict, ie. the data of a previous form.
+            initial = dict(initial.lists())
+        initial = {key: value for key, value in initial.items() if key in self.fields}
+
+        return hashlib.sha1(
+            json.dumps(
+                [self.fields["label"].initial, initial], sort_keys=True, default=str
+            ).encode()
+        ).hexdigest()
+
+    @classmethod
+    def compile(cls):
+        """Build the fields of all sub-forms, and the layout of the form, once."""
+        if "_layout_tree" in cls.__dict__:
+            return
+
+        with compile_lock:
+            if "_layout_tree" not in cls.__dict__:
+                cls._compile()
+
+    @classmethod
+    def _compile(cls):
+        for form in cls.form_list:
+            if issubclass(form, ComponentModelForm):
+                form.compile()
+
         # Here we modify some of the tab layouts because they are more obvious this way.
         extras = {
             CosmoForm: ("z", "n", "sigma_8"),
@@ -497,11 +550,10 @@ class FrameworkInput(CompositeForm):
         }
         omit = [TransferFramework, MassFunctionFramework, WDMFramework, WDMAlterForm]
 
-        print(
-            self.forms[self.form_list.index(WDMAlterForm)]._layout().fields[-1].fields
-        )
+        # The layouts are built from unbound instances of each sub-form.
+        forms = {form: form() for form in cls.form_list}
 
-        self.helper.layout = Layout(
+        cls._layout_tree = Layout(
             Div(
                 Div("label", css_class="col"),
                 Div(
@@ -525,22 +577,19 @@ class FrameworkInput(CompositeForm):
                 *[
                     form._layout(
                         extra=[
-                            x
-                            for x in extras.get(self.form_list[i], ())
-                            if isinstance(x, str)
+                            x for x in extras.get(form_cls, ()) if isinstance(x, str)
                         ],
                         appended_rows=[
-                            self.forms[self.form_list.index(x)]._layout().fields[-1]
-                            for x in extras.get(self.form_list[i], ())
+                            forms[x]._layout().fields[-1]
+                            for x in extras.get(form_cls, ())
                             if not isinstance(x, str)
                         ],
                     )
-                    for i, form in enumerate(self.forms)
-                    if self.form_list[i] not in omit
+                    for form_cls, form in forms.items()
+                    if form_cls not in omit
                 ]
             ),
         )
-        self.helper.form_action = ""
 
     def clean_label(self):
         label = self.cleaned_data["label"]
@@ -550,34 +599,77 @@ class FrameworkInput(CompositeForm):
             raise forms.ValidationError("Label must be unique")
         return label
 
+    def clean_transfer_FromStore_key(self):
+        """Parse (and store) an uploaded transfer file, returning its key."""
+        upload = self.cleaned_data.get("transfer_FromStore_key")
+        if not upload:
+            return ""
+
+        try:
+            table = transfer.read_table(upload, settings.TRANSFER_UPLOAD_MAX_BYTES)
+        except (ValueError, UnicodeDecodeError) as e:
+            raise forms.ValidationError(
+                f"Uploaded transfer file is of the wrong format: {e}"
+            )
+        if not self.store_uploads:
+            return transfer.table_key(table)
+        return transfer.store_table(table)
+
+    def _stored_transfer_key(self) -> str:
+        """The key of an already-stored transfer file for this model."""
+        # Imported parameter files give the key itself.
+        key = self.data.get("transfer_FromStore_key")
+        if isinstance(key, str) and transfer.has_table(key):
+            return key
+
+        # Edits of a model can keep using its file.
+        previous = self.derivative_model
+        if previous is not None and previous.transfer_model is transfer.FromStore:
+            return previous.transfer_params["key"]
+
+        raise forms.ValidationError("A transfer file must be uploaded.")
+
     def clean(self):
         """
         Clean the form for things that need to be cross-referenced between fields.
         """
         cleaned_data = super().clean()
 
-        # Check k limits
-        krange = cleaned_data.get("lnk_range")
-        dlnk = cleaned_data.get("dlnk")
-
-        if dlnk > (float(krange[1]) - float(krange[0])) / 2:
-            raise forms.ValidationError(
-                "Wavenumber step-size must be less than the k-range."
-            )
+        # A transfer function from file needs a file, but if none was uploaded we can
+        # re-use the one already stored for an imported or edited model.
+        if cleaned_data.get("transfer_model") == "FromStore":
+            if not cleaned_data.get("transfer_FromStore_key"):
+                cleaned_data["transfer_FromStore_key"] = self._stored_transfer_key()
+
+        # Check that step sizes fit in their ranges. Fields that are already invalid
+        # have their own errors, but the others are still checked so that every
+        # problem is reported at once.
+        for step, range_field, message in self.step_rules:
+            if step in self._errors or range_field in self._errors:
+                continue
 
-        # Check mass limits
-        mrange = cleaned_data.get("logm_range")
-        dlogm = cleaned_data.get("dlog10m")
+            value = cleaned_data.get(step)
+            if value is None:
+                self.add_error(None, f"{step} must be provided")
+                continue
 
-        if dlogm is None:
-            raise forms.ValidationError("dlogm must be provided")
+            lower, upper = cleaned_data.get(range_field)
+            if value > (float(upper) - float(lower)) / 2:
+                self.add_error(None, message)
 
-        if dlogm > (float(mrange[1]) - float(mrange[0])) / 2:
-            raise forms.ValidationError("Mass step-size must be less than its range.")
+        # The framework can only be built from a form that is entirely valid.
+        if self._errors:
+            return cleaned_data
 
         cls, frmwk_dict = self.cleaned_data_to_framework_dict(cleaned_data)
         logger.info(f"Constructed hmf_dct: {frmwk_dict}")
 
+        self.halomod_cls = cls
+        self.halomod_dct = frmwk_dict
+
+        if not self.compute_model:
+            return cleaned_data
+
         try:
             self.halomod_obj = utils.hmf_driver(
                 previous=self.derivative_model, cls=cls, **frmwk_dict
@@ -587,11 +679,78 @@ class FrameworkInput(CompositeForm):
             logger.error(f"Got form error: {e}")
             raise forms.ValidationError(str(e))
 
-        self.halomod_cls = cls
-        self.halomod_dct = frmwk_dict
-
         return cleaned_data
 
+    # Step-size fields that must be at most half of the width of a range field, with
+    # the error to show if they're not. These are also checked in the browser.
+    step_rules = [
+        ("dlnk", "lnk_range", "Wavenumber step-size must be less than the k-range."),
+        ("dlog10m", "logm_range", "Mass step-size must be less than its range."),
+    ]
+
+    # Form fields that hold a range of two framework parameters, with the function
+    # that converts each parameter to its value in the field.
+    range_fields = {
+        "lnk_range": ("lnk_min", "lnk_max", float),
+        "logm_range": ("Mmin", "Mmax", float),
+        "log_r_range": ("rmin", "rmax", np.log10),
+        "log_k_range": ("hm_logk_min", "hm_logk_max", float),
+    }
+
+    @classmethod
+    def data_from_framework_dict(cls, params: dict, label: str) -> dict:
+        """Form data that recreates a framework from its parameters.
+
+        This is the inverse of :meth:`cleaned_data_to_framework_dict`, and accepts the
+        ``params`` written to TOML by :func:`hmf.helpers.cfg_utils.framework_to_dict`
+        (as in the parameters download). Fields that aren't given keep their initial
+        values, and parameters that have no field in the form are ignored.
+        """
+        fields = cls().fields
+        data = {name: field.initial for name, field in fields.items()}
+
+        # A select whose initial value isn't one of its choices (eg. wdm_model, which
+        # defaults to None) is submitted by the browser with its first choice.
+        for name, field in fields.items():
+            if isinstance(field, forms.ChoiceField) and field.choices:
+                if not isinstance(field, forms.MultipleChoiceField):
+                    if not field.valid_value(data[name]):
+                        data[name] = field.choices[0][0]
+        data["label"] = label
+
+        for name, (lower, upper, convert) in cls.range_fields.items():
+            if lower in params and upper in params:
+                data[name] = f"{convert(params[lower])} - {convert(params[upper])}"
+
+        for key, val in params.items():
+            if key.endswith("_model") and key in fields:
+                # Models that are None just aren't used (eg. wdm_model outside WDM),
+                # so keep the initial choice unless "None" is a choice itself.
+                if val is not None or fields[key].valid_value("None"):
+                    data[key] = "None" if val is None else val
+            elif key.endswith("_params") and isinstance(val, dict):
+                component = key[: -len("_params")]
+                model = params.get(f"{component}_model")
+
+                for paramname, v in val.items():
+                    # Astropy quantities are written as {"value": ..., "unit": ...}
+                    if isinstance(v, dict) and "value" in v:
+                        v = v["value"]
+
+                    for name in (
+                        f"{component}_{model}_{paramname}",
+                        f"{component}_{paramname}",
+                    ):
+                        if name in fields and v is not None:
+                            data[name] = v
+                            break
+            elif key in fields:
+                data[key] = val
+            else:
+                logger.info(f"Parameter {key} has no form field, ignoring it.")
+
+        return data
+
     def cleaned_data_to_framework_dict(self, cleaned_data):
         # get all the _params out
         out = {}
@@ -827,9 +986,13 @@ class PlotChoice(forms.Form):
         ("pdf-current", "PDF of Current Plot"),
         # ("pdf-all", "PDF's of All Plots"),
         ("ASCII", "All ASCII data"),
+        ("ASCII-current", "ASCII data of current plot"),
+        ("npz", "All data (NumPy .npz)"),
         ("parameters", "List of parameter values"),
         ("halogen", "HALOgen-ready input"),
     ]
+    if utils.HAVE_PYARROW:
+        download_choices.insert(4, ("parquet", "All data (Parquet)"))
 
     download_choice = forms.ChoiceField(
         label=mark_safe(
@@ -841,6 +1004,113 @@ class PlotChoice(forms.Form):
     )
 
 
+class ExportChoice(forms.Form):
+    """Which quantities to include in a data download.
+
+    Quantities can be given individually, or as whole groups of
+    :attr:`PlotChoice.plot_choices` (eg. "Mass Function"). If neither is given, all
+    quantities are included. ``precision`` sets the number of digits after the decimal
+    point in text downloads.
+    """
+
+    quantities = forms.MultipleChoiceField(
+        choices=[(k, k) for k in utils.KEYMAP], required=False
+    )
+    groups = forms.MultipleChoiceField(
+        choices=[(group, group) for group, _ in PlotChoice.plot_choices],
+        required=False,
+    )
+    precision = forms.IntegerField(
+        min_value=1, max_value=exports.MAX_PRECISION, required=False
+    )
+
+    def selected_quantities(self):
+        """The selected quantities, in KEYMAP order, or None if all are wanted."""
+        selected = set(self.cleaned_data["quantities"])
+        for group, choices in PlotChoice.plot_choices:
+            if group in self.cleaned_data["groups"]:
+                selected.update(name for name, _ in choices if name in utils.KEYMAP)
+
+        if not selected:
+            return None
+        return [k for k in utils.KEYMAP if k in selected]
+
+    def clean_precision(self):
+        return self.cleaned_data["precision"] or exports.DEFAULT_PRECISION
+
+
+def _read_limited(f, name: str) -> bytes:
+    """Read a file from a zip, unless it is larger than a parameter file can be.
+
+    Its size in the zip's directory can't be trusted, so it is checked again here.
+    """
+    content = f.read(settings.IMPORT_MAX_FILE_BYTES + 1)
+    if len(content) > settings.IMPORT_MAX_FILE_BYTES:
+        raise forms.ValidationError(f"{name} is too large to be a parameter file.")
+    return content
+
+
+class ImportForm(forms.Form):
+    """Upload of parameter files, to recreate the models they describe."""
+
+    files = forms.FileField(
+        label="Parameter files",
+        help_text=(
+            "TOML files, or a zip of them, as given by the 'List of parameter values' "
+            "download. Each model is labelled by its file name."
+        ),
+        widget=forms.ClearableFileInput(attrs={"multiple": True}),
+    )
+
+    def __init__(self, *args, **kwargs):
+        self.helper = FormHelper()
+        self.helper.add_input(Submit("submit", "Import"))
+        super().__init__(*args, **kwargs)
+
+    def clean(self):
+        """Read the framework parameters of each model out of the uploaded files."""
+        cleaned_data = super().clean()
+
+        self.bundles = {}
+        for upload in self.files.getlist("files"):
+            try:
+                if upload.name.endswith(".zip"):
+                    with zipfile.ZipFile(upload) as archive:
+                        for info in archive.infolist():
+                            if info.filename.endswith(".toml"):
+                                self._check_size(info.filename, info.file_size)
+                                with archive.open(info) as f:
+                                    content = _read_limited(f, info.filename)
+                                self._add_bundle(info.filename, content.decode())
+                else:
+                    self._check_size(upload.name, upload.size)
+                    self._add_bundle(upload.name, upload.read().decode())
+            except (zipfile.BadZipFile, UnicodeDecodeError, toml.TomlDecodeError):
+                raise forms.ValidationError(f"Could not read {upload.name}")
+
+        if not self.bundles:
+            raise forms.ValidationError("No parameter files were found.")
+
+        return cleaned_data
+
+    def _check_size(self, name, size):
+        if len(self.bundles) >= settings.IMPORT_MAX_FILES:
+            raise forms.ValidationError(
+                f"At most {settings.IMPORT_MAX_FILES} files can be imported at once."
+            )
+        if size > settings.IMPORT_MAX_FILE_BYTES:
+            raise forms.ValidationError(f"{name} is too large to be a parameter file.")
+
+    def _add_bundle(self, name, content):
+        label = Path(name).stem
+        if label in self.bundles:
+            raise forms.ValidationError(f"More than one file is labelled {label}")
+
+        params = toml.loads(content)
+        # Files from the parameters download have the parameters under 'params'.
+        self.bundles[label] = params.get("params", params)
+
+
 class ContactForm(forms.Form):
     name = forms.CharField(required=True)
     email = forms.EmailField(required=True)
@@ -0,0 +1,64 @@
+"""Summarize the time taken to compute quantities, by model configuration."""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import profiling
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the slowest quantities to compute, and the model configurations that "
+        "make them slow (see halomod_app.profiling)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--by",
+            default="quantity",
+            help=(
+                "Group timings by 'quantity', by quantity and model 'config', or by "
+                "quantity and one feature of the configuration (eg. 'rnum')."
+            ),
+        )
+        parser.add_argument(
+            "--quantity",
+            action="append",
+            dest="quantities",
+            help="Only summarize this quantity (may be given several times).",
+        )
+        parser.add_argument(
+            "--since",
+            type=float,
+            help="Only summarize the timings of the last this many hours.",
+        )
+        parser.add_argument(
+            "--limit", type=int, default=20, help="The number of rows to show."
+        )
+
+    def handle(self, *args, by, quantities, since, limit, **options):
+        try:
+            rows = profiling.summarize(
+                by=by,
+                quantities=quantities,
+                since=since and time.time() - 3600 * since,
+                limit=limit,
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if not rows:
+            self.stdout.write("No timings recorded.")
+            return
+
+        self.stdout.write(
+            f"{'quantity':<28} {'count':>6} {'mean [s]':>9} {'p90 [s]':>9} "
+            f"{'max [s]':>9} {'total [s]':>10}"
+            + ("" if by == "quantity" else f"  {by}")
+        )
+        for row in rows:
+            self.stdout.write(
+                f"{row['quantity']:<28} {row['count']:6d} {row['mean']:9.3f} "
+                f"{row['p90']:9.3f} {row['max']:9.3f} {row['total']:10.2f}"
+                + ("" if by == "quantity" else f"  {row[by]}")
+            )
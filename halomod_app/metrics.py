@@ -0,0 +1,364 @@
+"""Metrics of the site, served at ``/metrics`` in the Prometheus text format.
+
+Counters and histograms (see :class:`Counter` and :class:`Histogram`) are updated in
+memory by the code they measure (eg. ``metrics.CACHE_LOOKUPS.inc(cache="result",
+result="hit")``), while gauges and totals kept elsewhere (eg. the depth of the
+compute queue, or :func:`~halomod_app.scheduling.stats`) are collected when the
+metrics are read. The metrics are:
+
+``thm_request_duration_seconds``, ``thm_requests_total``
+    The time taken to serve requests, and their number, by view (the name of its
+    URL) and status (see :mod:`~halomod_app.timing`).
+``thm_request_phase_seconds``
+    The time spent in each phase of serving requests (session, compute, render...).
+``thm_cache_lookups_total``
+    Lookups in the session, result and export caches, by whether they hit. Plots
+    are drawn from the result cache.
+``thm_session_bytes``
+    The size of (pickled) sessions, when loaded and saved.
+``thm_compute_duration_seconds``, ``thm_compute_wait_seconds``
+    The time taken by compute-heavy requests, and that they waited for a compute
+    slot, by class (see :mod:`~halomod_app.scheduling`).
+``thm_compute_queue_waiting``, ``thm_compute_slots_busy``
+    The requests waiting for, and holding, a compute slot of each worker.
+``thm_throttled_total``, ``thm_rejected_total``
+    Requests turned away for being over their quota, or over capacity.
+``thm_progress_job_duration_seconds``
+    The time taken by progress jobs (see :mod:`~halomod_app.progress`).
+``thm_timeouts_total``, ``thm_compute_crashes_total``, ``thm_circuits_opened_total``
+    Waits that timed out, computations that crashed (incl. timing out), and models
+    refused for crashing repeatedly (see :mod:`~halomod_app.circuit`).
+``thm_worker_rss_bytes``
+    The resident memory of each worker.
+
+Gauges have a ``pid`` label, of the worker they are from. Metrics are kept per
+process, so with several web workers each would only serve its own. If
+``METRICS_DIR`` is set, each process writes its metrics to a file there every
+``METRICS_FLUSH_INTERVAL`` seconds, and ``/metrics`` serves the total of all of them
+(including processes that have since exited, for counters and histograms). The
+directory should be emptied when the site is (re)started.
+"""
+import json
+import logging
+import math
+import os
+import resource
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+BYTE_BUCKETS = tuple(2**10 * 4**i for i in range(10))
+
+_lock = threading.Lock()
+_registry = {}
+
+
+class Metric:
+    """A metric, with a value for each combination of its labels.
+
+    If ``collect`` is given, it is called when the metric is read, and returns the
+    values by tuple of label values.
+    """
+
+    kind = None
+
+    def __init__(self, name: str, help: str, labels=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        self._values = {}
+        _registry[name] = self
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def samples(self) -> list:
+        """The samples of the metric, as ``[suffix, labels, value]``."""
+        if self.collect is not None:
+            values = self.collect()
+        else:
+            with _lock:
+                values = dict(self._values)
+        return [["", dict(zip(self.labels, k)), v] for k, v in values.items()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels=(), collect=None):
+        super().__init__(name, help, labels, collect)
+        if not self.labels:
+            self._values[()] = 0
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        _start_flushing()
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with _lock:
+            # The count in each bucket (and above the last), and the sum.
+            counts = self._values.setdefault(key, [0] * (len(self.buckets) + 1) + [0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+            counts[i] += 1
+            counts[-1] += value
+        _start_flushing()
+
+    def samples(self) -> list:
+        with _lock:
+            values = {k: list(v) for k, v in self._values.items()}
+
+        out = []
+        for key, counts in values.items():
+            labels = dict(zip(self.labels, key))
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts[:-1]):
+                total += count
+                out.append(["_bucket", {**labels, "le": _format(bound)}, total])
+            out.append(["_sum", labels, counts[-1]])
+            out.append(["_count", labels, total])
+        return out
+
+
+def _scheduling_totals(name: str):
+    def collect():
+        from . import scheduling
+
+        return {(k,): v for k, v in scheduling.stats()[name].items()}
+
+    return collect
+
+
+def _queue_load(i: int):
+    def collect():
+        from . import scheduling
+
+        return {(): scheduling.get_queue().load()[i]}
+
+    return collect
+
+
+def _rss() -> dict:
+    try:
+        with open("/proc/self/statm") as f:
+            return {(): int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")}
+    except OSError:
+        # Not Linux: the peak instead (in kilobytes, or bytes on macOS).
+        return {(): resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+REQUEST_SECONDS = Histogram(
+    "thm_request_duration_seconds", "Time taken to serve requests, by view.", ["view"]
+)
+REQUESTS = Counter(
+    "thm_requests_total", "Requests served, by view and status.", ["view", "status"]
+)
+PHASE_SECONDS = Histogram(
+    "thm_request_phase_seconds",
+    "Time spent in each phase of serving requests.",
+    ["phase"],
+)
+CACHE_LOOKUPS = Counter(
+    "thm_cache_lookups_total",
+    "Lookups in the session, result and export caches, by whether they hit.",
+    ["cache", "result"],
+)
+SESSION_BYTES = Histogram(
+    "thm_session_bytes",
+    "Size of pickled sessions, when loaded and saved.",
+    ["operation"],
+    buckets=BYTE_BUCKETS,
+)
+COMPUTE_SECONDS = Histogram(
+    "thm_compute_duration_seconds",
+    "Time taken by compute-heavy requests once given a compute slot, by class.",
+    ["kind"],
+)
+COMPUTE_WAIT_SECONDS = Histogram(
+    "thm_compute_wait_seconds",
+    "Time compute-heavy requests waited for a compute slot, by class.",
+    ["kind"],
+)
+Gauge(
+    "thm_compute_queue_waiting",
+    "Requests waiting for a compute slot of the worker.",
+    collect=_queue_load(0),
+)
+Gauge(
+    "thm_compute_slots_busy",
+    "Compute slots of the worker in use.",
+    collect=_queue_load(1),
+)
+Counter(
+    "thm_throttled_total",
+    "Requests turned away for being over their compute quota, by kind of client.",
+    ["client"],
+    collect=_scheduling_totals("throttled"),
+)
+Counter(
+    "thm_rejected_total",
+    "Compute-heavy requests turned away for being over capacity, by class.",
+    ["kind"],
+    collect=_scheduling_totals("rejected"),
+)
+JOB_SECONDS = Histogram(
+    "thm_progress_job_duration_seconds",
+    "Time taken by progress jobs, by whether they failed.",
+    ["status"],
+)
+TIMEOUTS = Counter(
+    "thm_timeouts_total", "Waits that timed out, by what was waited for.", ["what"]
+)
+CRASHES = Counter(
+    "thm_compute_crashes_total",
+    "Computations that crashed or timed out, by error.",
+    ["error"],
+)
+CIRCUITS_OPENED = Counter(
+    "thm_circuits_opened_total", "Models refused for repeatedly crashing."
+)
+Gauge("thm_worker_rss_bytes", "Resident memory of the worker.", collect=_rss)
+
+
+def snapshot() -> dict:
+    """The current metrics of this process."""
+    out = {}
+    for name, metric in _registry.items():
+        try:
+            samples = metric.samples()
+        except Exception:
+            logger.exception(f"Could not collect metric {name}")
+            continue
+        out[name] = {"kind": metric.kind, "help": metric.help, "samples": samples}
+    return out
+
+
+# The file of the metrics of this process, and whether it is being written.
+_file = None
+_flushing_pid = None
+
+
+def _flush():
+    global _file
+    directory = Path(settings.METRICS_DIR)
+    if _file is None or not _file.name.startswith(f"{os.getpid()}."):
+        directory.mkdir(parents=True, exist_ok=True)
+        _file = directory / f"{os.getpid()}.{uuid.uuid4().hex[:8]}.json"
+
+    tmp = _file.with_suffix(".tmp")
+    tmp.write_text(json.dumps(snapshot()))
+    os.replace(tmp, _file)
+
+
+def _flush_forever():
+    while True:
+        time.sleep(settings.METRICS_FLUSH_INTERVAL)
+        try:
+            _flush()
+        except Exception:
+            logger.exception("Could not write the metrics of this process.")
+
+
+def _start_flushing():
+    """Start writing the metrics of this process to ``METRICS_DIR``, if it's set."""
+    global _flushing_pid
+    if _flushing_pid == os.getpid() or not settings.METRICS_DIR:
+        return
+    with _lock:
+        if _flushing_pid == os.getpid():
+            return
+        _flushing_pid = os.getpid()
+    threading.Thread(target=_flush_forever, daemon=True).start()
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _snapshots() -> list:
+    """The metrics of each process, as ``(pid, snapshot)``."""
+    if not settings.METRICS_DIR:
+        return [(os.getpid(), snapshot())]
+
+    _flush()
+    out = []
+    for path in Path(settings.METRICS_DIR).glob("*.json"):
+        try:
+            out.append((int(path.name.split(".")[0]), json.loads(path.read_text())))
+        except (OSError, ValueError):
+            # Being replaced, or not ours.
+            continue
+    return out
+
+
+def _format(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def exposition() -> str:
+    """The metrics of all processes, in the Prometheus text format."""
+    merged = {}
+    for pid, metrics in _snapshots():
+        alive = None
+        for name, metric in metrics.items():
+            if metric["kind"] == "gauge":
+                # The gauges of processes that have exited are stale.
+                alive = _alive(pid) if alive is None else alive
+                if not alive:
+                    continue
+
+            entry = merged.setdefault(name, {**metric, "samples": {}})
+            for suffix, labels, value in metric["samples"]:
+                if metric["kind"] == "gauge":
+                    labels = {**labels, "pid": str(pid)}
+                key = (suffix, tuple(labels.items()))
+                entry["samples"][key] = entry["samples"].get(key, 0) + value
+
+    lines = []
+    for name, metric in merged.items():
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        for (suffix, labels), value in metric["samples"].items():
+            label_str = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+            label_str = "{" + label_str + "}" if label_str else ""
+            lines.append(f"{name}{suffix}{label_str} {_format(value)}")
+    return "\n".join(lines) + "\n"
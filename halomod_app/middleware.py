@@ -0,0 +1,261 @@
+"""Middleware protecting the compute capacity of the site.
+
+All of it can run in a synchronous (WSGI) or an asynchronous (ASGI) stack, so
+that under ASGI no request holds a thread while it waits (see
+:mod:`~halomod_app.async_views`).
+"""
+import asyncio
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from . import scheduling, timing
+
+logger = logging.getLogger(__name__)
+
+
+class _SyncAndAsync:
+    """Base of middleware that follows the mode (sync or async) of the stack."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Mark ourselves as a coroutine function, as django's MiddlewareMixin does.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        return self.call(request)
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """WhiteNoise's middleware, which also runs in an async stack.
+
+    WhiteNoise's own is sync-only, and coming first, it would make every request
+    under ASGI hold a thread for its whole duration.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return await sync_to_async(self.serve)(static_file, request)
+        return await self.get_response(request)
+
+
+class TimingMiddleware(_SyncAndAsync):
+    """Time the phases of serving each request, and report them (see :mod:`.timing`).
+
+    Must come before the session middleware, so as to time saving the session.
+    """
+
+    def call(self, request):
+        timings, token = timing.start()
+        response = self.get_response(request)
+        timing.finish(request, response, timings, token)
+        return response
+
+    async def __acall__(self, request):
+        timings, token = timing.start()
+        response = await self.get_response(request)
+        timing.finish(request, response, timings, token)
+        return response
+
+
+class _ClosingContent:
+    """The content of a streaming response, calling ``finish`` once it's closed.
+
+    Servers close a response once it has been sent (or the client went away), which
+    for a streaming response is long after the view returned: the content is only
+    computed as it's sent.
+    """
+
+    def __init__(self, content, finish):
+        self._content = content
+        self._finish = finish
+
+    def __iter__(self):
+        return iter(self._content)
+
+    def close(self):
+        finish, self._finish = self._finish, None
+        try:
+            if hasattr(self._content, "close"):
+                self._content.close()
+        finally:
+            if finish is not None:
+                finish()
+
+
+def _after_sending(response, finish):
+    """Call ``finish`` once a response has been sent.
+
+    That's straight away, unless the response is streamed, when its content is only
+    computed as it's sent.
+    """
+    if response.streaming:
+        response.streaming_content = _ClosingContent(response.streaming_content, finish)
+    else:
+        finish()
+
+
+def _over_quota(retry_after: int) -> HttpResponse:
+    response = HttpResponse(
+        "You have used up your share of compute time for now. "
+        "Please try again later.",
+        content_type="text/plain",
+        status=429,
+    )
+    response["Retry-After"] = str(retry_after)
+    return response
+
+
+def _over_capacity(request, kind: str) -> HttpResponse:
+    logger.info(f"Over capacity: turning away {request.path}")
+    response = HttpResponse(
+        "The server is busy. Please try again shortly.",
+        content_type="text/plain",
+        status=503,
+    )
+    response["Retry-After"] = str(scheduling.retry_hint(kind))
+    return response
+
+
+class ComputeQuotaMiddleware(_SyncAndAsync):
+    """Charge compute-heavy requests to their clients, and schedule them fairly.
+
+    Requests from a client (session or IP) over its compute quota get a 429 response,
+    with a ``Retry-After`` header of the seconds until its quota is renewed. Others
+    wait for a compute slot in the worker's :class:`~.scheduling.FairQueue`, and are
+    charged the seconds they take once they have one. Streaming responses hold the
+    slot, and are charged, until they have been sent. See :mod:`.scheduling`.
+
+    Must come after the session middleware.
+    """
+
+    def call(self, request):
+        kind = scheduling.request_class(request)
+        if kind is None:
+            return self.get_response(request)
+
+        quotas = scheduling.clients(request)
+        retry_after = scheduling.retry_after(quotas)
+        if retry_after is not None:
+            return _over_quota(retry_after)
+
+        queue = scheduling.get_queue()
+        waited = queue.acquire(kind, quotas)
+        t0 = time.perf_counter()
+
+        def finish():
+            queue.release()
+            scheduling.charge(quotas, kind, time.perf_counter() - t0, waited)
+
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            finish()
+            raise
+        _after_sending(response, finish)
+        return response
+
+    async def __acall__(self, request):
+        kind = scheduling.request_class(request)
+        if kind is None:
+            return await self.get_response(request)
+
+        quotas = scheduling.clients(request)
+        retry_after = await sync_to_async(scheduling.retry_after)(quotas)
+        if retry_after is not None:
+            return _over_quota(retry_after)
+
+        queue = scheduling.get_queue()
+        waited = await queue.aacquire(kind, quotas)
+        t0 = time.perf_counter()
+
+        def finish():
+            queue.release()
+            scheduling.charge(quotas, kind, time.perf_counter() - t0, waited)
+
+        try:
+            response = await self.get_response(request)
+        except BaseException:
+            await sync_to_async(finish)()
+            raise
+        if response.streaming:
+            # Closed by the server, from a thread.
+            _after_sending(response, finish)
+        else:
+            await sync_to_async(finish)()
+        return response
+
+
+class AdmissionControlMiddleware(_SyncAndAsync):
+    """Turn away compute-heavy requests beyond the site's capacity.
+
+    At most ``ADMISSION_CAPACITY`` compute-heavy requests (see
+    :data:`~.scheduling.COMPUTE_VIEWS`) are in flight at once, over all the workers
+    sharing the cache. Beyond that, requests get an immediate 503 response, with a
+    ``Retry-After`` header of the typical duration of such a request, rather than
+    queueing without limit. The plot page retries images after that delay.
+    Streaming responses hold their lease until they have been sent.
+    """
+
+    def call(self, request):
+        kind = scheduling.request_class(request)
+        if kind is None:
+            return self.get_response(request)
+
+        lease = scheduling.admit(kind)
+        if lease is None:
+            return _over_capacity(request, kind)
+
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            scheduling.release(lease)
+            raise
+        _after_sending(response, lambda: scheduling.release(lease))
+        return response
+
+    async def __acall__(self, request):
+        kind = scheduling.request_class(request)
+        if kind is None:
+            return await self.get_response(request)
+
+        lease = await sync_to_async(scheduling.admit)(kind)
+        if lease is None:
+            return _over_capacity(request, kind)
+
+        try:
+            response = await self.get_response(request)
+        except BaseException:
+            await sync_to_async(scheduling.release)(lease)
+            raise
+        if response.streaming:
+            _after_sending(response, lambda: scheduling.release(lease))
+        else:
+            await sync_to_async(scheduling.release)(lease)
+        return response
@@ -0,0 +1,187 @@
+"""Profiling of the computation of each quantity, by the configuration of its model.
+
+Each time a quantity of a model is computed (ie. wasn't in the result cache, see
+:mod:`~halomod_app.results`), the seconds it took are recorded, along with the
+features of the model that most affect the cost (see :data:`FEATURES`): which
+transfer function, mass function, profile, exclusion model etc. it uses, and its
+grids in mass, wavenumber and radius. The records are kept in a SQLite database at
+``QUANTITY_PROFILE`` (shared by all the workers of a machine), of which only the
+last ``QUANTITY_PROFILE_ROWS`` are kept.
+
+Quantities of a model are computed lazily, and share intermediate results, so the
+time recorded for one is what it cost given what the model had already computed
+(eg. ``dndm`` costs less once ``power`` has been computed). The first quantity
+computed for a model includes the cost of its transfer function.
+
+Summarize the records with ``python manage.py profile_quantities``.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+# The parameters of a model that (may) affect the cost of computing its quantities.
+FEATURES = (
+    "transfer_model",
+    "hmf_model",
+    "bias_model",
+    "sd_bias_model",
+    "halo_profile_model",
+    "halo_concentration_model",
+    "exclusion_model",
+    "hod_model",
+    "hc_spectrum",
+    "wdm_model",
+    "z",
+    "Mmin",
+    "Mmax",
+    "dlog10m",
+    "lnk_min",
+    "lnk_max",
+    "dlnk",
+    "hm_dlog10k",
+    "rmin",
+    "rmax",
+    "rnum",
+    "dr_table",
+)
+
+# Old records are removed every this many new ones.
+_TRIM_EVERY = 100
+
+_local = threading.local()
+_writes = 0
+
+
+def _db() -> sqlite3.Connection:
+    # One connection per thread, and per process (as in the SQLite cache).
+    db = getattr(_local, "db", None)
+    if db is None or _local.pid != os.getpid():
+        path = Path(settings.QUANTITY_PROFILE)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS timings ("
+            "time REAL, quantity TEXT, framework TEXT, config TEXT, seconds REAL)"
+        )
+        _local.db = db
+        _local.pid = os.getpid()
+    return db
+
+
+def features(obj) -> dict:
+    """The features of a model's configuration that are recorded with its timings."""
+    out = {}
+    for name in FEATURES:
+        try:
+            val = getattr(obj, name)
+        except AttributeError:
+            continue
+        out[name] = utils._canonical(val)
+    return out
+
+
+def record(obj, quantity: str, seconds: float):
+    """Record the time it took to compute a quantity of a model."""
+    global _writes
+    if not settings.QUANTITY_PROFILE or obj is None:
+        return
+
+    try:
+        db = _db()
+        db.execute(
+            "INSERT INTO timings VALUES (?, ?, ?, ?, ?)",
+            (
+                time.time(),
+                quantity,
+                type(obj).__name__,
+                json.dumps(features(obj), sort_keys=True),
+                seconds,
+            ),
+        )
+
+        _writes += 1
+        if _writes % _TRIM_EVERY == 0:
+            db.execute(
+                "DELETE FROM timings WHERE rowid <= "
+                "(SELECT MAX(rowid) FROM timings) - ?",
+                (settings.QUANTITY_PROFILE_ROWS,),
+            )
+    except Exception:
+        # Profiling mustn't get in the way of computing.
+        logger.exception("Could not record the timing of a quantity.")
+
+
+def _percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def summarize(
+    by: str = "quantity", quantities=None, since: float = None, limit: int = 20
+) -> list:
+    """Summarize the recorded timings, slowest first.
+
+    Parameters
+    ----------
+    by
+        How to group the timings: by ``"quantity"``, by quantity and whole
+        ``"config"`` (the framework and its features), or by quantity and the value
+        of one of the :data:`FEATURES` (eg. ``"rnum"``).
+    quantities
+        Only summarize these quantities (by default, all of them).
+    since
+        Only summarize the timings recorded since this (Unix) time.
+    limit
+        The number of groups to return.
+
+    Returns
+    -------
+    list
+        For each group, a dict of the quantity, the value it is grouped by (if any),
+        the ``count`` of timings and their ``mean``, ``p90``, ``max`` and ``total``
+        seconds. Sorted by mean, slowest first.
+    """
+    if by not in ("quantity", "config") and by not in FEATURES:
+        raise ValueError(f"Can't group timings by {by}")
+
+    query = "SELECT quantity, framework, config, seconds FROM timings WHERE time >= ?"
+    args = [since or 0]
+    if quantities:
+        query += f" AND quantity IN ({', '.join('?' * len(quantities))})"
+        args += list(quantities)
+
+    groups = {}
+    for quantity, framework, config, seconds in _db().execute(query, args):
+        if by == "quantity":
+            key = (quantity, None)
+        elif by == "config":
+            key = (quantity, f"{framework} {config}")
+        else:
+            key = (quantity, json.dumps(json.loads(config).get(by)))
+        groups.setdefault(key, []).append(seconds)
+
+    out = [
+        {
+            "quantity": quantity,
+            **({} if by == "quantity" else {by: value}),
+            "count": len(times),
+            "mean": sum(times) / len(times),
+            "p90": _percentile(times, 90),
+            "max": max(times),
+            "total": sum(times),
+        }
+        for (quantity, value), times in groups.items()
+    ]
+    return sorted(out, key=lambda row: row["mean"], reverse=True)[:limit]
@@ -0,0 +1,273 @@
+"""Progress reporting of long computations, by stage.
+
+A plot can take tens of seconds to compute for a new model. When the client gives a
+job id with its request, the computation is split into its stages (the transfer
+function, the mass function, the HOD, the halo-model power spectra and their Hankel
+transforms to correlation functions), computing each in turn and recording the
+progress in the cache under that id. The client follows it through a stream of
+server-sent events (see :func:`events`), and the time spent in each stage is logged.
+"""
+import asyncio
+import json
+import logging
+import re
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+from . import circuit, metrics, profiling, results, timing, utils
+
+logger = logging.getLogger(__name__)
+
+# Each stage: its name, its description, and the quantity that computes it.
+STAGES = {
+    "transfer": ("Transfer function", "transfer_function"),
+    "mass_function": ("Mass variance and mass function", "dndm"),
+    "hod": ("Halo occupation", "total_occupation"),
+    "power": ("Power spectra", None),
+    "correlation": ("Hankel transforms to correlations", None),
+}
+
+# Quantities that only need the linear power spectrum.
+_LINEAR = {
+    "k",
+    "transfer_function",
+    "power",
+    "delta_k",
+    "nonlinear_power",
+    "nonlinear_delta_k",
+}
+
+# Seconds to wait for a job to start, before closing the stream.
+_START_WAIT = 5
+
+_JOB_ID = re.compile(r"^[0-9a-zA-Z_-]{8,64}$")
+
+
+def valid_job_id(job_id) -> bool:
+    """Whether a job id given by a client is acceptable."""
+    return isinstance(job_id, str) and bool(_JOB_ID.match(job_id))
+
+
+def stages_for(quantity: str) -> list:
+    """The stages needed to compute a quantity, in the order they're computed."""
+    if quantity == "corr_linear_mm":
+        return ["transfer", "correlation"]
+    if quantity in _LINEAR:
+        return ["transfer"]
+
+    stages = ["transfer", "mass_function"]
+    if "tracer" in quantity or quantity.endswith("occupation"):
+        stages.append("hod")
+    if quantity.startswith("power_"):
+        stages.append("power")
+    elif quantity.startswith("corr_"):
+        stages.append("correlation")
+    return stages
+
+
+def _key(job_id: str) -> str:
+    return f"thm-job:{job_id}"
+
+
+def get_state(job_id: str):
+    """The progress of a job, or None if it hasn't started."""
+    return cache.get(_key(job_id))
+
+
+class Job:
+    """The progress of computing one quantity for a set of models."""
+
+    def __init__(self, job_id: str, quantity: str, labels: list):
+        self.job_id = job_id
+        self.quantity = quantity
+        self.timings = {}
+        self.state = {
+            "quantity": quantity,
+            "steps": [
+                {
+                    "model": label,
+                    "stage": stage,
+                    "label": STAGES[stage][0],
+                    "status": "pending",
+                }
+                for label in labels
+                for stage in stages_for(quantity)
+            ],
+            "done": False,
+            "error": None,
+        }
+        self._current = None
+        self._t0 = time.perf_counter()
+        self._save()
+
+    def _save(self):
+        cache.set(_key(self.job_id), self.state, settings.PROGRESS_TIMEOUT)
+
+    def _finish_step(self):
+        if self._current is not None:
+            step, t0 = self._current
+            step["status"] = "done"
+            step["seconds"] = round(time.perf_counter() - t0, 3)
+            self.timings[f"{step['model']}:{step['stage']}"] = step["seconds"]
+            self._current = None
+
+    def start(self, label: str, stage: str):
+        """Mark the start of a stage of one of the models."""
+        self._finish_step()
+        for step in self.state["steps"]:
+            if step["model"] == label and step["stage"] == stage:
+                step["status"] = "running"
+                self._current = (step, time.perf_counter())
+        self._save()
+
+    def finish(self, error: str = None):
+        """Mark the job as finished, logging the time spent in each stage."""
+        self._finish_step()
+        self.state["done"] = True
+        self.state["error"] = error
+        self._save()
+        metrics.JOB_SECONDS.observe(
+            time.perf_counter() - self._t0, status="error" if error else "ok"
+        )
+        logger.info(
+            f"Stage timings for {self.quantity}: {json.dumps(self.timings)}",
+        )
+
+
+def compute(job: Job, objects: dict):
+    """Compute each stage of the job's quantity in turn, for each model.
+
+    Errors are not raised here: the quantity is computed again (from the cached
+    stages) afterwards, where the errors are handled as usual.
+    """
+    quantity = job.quantity
+    stages = stages_for(quantity)
+    for label, obj in objects.items():
+        try:
+            fingerprint = utils.model_fingerprint(obj)
+            seconds = {}
+            try:
+                with utils.compute_lock, circuit.guard(fingerprint), timing.timed(
+                    "compute"
+                ):
+                    for stage in stages[:-1]:
+                        job.start(label, stage)
+                        t0 = time.perf_counter()
+                        getattr(obj, STAGES[stage][1])
+                        seconds[STAGES[stage][1]] = time.perf_counter() - t0
+            finally:
+                # Recorded once the compute lock is released, as writing to the
+                # profile may wait for other workers.
+                for name, stage_seconds in seconds.items():
+                    profiling.record(obj, name, stage_seconds)
+
+            # Computing the quantity itself is shared with any concurrent requests
+            # for it (see results.single_flight).
+            job.start(label, stages[-1])
+            results.get_quantity(obj, quantity, fingerprint=fingerprint)
+        except Exception:
+            continue
+
+
+def _event(name: str, data) -> bytes:
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+class _Stream:
+    """The state of a stream of the progress of a job, polled every so often."""
+
+    def __init__(self):
+        self.last = None
+        self.t0 = self.sent = time.monotonic()
+
+    def poll(self, state) -> tuple:
+        """The events to send given the current state, and whether the stream ends."""
+        elapsed = time.monotonic() - self.t0
+
+        if state is None and elapsed > _START_WAIT:
+            return [], True
+        if elapsed > settings.PROGRESS_TIMEOUT:
+            metrics.TIMEOUTS.inc(what="progress")
+            return [_event("timeout", None)], True
+
+        if state != self.last:
+            self.last = state
+            self.sent = time.monotonic()
+            if state["done"]:
+                return [_event("progress", state), _event("done", state)], True
+            return [_event("progress", state)], False
+        elif time.monotonic() - self.sent > 15:
+            # Keep the connection from being closed as idle by proxies.
+            self.sent = time.monotonic()
+            return [b": keep-alive\n\n"], False
+        return [], False
+
+
+def events(job_id: str):
+    """Server-sent events of the progress of a job, until it's done.
+
+    The job may not have started yet when the stream is opened (the request that
+    runs it may arrive later). If it doesn't start within a few seconds, the stream
+    is closed and the client reconnects, so that a worker isn't held waiting for a
+    request that may be queued behind it.
+    """
+    yield b"retry: 1000\n\n"
+
+    stream = _Stream()
+    while True:
+        chunks, done = stream.poll(get_state(job_id))
+        yield from chunks
+        if done:
+            return
+        time.sleep(settings.PROGRESS_POLL_INTERVAL)
+
+
+async def aevents(job_id: str):
+    """The same events as :func:`events`, waiting without blocking the event loop."""
+    yield b"retry: 1000\n\n"
+
+    stream = _Stream()
+    while True:
+        chunks, done = stream.poll(await sync_to_async(get_state)(job_id))
+        for chunk in chunks:
+            yield chunk
+        if done:
+            return
+        await asyncio.sleep(settings.PROGRESS_POLL_INTERVAL)
+
+
+async def serve_events(job_id: str, receive, send):
+    """Stream the progress of a job as an ASGI response (see ``TheHaloMod/asgi.py``).
+
+    Django (before 4.2) iterates streaming responses synchronously in the event
+    loop, so under ASGI the stream is served here rather than by a view.
+    """
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                # Don't let nginx buffer the stream.
+                (b"x-accel-buffering", b"no"),
+            ],
+        }
+    )
+
+    async def disconnected():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    client = asyncio.ensure_future(disconnected())
+    try:
+        async for chunk in aevents(job_id):
+            if client.done():
+                return
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body"})
+    finally:
+        client.cancel()
@@ -0,0 +1,138 @@
+"""Rendering of plots, in a pool of long-lived renderer processes.
+
+Matplotlib isn't thread-safe, so plots can't be drawn in several threads of a web
+worker at once. Instead, the web worker gathers the lines to plot (see
+:func:`~halomod_app.utils.plot_lines`), and a renderer process draws them and sends
+back the bytes of the image. The web workers then only orchestrate, so they can be
+threaded, and the number of renderers (``RENDER_WORKERS``) can be set separately.
+
+With ``RENDER_WORKERS = 0``, plots are drawn in the web worker itself, one at a
+time. Async views (see :mod:`~halomod_app.async_views`) await plots with
+:func:`arender`.
+"""
+import asyncio
+import io
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib.ticker as tick
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import FigureCanvasPdf
+from matplotlib.backends.backend_svg import FigureCanvasSVG
+from matplotlib.figure import Figure
+
+from . import timing
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("png", "pdf", "svg")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Serializes drawing in this process, when it isn't done by the pool.
+_draw_lock = threading.Lock()
+
+
+def draw(lines: list, d: dict, plot_format: str = "png") -> bytes:
+    """Draw a plot, returning the bytes of the image.
+
+    Parameters
+    ----------
+    lines
+        The lines to plot, as dicts with keys ``x``, ``y``, ``label``, ``color`` and
+        ``linestyle``.
+    d
+        The axis settings of the quantity (an entry of
+        :data:`~halomod_app.utils.KEYMAP`).
+    plot_format
+        One of :data:`FORMATS`.
+    """
+    if plot_format not in FORMATS:
+        raise ValueError("plot_format should be png, pdf or svg!")
+
+    # TODO: make log scaling automatic
+    fig = Figure(figsize=(10, 6), edgecolor="white", facecolor="white", dpi=100)
+    ax = fig.add_subplot(111)
+    ax.grid(True)
+    ax.set_xlabel(d["xlab"], fontsize=15)
+    ax.set_ylabel(d["ylab"], fontsize=15)
+
+    for line in lines:
+        ax.plot(
+            line["x"],
+            line["y"],
+            color=line["color"],
+            linestyle=line["linestyle"],
+            label=line["label"],
+        )
+
+    try:
+        # Shrink current axis by 30%
+        ax.set_xscale("log")
+
+        ax.set_yscale(d["yscale"], base=d.get("basey", 10))
+        if d["yscale"] == "log" and d.get("basey", 10) == 2:
+            ax.yaxis.set_major_formatter(tick.ScalarFormatter())
+
+        box = ax.get_position()
+        ax.set_position([box.x0, box.y0, box.width * 0.6, box.height])
+
+        # Put a legend to the right of the current axis
+        ax.legend(loc="center left", bbox_to_anchor=(1, 0.5), fontsize=15)
+
+        buf = io.BytesIO()
+
+        if plot_format == "pdf":
+            FigureCanvasPdf(fig).print_pdf(buf)
+        elif plot_format == "png":
+            FigureCanvasAgg(fig).print_png(buf)
+        else:
+            FigureCanvasSVG(fig).print_svg(buf)
+    except Exception:
+        logger.info(f"y-axis data: { {line['label']: line['y'] for line in lines} }")
+        logger.exception("Something went wrong in creating the image itself")
+        raise
+
+    return buf.getvalue()
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """The renderer pool of this worker, creating it on first use."""
+    global _executor
+    with _executor_lock:
+        # A pool is broken for good if one of its processes dies.
+        if _executor is None or getattr(_executor, "_broken", False):
+            # Spawn rather than fork, since the web worker may be running threads.
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.RENDER_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+    return _executor
+
+
+def render(lines: list, d: dict, plot_format: str = "png") -> bytes:
+    """Draw a plot (see :func:`draw`) in the renderer pool."""
+    with timing.timed("render"):
+        if not settings.RENDER_WORKERS:
+            with _draw_lock:
+                return draw(lines, d, plot_format)
+
+        return get_executor().submit(draw, lines, d, plot_format).result()
+
+
+async def arender(lines: list, d: dict, plot_format: str = "png") -> bytes:
+    """Draw a plot like :func:`render`, waiting for it without blocking the loop."""
+    if not settings.RENDER_WORKERS:
+        return await sync_to_async(render, thread_sensitive=False)(
+            lines, d, plot_format
+        )
+
+    with timing.timed("render"):
+        return await asyncio.wrap_future(
+            get_executor().submit(draw, lines, d, plot_format)
+        )
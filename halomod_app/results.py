@@ -0,0 +1,301 @@
+"""Caching of computed model quantities, keyed by model fingerprint.
+
+Every quantity of a model (eg. ``dndm`` or ``power_auto_tracer``) is stored in the
+default cache under the fingerprint of the model's parameters, so it is only ever
+computed once, no matter how many plots or downloads ask for it. With
+``RESULT_STORE = "shm"``, the arrays themselves are kept in shared memory instead,
+and the cache only holds references to them (see :mod:`.shm_store`).
+
+Requests that ask for the same uncached quantity at the same time are coalesced
+(see :func:`single_flight`): one of them computes it, and the others wait for its
+result, rather than all computing it at once. Models that repeatedly crash or time
+out while being computed are refused for a while (see :mod:`.circuit`).
+"""
+import functools
+import logging
+import threading
+import time
+import uuid
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from . import circuit, metrics, profiling, shm_store, timing, utils
+
+logger = logging.getLogger(__name__)
+
+# Stored in place of quantities that a model defines as None, since the cache
+# itself returns None for missing keys.
+_NONE = "__none__"
+
+
+def _key(fingerprint: str, quantity: str) -> str:
+    return f"thm-result:{fingerprint}:{quantity}"
+
+
+def _index_key(fingerprint: str) -> str:
+    return f"thm-result:{fingerprint}"
+
+
+def cached_quantities(fingerprint: str) -> set:
+    """The quantities of the model with the given fingerprint that are cached."""
+    index = cache.get(_index_key(fingerprint)) or set()
+    return {q for q in index if cache.has_key(_key(fingerprint, q))}
+
+
+def get_cached(fingerprint: str, quantities) -> dict:
+    """The given quantities of a model that are already cached.
+
+    Returns
+    -------
+    dict
+        Mapping of each cached quantity to its array (or None if the model doesn't
+        define it). Quantities that aren't cached are left out.
+    """
+    keys = {_key(fingerprint, q): q for q in quantities}
+
+    out = {}
+    for k, v in cache.get_many(list(keys)).items():
+        if isinstance(v, shm_store.Ref):
+            v = shm_store.get(v)
+            if v is None:
+                # Evicted from shared memory.
+                continue
+        elif isinstance(v, str):
+            v = None
+        out[keys[k]] = v
+    return out
+
+
+def _as_array(val):
+    return None if val is None else np.asarray(val)
+
+
+def _lock_key(fingerprint: str, quantity: str) -> str:
+    return f"thm-lock:{fingerprint}:{quantity}"
+
+
+class _Flight:
+    """A computation in progress in this process, and its outcome."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+# The computations in progress in this process, by (fingerprint, quantity).
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _compute_shared(fingerprint: str, quantity: str, compute):
+    """Compute and cache a quantity, unless another worker already is.
+
+    The worker computing a quantity holds a lock on it in the cache, and the others
+    wait for its result to be cached. If it fails, the lock is released and another
+    worker takes over. A worker that waits for longer than ``COALESCE_TIMEOUT``
+    computes the quantity itself.
+
+    The lock holds a token of the worker that took it, so that a worker whose lock
+    expired (while it was still computing) doesn't release another's.
+    """
+    lock = _lock_key(fingerprint, quantity)
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + settings.COALESCE_TIMEOUT
+
+    while time.monotonic() < deadline:
+        if cache.add(lock, token, settings.COALESCE_TIMEOUT):
+            try:
+                # It may have been cached just before we took the lock.
+                cached = get_cached(fingerprint, [quantity])
+                if quantity in cached:
+                    return cached[quantity]
+
+                with utils.compute_lock, circuit.guard(fingerprint), timing.timed(
+                    "compute"
+                ):
+                    val = _as_array(compute())
+                store(fingerprint, {quantity: val})
+                return val
+            finally:
+                if cache.get(lock) == token:
+                    cache.delete(lock)
+
+        cached = get_cached(fingerprint, [quantity])
+        if quantity in cached:
+            return cached[quantity]
+        time.sleep(settings.COALESCE_POLL_INTERVAL)
+
+    logger.warning(f"Timed out waiting for {quantity} of model {fingerprint}")
+    metrics.TIMEOUTS.inc(what="coalesce")
+    with utils.compute_lock, circuit.guard(fingerprint), timing.timed("compute"):
+        val = _as_array(compute())
+    store(fingerprint, {quantity: val})
+    return val
+
+
+def single_flight(fingerprint: str, quantity: str, compute):
+    """Compute a quantity of a model once, however many requests ask for it at once.
+
+    Concurrent calls for the same quantity of the same model (by fingerprint) share a
+    single call of ``compute``: across threads of this process by waiting on the
+    thread that called it first, and across processes through a lock in the cache
+    (which only coalesces workers if the cache is shared between them).
+
+    Parameters
+    ----------
+    fingerprint
+        The fingerprint of the model.
+    quantity
+        The name of the quantity.
+    compute
+        A function of no arguments that computes the quantity.
+
+    Returns
+    -------
+    The quantity (an array, or None), which is also cached.
+
+    Raises
+    ------
+    ~halomod_app.circuit.CircuitOpen
+        If the model has repeatedly failed to compute (see :mod:`.circuit`).
+    """
+    circuit.check(fingerprint)
+
+    key = (fingerprint, quantity)
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    try:
+        flight.value = _compute_shared(fingerprint, quantity, compute)
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+    return flight.value
+
+
+def _timed(getter, quantity: str, seconds: dict):
+    """Compute a quantity with ``getter``, adding the time it takes to ``seconds``."""
+    t0 = time.perf_counter()
+    val = getter(quantity)
+    seconds[quantity] = time.perf_counter() - t0
+    return val
+
+
+def _get(fingerprint: str, quantities, getter, model) -> dict:
+    """Get quantities of a model from the cache, computing the rest with ``getter``.
+
+    ``model`` is a function returning the model (once the getter has built it).
+    """
+    out = get_cached(fingerprint, quantities)
+    metrics.CACHE_LOOKUPS.inc(len(out), cache="result", result="hit")
+    metrics.CACHE_LOOKUPS.inc(len(quantities) - len(out), cache="result", result="miss")
+    seconds = {}
+    for q in quantities:
+        if q not in out:
+            out[q] = single_flight(
+                fingerprint, q, functools.partial(_timed, getter, q, seconds)
+            )
+            # Recorded here, rather than while computing, so as not to hold the
+            # compute lock while writing to the profile.
+            if q in seconds:
+                profiling.record(model(), q, seconds[q])
+    return {q: out[q] for q in quantities}
+
+
+def get_quantities(obj, quantities, fingerprint: str = None) -> dict:
+    """Get quantities of a model, computing only those that are not yet cached.
+
+    Parameters
+    ----------
+    obj
+        The halo model instance.
+    quantities
+        Names of the attributes of ``obj`` to get.
+    fingerprint
+        The fingerprint of ``obj``, if already known.
+
+    Returns
+    -------
+    dict
+        Mapping of each quantity to its array (or None if the model doesn't
+        define it).
+    """
+    fingerprint = fingerprint or utils.model_fingerprint(obj)
+    return _get(fingerprint, quantities, lambda q: getattr(obj, q), lambda: obj)
+
+
+def store(fingerprint: str, quantities: dict):
+    """Cache computed quantities (arrays, or None) of the model with a fingerprint."""
+    logger.debug(f"Caching {len(quantities)} new quantities for model {fingerprint}")
+    values = {q: _NONE if val is None else val for q, val in quantities.items()}
+
+    # Arrays can be kept in shared memory, with only a reference to them in the cache.
+    if settings.RESULT_STORE == "shm":
+        arrays = {q: val for q, val in quantities.items() if shm_store.can_store(val)}
+        if arrays:
+            try:
+                values.update(shm_store.put(arrays))
+            except shm_store.RegistryBusy:
+                # Keep them in the cache itself instead.
+                logger.warning(f"Could not store the results of {fingerprint} in shm")
+                metrics.TIMEOUTS.inc(what="shm-registry")
+
+    cache.set_many(
+        {_key(fingerprint, q): val for q, val in values.items()},
+        settings.RESULT_CACHE_TIMEOUT,
+    )
+
+    # Keep an index of what's cached for each model, so it can be looked up
+    # without fetching the arrays themselves.
+    index = cache.get(_index_key(fingerprint)) or set()
+    cache.set(
+        _index_key(fingerprint),
+        index | set(quantities),
+        settings.RESULT_CACHE_TIMEOUT,
+    )
+
+
+def get_framework_quantities(cls, params: dict, quantities) -> tuple:
+    """Get quantities of the framework ``cls(**params)``.
+
+    The framework is only built if some of the quantities are not yet cached.
+
+    Returns
+    -------
+    fingerprint : str
+        The fingerprint of the framework.
+    quantities : dict
+        Mapping of each quantity to its array (or None).
+    """
+    fingerprint = utils.framework_fingerprint(cls, params)
+    obj = None
+
+    def getter(q):
+        nonlocal obj
+        if obj is None:
+            obj = utils.hmf_driver(cls=cls, **params)
+        return getattr(obj, q)
+
+    return fingerprint, _get(fingerprint, quantities, getter, lambda: obj)
+
+
+def get_quantity(obj, quantity: str, fingerprint: str = None):
+    """Get a single quantity of a model, using the cache if possible."""
+    return get_quantities(obj, [quantity], fingerprint=fingerprint)[quantity]
@@ -0,0 +1,318 @@
+"""Accounting of compute time per client, and fair scheduling of compute requests.
+
+Compute-heavy requests (see :data:`COMPUTE_VIEWS`) are charged the seconds they
+take, both to the session and to the IP address they come from, over fixed windows
+of ``QUOTA_WINDOW`` seconds. The totals are kept in the default cache, so they are
+shared between web workers if the cache is. A client that has used up its quota
+gets a 429 response until the window ends (see
+:class:`~halomod_app.middleware.ComputeQuotaMiddleware`).
+
+Before any of that, at most ``ADMISSION_CAPACITY`` compute requests are admitted
+at once (over all the workers sharing the cache), each holding one of that many
+leases in the cache (see :func:`admit`). Beyond that, requests are turned away
+straight away with a 503, rather than piling up until the proxy times out.
+
+Within a web worker, at most ``COMPUTE_SLOTS`` compute requests run at once, and
+the rest wait in a :class:`FairQueue`. Interactive requests (plots, creating
+models) are served before bulk ones (downloads, the API), and clients that have
+used less compute are served before those that have used more.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.urls import Resolver404, resolve
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+# The relative share of compute of each class of request: a request waits in the
+# queue for (roughly) the compute seconds its client has used, divided by this.
+WEIGHTS = {INTERACTIVE: 4.0, BULK: 1.0}
+
+# The compute-heavy views, by URL name: their class, and whether only POSTs to them
+# are compute-heavy.
+COMPUTE_VIEWS = {
+    "images": (INTERACTIVE, False),
+    "calculate": (INTERACTIVE, True),
+    "import": (BULK, True),
+    "data-output": (BULK, False),
+    "data-output-npz": (BULK, False),
+    "data-output-parquet": (BULK, False),
+    "halogen-output": (BULK, False),
+    "api-compute": (BULK, True),
+    "api-batch": (BULK, True),
+}
+
+# Totals for this process, by class (or by client kind, for throttled requests).
+STATS = {
+    "requests": defaultdict(int),
+    "seconds": defaultdict(float),
+    "wait_seconds": defaultdict(float),
+    "throttled": defaultdict(int),
+    "rejected": defaultdict(int),
+}
+_stats_lock = threading.Lock()
+
+
+def request_class(request):
+    """The class of a compute-heavy request, or None if it isn't one."""
+    try:
+        match = resolve(request.path_info)
+    except Resolver404:
+        return None
+
+    kind, post_only = COMPUTE_VIEWS.get(match.url_name, (None, False))
+    if post_only and request.method != "POST":
+        return None
+    return kind
+
+
+def client_ip(request) -> str:
+    """The IP address of the client, as forwarded by the proxy in front of us.
+
+    The proxy appends the address it was connected from to any ``X-Forwarded-For``
+    the client sent, so only the last entry can be trusted: the others are whatever
+    the client chose to send.
+    """
+    forwarded = request.META.get("HTTP_X_FORWARDED_FOR", "")
+    if forwarded:
+        return forwarded.split(",")[-1].strip()
+    return request.META.get("REMOTE_ADDR", "")
+
+
+def clients(request) -> dict:
+    """The identities that a request is charged to, with the quota of each."""
+    out = {f"ip:{client_ip(request)}": settings.QUOTA_IP_SECONDS}
+    session = getattr(request, "session", None)
+    if session is not None and session.session_key:
+        out[f"session:{session.session_key}"] = settings.QUOTA_SESSION_SECONDS
+    return out
+
+
+def _window() -> tuple:
+    """The index of the current accounting window, and the seconds until it ends."""
+    now = time.time()
+    return int(now // settings.QUOTA_WINDOW), settings.QUOTA_WINDOW - now % (
+        settings.QUOTA_WINDOW
+    )
+
+
+def _usage_key(client: str, window: int) -> str:
+    return f"thm-quota:{client}:{window}"
+
+
+def usage(client: str) -> float:
+    """The compute seconds used by a client in the current window."""
+    window, _ = _window()
+    return cache.get(_usage_key(client, window), 0) / 1000
+
+
+def retry_after(quotas: dict):
+    """Seconds until a client over its quota may try again, or None if none is."""
+    window, remaining = _window()
+    used = cache.get_many([_usage_key(c, window) for c in quotas])
+    for client, quota in quotas.items():
+        if used.get(_usage_key(client, window), 0) / 1000 >= quota:
+            with _stats_lock:
+                STATS["throttled"][client.split(":")[0]] += 1
+            logger.info(f"Client {client} is over its compute quota.")
+            return int(remaining) + 1
+    return None
+
+
+def charge(quotas: dict, kind: str, seconds: float, waited: float = 0):
+    """Charge the compute seconds of a request to each of its clients."""
+    window, _ = _window()
+    for client in quotas:
+        key = _usage_key(client, window)
+        # Kept in milliseconds, so the total can be incremented atomically.
+        cache.add(key, 0, settings.QUOTA_WINDOW)
+        try:
+            cache.incr(key, int(1000 * seconds))
+        except ValueError:
+            # The window ended, and the key expired, in between.
+            pass
+
+    with _stats_lock:
+        STATS["requests"][kind] += 1
+        STATS["seconds"][kind] += seconds
+        STATS["wait_seconds"][kind] += waited
+    metrics.COMPUTE_SECONDS.observe(seconds, kind=kind)
+    metrics.COMPUTE_WAIT_SECONDS.observe(waited, kind=kind)
+
+
+def _lease_key(slot: int) -> str:
+    return f"thm-admission:{slot}"
+
+
+def admit(kind: str):
+    """Take one of the ``ADMISSION_CAPACITY`` leases on compute, if one is free.
+
+    Leases expire after ``ADMISSION_TIMEOUT`` seconds, in case a worker dies while
+    holding one. Each holds a token of the request that took it, so that a request
+    that outlives its lease doesn't give back the lease of another.
+
+    Returns
+    -------
+    The key of the lease taken and its token (to give to :func:`release`), or None
+    if all are taken.
+    """
+    capacity = settings.ADMISSION_CAPACITY
+    token = uuid.uuid4().hex
+    # Start at a random slot, so concurrent requests don't all contend for the first.
+    start = random.randrange(capacity)
+    for i in range(capacity):
+        key = _lease_key((start + i) % capacity)
+        if cache.add(key, token, settings.ADMISSION_TIMEOUT):
+            return key, token
+
+    with _stats_lock:
+        STATS["rejected"][kind] += 1
+    return None
+
+
+def release(lease: tuple):
+    """Give back a lease taken with :func:`admit`, unless it has expired.
+
+    Checking the token and deleting the lease isn't atomic: if the lease expires,
+    and another request takes it, in between the two, the other request's lease is
+    given back instead, and one request too many may be admitted until that one
+    ends. That needs a request to take the whole ``ADMISSION_TIMEOUT``, so it's
+    rare, and the cache has no atomic compare-and-delete to avoid it.
+    """
+    key, token = lease
+    if cache.get(key) == token:
+        cache.delete(key)
+
+
+def retry_hint(kind: str) -> int:
+    """Seconds a client turned away should wait: the mean duration of its class."""
+    with _stats_lock:
+        n = STATS["requests"].get(kind, 0)
+        seconds = STATS["seconds"].get(kind, 0)
+    if not n:
+        return settings.ADMISSION_RETRY_AFTER
+    return max(1, round(seconds / n))
+
+
+def stats() -> dict:
+    """A copy of the totals of this process."""
+    with _stats_lock:
+        return {name: dict(values) for name, values in STATS.items()}
+
+
+class FairQueue:
+    """A queue of requests for a limited number of compute slots.
+
+    Each request is given a deadline: its arrival time, plus the compute seconds its
+    clients have used (plus one) divided by the weight of its class. The waiting
+    request with the earliest deadline is served first. So interactive requests
+    overtake bulk ones, light clients overtake heavy ones, and every request is
+    served eventually.
+    """
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self._busy = 0
+        self._waiting = []
+        self._count = itertools.count()
+        self._cond = threading.Condition()
+        # Events waking up the requests waiting in event loops (see aacquire).
+        self._wakeups = []
+
+    def _ticket(self, kind: str, quotas: dict) -> tuple:
+        used = max((usage(client) for client in quotas), default=0)
+        return (time.monotonic() + (used + 1) / WEIGHTS[kind], next(self._count))
+
+    def _take(self, ticket: tuple) -> bool:
+        """Take a slot for a waiting ticket, if it's its turn. Needs the lock."""
+        if self._busy >= self.slots or self._waiting[0] != ticket:
+            return False
+        heapq.heappop(self._waiting)
+        self._busy += 1
+        return True
+
+    def _wake_all(self):
+        """Wake up the waiting requests to check their turn. Needs the lock."""
+        self._cond.notify_all()
+        for loop, wake in self._wakeups:
+            loop.call_soon_threadsafe(wake.set)
+        self._wakeups.clear()
+
+    def load(self) -> tuple:
+        """The number of requests waiting for a slot, and holding one."""
+        with self._cond:
+            return len(self._waiting), self._busy
+
+    def acquire(self, kind: str, quotas: dict) -> float:
+        """Wait for a compute slot, returning the seconds spent waiting.
+
+        The slot must be given back with :meth:`release`.
+        """
+        ticket = self._ticket(kind, quotas)
+
+        t0 = time.perf_counter()
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            while not self._take(ticket):
+                self._cond.wait()
+        return time.perf_counter() - t0
+
+    async def aacquire(self, kind: str, quotas: dict) -> float:
+        """Like :meth:`acquire`, but waiting without blocking the event loop."""
+        ticket = await sync_to_async(self._ticket)(kind, quotas)
+        loop = asyncio.get_running_loop()
+
+        t0 = time.perf_counter()
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+        try:
+            while True:
+                wake = asyncio.Event()
+                with self._cond:
+                    if self._take(ticket):
+                        break
+                    self._wakeups.append((loop, wake))
+                await wake.wait()
+        except BaseException:
+            # Cancelled while waiting (eg. the client went away).
+            with self._cond:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                self._wake_all()
+            raise
+        return time.perf_counter() - t0
+
+    def release(self):
+        """Give back a slot taken with :meth:`acquire` or :meth:`aacquire`."""
+        with self._cond:
+            self._busy -= 1
+            self._wake_all()
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue() -> FairQueue:
+    """The queue of this worker, creating it on first use."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = FairQueue(settings.COMPUTE_SLOTS)
+    return _queue
@@ -0,0 +1,96 @@
+"""A machine-readable description of the input form, for validating it in the browser.
+
+The schema is generated from the form classes themselves (their fields, bounds and
+choices, the parameters of each model, and the cross-field rules of
+:class:`~halomod_app.forms.FrameworkInput`), so it can't get out of sync with the
+validation done on the server.
+"""
+from functools import lru_cache
+
+from django import forms as django_forms
+
+from . import forms
+from .form_utils import FloatListField, RangeSliderField
+
+
+def _field_type(field) -> str:
+    # Order matters, since eg. FloatField is an IntegerField, and MultipleChoiceField
+    # is a ChoiceField.
+    for cls, name in [
+        (RangeSliderField, "range"),
+        (FloatListField, "floatlist"),
+        (django_forms.BooleanField, "bool"),
+        (django_forms.FloatField, "float"),
+        (django_forms.IntegerField, "int"),
+        (django_forms.MultipleChoiceField, "multichoice"),
+        (django_forms.ChoiceField, "choice"),
+        (django_forms.FileField, "file"),
+    ]:
+        if isinstance(field, cls):
+            return name
+    return "text"
+
+
+def field_schema(name: str, field) -> dict:
+    """The schema of a single form field."""
+    kind = _field_type(field)
+    out = {
+        "name": name,
+        "type": kind,
+        "label": str(field.label or name),
+        "required": field.required,
+    }
+
+    if kind == "range":
+        out["min"] = float(field.minimum)
+        out["max"] = float(field.maximum)
+        out["step"] = float(field.step)
+    elif kind == "floatlist":
+        out["min"] = field.min_val
+        out["max"] = field.max_val
+    elif kind in ("int", "float"):
+        out["min"] = field.min_value
+        out["max"] = field.max_value
+    elif kind in ("choice", "multichoice"):
+        out["choices"] = [str(value) for value, _ in field.choices]
+
+    if hasattr(field, "component"):
+        out["component"] = field.component
+    if hasattr(field, "model"):
+        out["model"] = field.model
+
+    return out
+
+
+@lru_cache
+def form_schema() -> dict:
+    """The schema of :class:`~halomod_app.forms.FrameworkInput`.
+
+    Returns
+    -------
+    dict
+        With keys ``fields`` (the schema of each field, in order), ``models`` (for
+        each component, the fields that are parameters of each of its models -- only
+        those of the chosen model are used), and ``rules`` (the cross-field rules).
+    """
+    form = forms.FrameworkInput()
+
+    models = {}
+    for name, field in form.fields.items():
+        if hasattr(field, "model"):
+            component = models.setdefault(field.component, {})
+            component.setdefault(field.model, []).append(name)
+
+    return {
+        "fields": [field_schema(name, field) for name, field in form.fields.items()],
+        "models": models,
+        "rules": [
+            {
+                "type": "step_in_range",
+                "step": step,
+                "range": range_field,
+                "message": message,
+            }
+            for step, range_field, message in forms.FrameworkInput.step_rules
+        ],
+    }
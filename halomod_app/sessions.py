@@ -0,0 +1,81 @@
+"""The session engine of the site: sessions in the cache, with their load timed.
+
+Sessions hold whole pickled models, so loading and saving them is a large part of
+the time spent on many requests. This stores them in the cache already serialized
+(by ``SESSION_SERIALIZER``, ie. :class:`DillSerializer`), rather than leaving the
+cache to pickle them, so that fetching and unpickling them can be timed separately
+(see :mod:`~halomod_app.timing`).
+"""
+import logging
+
+import dill
+from django.contrib.sessions.backends import cache
+from django.contrib.sessions.backends.base import CreateError, UpdateError
+
+from . import metrics, timing
+
+logger = logging.getLogger(__name__)
+
+
+class DillSerializer:
+    """Serialize sessions with dill.
+
+    Models hold lambdas and locally-defined classes (eg. in their tracer
+    quantities), which plain pickle can't serialize.
+    """
+
+    def dumps(self, obj) -> bytes:
+        return dill.dumps(obj, protocol=dill.HIGHEST_PROTOCOL)
+
+    def loads(self, data: bytes):
+        return dill.loads(data)
+
+
+class SessionStore(cache.SessionStore):
+    """A cache-based session store, keeping sessions serialized."""
+
+    def load(self):
+        try:
+            with timing.timed("session-fetch"):
+                session_data = self._cache.get(self.cache_key)
+        except Exception:
+            # Some backends (e.g. memcache) raise an exception on invalid
+            # cache keys. If this happens, reset the session. See #17810.
+            session_data = None
+
+        metrics.CACHE_LOOKUPS.inc(
+            cache="session", result="miss" if session_data is None else "hit"
+        )
+        if isinstance(session_data, bytes):
+            metrics.SESSION_BYTES.observe(len(session_data), operation="load")
+            try:
+                with timing.timed("session-unpickle"):
+                    return self.serializer().loads(session_data)
+            except Exception:
+                logger.exception("Could not load a session, so it is reset.")
+        elif session_data is not None:
+            # Stored by the cache backend itself, before this engine was used.
+            return session_data
+
+        self._session_key = None
+        return {}
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        if must_create:
+            func = self._cache.add
+        elif self.cache_key in self._cache:
+            func = self._cache.set
+        else:
+            raise UpdateError
+
+        with timing.timed("session-pickle"):
+            session_data = self.serializer().dumps(
+                self._get_session(no_load=must_create)
+            )
+        metrics.SESSION_BYTES.observe(len(session_data), operation="save")
+        with timing.timed("session-store"):
+            result = func(self.cache_key, session_data, self.get_expiry_age())
+        if must_create and not result:
+            raise CreateError
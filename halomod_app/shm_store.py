@@ -0,0 +1,291 @@
+"""A store of computed arrays in shared memory, shared by all the worker processes.
+
+With ``RESULT_STORE = "shm"``, the arrays of the result cache (see
+:mod:`~halomod_app.results`) are written once into a
+:class:`multiprocessing.shared_memory.SharedMemory` segment, and the cache itself
+only holds a small :class:`Ref` to each: its segment, byte offset, shape and dtype.
+Reading a quantity then maps the segment (once per process) and wraps it as a
+read-only numpy view, with no copy or deserialization.
+
+Segments are listed in a registry in the cache, with their size and age. When a
+new segment is stored, the oldest ones are evicted, so that they total no more than
+``SHM_STORE_BYTES``, and none are older than ``RESULT_CACHE_TIMEOUT``. The
+processes that have a segment mapped are counted (a process keeps it mapped while
+any view of it is alive), and an evicted segment is only unlinked (its memory
+reclaimed) once none have -- or, in case a process died without letting go of it,
+after another ``RESULT_CACHE_TIMEOUT``.
+
+This only shares arrays between processes if the cache is shared between them too
+(eg. :class:`~halomod_app.sqlite_cache.SQLiteCache`).
+"""
+import logging
+import sys
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+Ref = namedtuple("Ref", ["segment", "offset", "shape", "dtype"])
+Ref.__doc__ = "The location of an array in the store."
+
+# Arrays are aligned to this many bytes in their segment.
+_ALIGN = 64
+
+# Maximum number of segments a process keeps mapped at once.
+_MAX_ATTACHED = 256
+
+_REGISTRY = "thm-shm:segments"
+_REGISTRY_LOCK = "thm-shm:lock"
+
+# How long (in seconds) to wait for the lock on the registry. The lock expires after
+# as long, in case its holder died.
+_LOCK_TIMEOUT = 10
+
+# The segments mapped by this process, by name, least recently used first.
+_attached = OrderedDict()
+_local_lock = threading.Lock()
+
+
+class RegistryBusy(TimeoutError):
+    """Raised if the registry of segments couldn't be locked in time."""
+
+
+def _refs_key(name: str) -> str:
+    return f"thm-shm-refs:{name}"
+
+
+def _open(name: str = None, size: int = 0) -> shared_memory.SharedMemory:
+    """Create (if no name is given) or attach to a segment, without tracking it.
+
+    Segments outlive the process that created or attached them, so the resource
+    tracker mustn't unlink them when the process exits.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(
+            name=name, create=name is None, size=size, track=False
+        )
+
+    shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def _unlink(name: str):
+    try:
+        shm = _open(name)
+    except FileNotFoundError:
+        return
+
+    if sys.version_info < (3, 13):
+        # unlink() unregisters it from the tracker, so it must be registered first.
+        resource_tracker.register(shm._name, "shared_memory")
+    shm.unlink()
+    shm.close()
+    logger.debug(f"Unlinked shared memory segment {name}")
+
+
+@contextmanager
+def _locked_registry():
+    """The registry of segments, locked (across processes) for modification.
+
+    The lock holds a token of its holder, so that a holder whose lock expired
+    doesn't release another's.
+
+    Raises
+    ------
+    RegistryBusy
+        If the lock couldn't be taken within ``_LOCK_TIMEOUT`` seconds.
+    """
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + _LOCK_TIMEOUT
+    while not cache.add(_REGISTRY_LOCK, token, _LOCK_TIMEOUT):
+        if time.monotonic() > deadline:
+            raise RegistryBusy("Timed out waiting for the lock on the registry.")
+        time.sleep(0.005)
+
+    try:
+        registry = cache.get(_REGISTRY) or {}
+        yield registry
+        cache.set(_REGISTRY, registry, None)
+    finally:
+        if cache.get(_REGISTRY_LOCK) == token:
+            cache.delete(_REGISTRY_LOCK)
+
+
+def _add_ref(name: str, delta: int) -> int:
+    """Change the count of processes that have a segment mapped."""
+    key = _refs_key(name)
+    cache.add(key, 0, None)
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        return 0
+
+
+def _unmapped(name: str):
+    """Called once a segment is unmapped from this process."""
+    if _add_ref(name, -1) <= 0:
+        info = (cache.get(_REGISTRY) or {}).get(name)
+        if info is None or info["evicted"]:
+            _unlink(name)
+            cache.delete(_refs_key(name))
+
+
+def _map(shm) -> shared_memory.SharedMemory:
+    """Count a segment as mapped in this process, until it is garbage-collected.
+
+    Views of the segment keep it alive (see :class:`_View`), so it is only unmapped
+    once this process no longer holds any, and doesn't need it any more.
+    """
+    _add_ref(shm.name, 1)
+    weakref.finalize(shm, _unmapped, shm.name)
+    with _local_lock:
+        _attached[shm.name] = shm
+        while len(_attached) > _MAX_ATTACHED:
+            _attached.popitem(last=False)
+    return shm
+
+
+def _tidy(registry: dict):
+    """Let go of the evicted segments in this process."""
+    with _local_lock:
+        for name in list(_attached):
+            if registry.get(name, {"evicted": True})["evicted"]:
+                del _attached[name]
+
+
+def _evict(registry: dict):
+    """Evict the oldest segments beyond the size and age limits, and unlink them."""
+    now = time.time()
+    live = sorted(
+        (info["created"], name)
+        for name, info in registry.items()
+        if not info["evicted"]
+    )
+    total = sum(registry[name]["size"] for _, name in live)
+    for created, name in live:
+        if (
+            total <= settings.SHM_STORE_BYTES
+            and now - created < settings.RESULT_CACHE_TIMEOUT
+        ):
+            break
+        registry[name].update(evicted=True, evicted_at=now)
+        total -= registry[name]["size"]
+
+    for name, info in list(registry.items()):
+        if not info["evicted"]:
+            continue
+
+        stale = now - info["evicted_at"] > settings.RESULT_CACHE_TIMEOUT
+        if stale or (cache.get(_refs_key(name)) or 0) <= 0:
+            _unlink(name)
+            cache.delete(_refs_key(name))
+            del registry[name]
+
+
+def can_store(value) -> bool:
+    """Whether a value can be kept in shared memory (ie. is a plain numeric array)."""
+    return isinstance(value, np.ndarray) and not value.dtype.hasobject
+
+
+def put(arrays: dict) -> dict:
+    """Write arrays into a new segment.
+
+    Parameters
+    ----------
+    arrays
+        Mapping of names to arrays (for which :func:`can_store` is True).
+
+    Returns
+    -------
+    dict
+        Mapping of the same names to the :class:`Ref` of each array.
+
+    Raises
+    ------
+    RegistryBusy
+        If the segment couldn't be registered (and so wasn't stored).
+    """
+    refs = {}
+    offset = 0
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        refs[name] = Ref(None, offset, arr.shape, arr.dtype.str)
+        offset += -(-arr.nbytes // _ALIGN) * _ALIGN
+
+    shm = _open(size=max(offset, 1))
+    view = None
+    for name, arr in arrays.items():
+        ref = refs[name] = refs[name]._replace(segment=shm.name)
+        view = np.ndarray(ref.shape, ref.dtype, buffer=shm.buf, offset=ref.offset)
+        view[...] = arr
+    del view
+
+    _map(shm)
+    try:
+        with _locked_registry() as registry:
+            registry[shm.name] = {
+                "size": shm.size,
+                "created": time.time(),
+                "evicted": False,
+            }
+            _evict(registry)
+    except RegistryBusy:
+        # It isn't registered, so it's unlinked once unmapped (see _unmapped).
+        with _local_lock:
+            _attached.pop(shm.name, None)
+        raise
+    _tidy(registry)
+
+    return refs
+
+
+def _attach(name: str):
+    """The segment, mapped in this process, or None if it has been evicted."""
+    with _local_lock:
+        shm = _attached.get(name)
+        if shm is not None:
+            _attached.move_to_end(name)
+            return shm
+
+    info = (cache.get(_REGISTRY) or {}).get(name)
+    if info is None or info["evicted"]:
+        return None
+
+    try:
+        return _map(_open(name))
+    except FileNotFoundError:
+        return None
+
+
+class _View:
+    """An array in a segment, which keeps the segment mapped while it is used.
+
+    Arrays made straight from the segment's buffer don't keep it mapped: it would be
+    unmapped under them once the segment is garbage-collected.
+    """
+
+    def __init__(self, shm, ref: Ref):
+        self._shm = shm
+        arr = np.ndarray(ref.shape, ref.dtype, buffer=shm.buf, offset=ref.offset)
+        self.__array_interface__ = {
+            **arr.__array_interface__,
+            "data": (arr.__array_interface__["data"][0], True),
+        }
+
+
+def get(ref: Ref):
+    """A read-only view of a stored array, or None if it has been evicted."""
+    shm = _attach(ref.segment)
+    if shm is None:
+        return None
+    return np.asarray(_View(shm, ref))
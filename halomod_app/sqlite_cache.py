@@ -0,0 +1,296 @@
+"""A cache backend shared between the web workers of a machine, without a server.
+
+Entries are stored in a SQLite database in WAL mode (so that readers never block,
+and don't block the writer), which every worker process opens. Each process also
+keeps the most recently used entries in memory, along with the version they were
+stored with, so that a hit only has to check the version in the database rather
+than read (possibly large, eg. sessions) values from it.
+
+Use it with eg.::
+
+    CACHES = {
+        "default": {
+            "BACKEND": "halomod_app.sqlite_cache.SQLiteCache",
+            "LOCATION": "/path/to/cache.sqlite3",
+            "OPTIONS": {"MAX_ENTRIES": 1000, "FRONT_BYTES": 64 * 2**20},
+        }
+    }
+"""
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import dill
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+# Expiry time of entries that never expire.
+_NEVER = float("inf")
+
+
+class _Front:
+    """An LRU of serialized values (with their versions), bounded in total size."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, version: int):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: str, version: int, value: bytes):
+        if len(value) > self.max_bytes:
+            self.pop(key)
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old[1])
+
+            self._entries[key] = (version, value)
+            self.nbytes += len(value)
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= len(evicted)
+
+    def peek(self, key: str):
+        """The (version, value) of a key, if kept, without counting it as a use."""
+        with self._lock:
+            return self._entries.get(key)
+
+    def pop(self, key: str):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+class SQLiteCache(BaseCache):
+    """A cache in a SQLite database, with an in-memory LRU in front of it.
+
+    Options (besides those of every backend, eg. ``MAX_ENTRIES``):
+
+    FRONT_BYTES
+        The maximum total size of the serialized values kept in memory by each
+        process (default 64 MiB).
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self.path = Path(location)
+        options = params.get("OPTIONS", {})
+        self._front = _Front(int(options.get("FRONT_BYTES", 64 * 2**20)))
+        self._local = threading.local()
+        self._writes = 0
+
+    # ----- Connection --------------------------------------------------------------
+    @property
+    def _db(self) -> sqlite3.Connection:
+        # One connection per thread, and per process (workers may be forked after a
+        # connection was opened).
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value BLOB, expires REAL, version INTEGER)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    # ----- Helpers -----------------------------------------------------------------
+    def _key(self, key, version) -> str:
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def _expiry(self, timeout) -> float:
+        expires = self.get_backend_timeout(timeout)
+        return _NEVER if expires is None else expires
+
+    def _load(self, key: str, now: float):
+        """The serialized value of a (full) key, or None if it isn't cached."""
+        row = self._db.execute(
+            "SELECT version FROM cache WHERE key = ? AND expires > ?", (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+
+        value = self._front.get(key, row[0])
+        if value is None:
+            row = self._db.execute(
+                "SELECT version, value FROM cache WHERE key = ? AND expires > ?",
+                (key, now),
+            ).fetchone()
+            if row is None:
+                return None
+            value = bytes(row[1])
+            self._front.put(key, row[0], value)
+        return value
+
+    def _store(self, key: str, value, timeout, only_if_missing: bool = False) -> bool:
+        data = dill.dumps(value, dill.HIGHEST_PROTOCOL)
+        version = random.getrandbits(63)
+        now = time.time()
+
+        if only_if_missing:
+            # Atomically insert, or replace an expired entry.
+            cursor = self._db.execute(
+                "INSERT INTO cache (key, value, expires, version) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, "
+                "expires = excluded.expires, version = excluded.version "
+                "WHERE cache.expires <= ?",
+                (key, data, self._expiry(timeout), version, now),
+            )
+            if cursor.rowcount != 1:
+                return False
+        else:
+            # Sessions are saved on every request, mostly unchanged: then only the
+            # expiry needs updating.
+            kept = self._front.peek(key)
+            if kept is not None and kept[1] == data:
+                cursor = self._db.execute(
+                    "UPDATE cache SET expires = ? WHERE key = ? AND version = ?",
+                    (self._expiry(timeout), key, kept[0]),
+                )
+                if cursor.rowcount == 1:
+                    return True
+
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires, version) "
+                "VALUES (?, ?, ?, ?)",
+                (key, data, self._expiry(timeout), version),
+            )
+
+        self._front.put(key, version, data)
+        self._maybe_cull(now)
+        return True
+
+    def _maybe_cull(self, now: float):
+        # Counting the entries isn't free, so only check every so often.
+        self._writes += 1
+        if self._writes % max(1, self._max_entries // 10):
+            return
+
+        db = self._db
+        db.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+        (count,) = db.execute("SELECT COUNT(*) FROM cache").fetchone()
+        if count > self._max_entries:
+            # Remove the entries that expire soonest.
+            db.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY expires LIMIT ?)",
+                (count // self._cull_frequency,),
+            )
+
+    # ----- Cache API ---------------------------------------------------------------
+    def get(self, key, default=None, version=None):
+        value = self._load(self._key(key, version), time.time())
+        return default if value is None else dill.loads(value)
+
+    def get_many(self, keys, version=None):
+        now = time.time()
+        out = {}
+        for key in keys:
+            value = self._load(self._key(key, version), now)
+            if value is not None:
+                out[key] = dill.loads(value)
+        return out
+
+    def has_key(self, key, version=None):
+        row = self._db.execute(
+            "SELECT 1 FROM cache WHERE key = ? AND expires > ?",
+            (self._key(key, version), time.time()),
+        ).fetchone()
+        return row is not None
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._store(self._key(key, version), value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._store(
+            self._key(key, version), value, timeout, only_if_missing=True
+        )
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        db = self._db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for key, value in data.items():
+                self._store(self._key(key, version), value, timeout)
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        return []
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        cursor = self._db.execute(
+            "UPDATE cache SET expires = ? WHERE key = ? AND expires > ?",
+            (self._expiry(timeout), self._key(key, version), time.time()),
+        )
+        return cursor.rowcount == 1
+
+    def incr(self, key, delta=1, version=None):
+        key = self._key(key, version)
+        db = self._db
+        # Read and write in one (write) transaction, so increments aren't lost.
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT value FROM cache WHERE key = ? AND expires > ?",
+                (key, time.time()),
+            ).fetchone()
+            if row is None:
+                raise ValueError(f"Key '{key}' not found")
+
+            value = dill.loads(row[0]) + delta
+            data = dill.dumps(value, dill.HIGHEST_PROTOCOL)
+            new_version = random.getrandbits(63)
+            db.execute(
+                "UPDATE cache SET value = ?, version = ? WHERE key = ?",
+                (data, new_version, key),
+            )
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+        self._front.put(key, new_version, data)
+        return value
+
+    def delete(self, key, version=None):
+        key = self._key(key, version)
+        self._front.pop(key)
+        cursor = self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+        return cursor.rowcount == 1
+
+    def clear(self):
+        self._front.clear()
+        self._db.execute("DELETE FROM cache")
+
+    def close(self, **kwargs):
+        # Connections are kept open for the life of the thread, like LocMemCache
+        # keeps its memory: closing them after every request would be wasteful.
+        pass
@@ -0,0 +1,151 @@
+$(function () {
+    // Validates the input form in the browser before it is submitted, using the
+    // schema generated from the form classes (see halomod_app/schema.py). The server
+    // still validates everything; this just saves a round-trip for simple mistakes.
+    var form = $('#input_form');
+    if (form.length === 0) {
+        return;
+    }
+
+    var schema = null;
+    $.getJSON('/schema.json', function (data) {
+        schema = data;
+    });
+
+    function parseRange(value) {
+        var parts = String(value).split(' - ');
+        if (parts.length !== 2) {
+            return null;
+        }
+        var lower = Number(parts[0].trim());
+        var upper = Number(parts[1].trim());
+        if (isNaN(lower) || isNaN(upper)) {
+            return null;
+        }
+        return [lower, upper];
+    }
+
+    function checkBounds(value, field) {
+        if (field.min !== null && field.min !== undefined && value < field.min) {
+            return 'Must be greater than ' + field.min + '.';
+        }
+        if (field.max !== null && field.max !== undefined && value > field.max) {
+            return 'Must be smaller than ' + field.max + '.';
+        }
+        return null;
+    }
+
+    // Whether a field is a parameter of a model that isn't chosen (so it's unused).
+    function isInactive(field) {
+        if (field.model === undefined) {
+            return false;
+        }
+        return $('#id_' + field.component + '_model').val() !== field.model;
+    }
+
+    function fieldError(field, value) {
+        if (value === undefined || value === null || String(value).trim() === '') {
+            if (field.required && field.type !== 'bool' && field.type !== 'file') {
+                return 'This field is required.';
+            }
+            return null;
+        }
+        value = String(value).trim();
+
+        switch (field.type) {
+            case 'int':
+                if (!/^[-+]?\d+$/.test(value)) {
+                    return 'Enter a whole number.';
+                }
+                return checkBounds(Number(value), field);
+            case 'float':
+                if (isNaN(Number(value))) {
+                    return 'Enter a number.';
+                }
+                return checkBounds(Number(value), field);
+            case 'floatlist':
+                var numbers = value.split(',');
+                for (var i = 0; i < numbers.length; i++) {
+                    if (isNaN(Number(numbers[i]))) {
+                        return numbers[i] + ' is not a float';
+                    }
+                    var error = checkBounds(Number(numbers[i]), field);
+                    if (error) {
+                        return error;
+                    }
+                }
+                return null;
+            case 'range':
+                var range = parseRange(value);
+                if (range === null) {
+                    return 'Enter a range as "lower - upper".';
+                }
+                if (range[0] >= range[1]) {
+                    return 'The lower limit must be smaller than the upper limit.';
+                }
+                return checkBounds(range[0], field) || checkBounds(range[1], field);
+            case 'choice':
+                if (field.choices.indexOf(value) === -1) {
+                    return 'Select a valid choice.';
+                }
+                return null;
+        }
+        return null;
+    }
+
+    function showError(input, field, message) {
+        input.addClass('is-invalid');
+        input.after($('<div class="invalid-feedback d-block js-validation"></div>').text(message));
+        return $('<li></li>').text(field.label.replace(/<[^>]*>/g, '') + ': ' + message);
+    }
+
+    form.submit(function (event) {
+        if (schema === null) {
+            // Schema hasn't loaded, so leave it all to the server.
+            return true;
+        }
+
+        form.find('.js-validation').remove();
+        form.find('.is-invalid').removeClass('is-invalid');
+
+        var errors = [];
+        var values = {};
+
+        $.each(schema.fields, function (i, field) {
+            var input = form.find('[name="' + field.name + '"]');
+            if (input.length === 0 || isInactive(field)) {
+                return;
+            }
+            values[field.name] = input.val();
+
+            var message = fieldError(field, input.val());
+            if (message) {
+                errors.push(showError(input, field, message));
+            }
+        });
+
+        $.each(schema.rules, function (i, rule) {
+            if (rule.type !== 'step_in_range') {
+                return;
+            }
+            var range = parseRange(values[rule.range]);
+            var step = Number(values[rule.step]);
+            if (range !== null && !isNaN(step) && step > (range[1] - range[0]) / 2) {
+                var field = $.grep(schema.fields, function (f) {
+                    return f.name === rule.step;
+                })[0];
+                errors.push(showError(form.find('[name="' + rule.step + '"]'), field, rule.message));
+            }
+        });
+
+        if (errors.length > 0) {
+            event.preventDefault();
+            var alert = $('<div class="alert alert-danger js-validation"><ul class="m-0"></ul></div>');
+            alert.find('ul').append(errors);
+            form.prepend(alert);
+            $('html, body').animate({scrollTop: form.offset().top}, 200);
+            return false;
+        }
+        return true;
+    });
+});
@@ -118,16 +118,134 @@ $(function () {
 
     });
 
+    // Fetch a plot image, retrying (after the delay the server asks for) while the
+    // server is too busy to take it. The request is dropped (and its response ignored)
+    // once another plot has been asked for in the same image.
+    function fetchImage(image, url, attempt, request) {
+        function stale() {
+            return image.data('request') !== request;
+        }
+
+        var options = {credentials: 'same-origin'};
+        if (request.controller) {
+            options.signal = request.controller.signal;
+        }
+        fetch(url, options).then(function (response) {
+            if (stale()) {
+                return;
+            }
+            if (response.status === 503 && attempt < 5) {
+                var delay = parseInt(response.headers.get('Retry-After'), 10) || 2;
+                setTimeout(function () {
+                    if (!stale()) {
+                        fetchImage(image, url, attempt + 1, request);
+                    }
+                }, 1000 * delay);
+                return;
+            }
+            if (!response.ok) {
+                image.trigger('error');
+                return;
+            }
+            return response.blob().then(function (blob) {
+                if (stale()) {
+                    return;
+                }
+                var old = image.attr('src');
+                if (old && old.indexOf('blob:') === 0) {
+                    URL.revokeObjectURL(old);
+                }
+                image.attr('src', URL.createObjectURL(blob));
+            });
+        }).catch(function () {
+            if (!stale()) {
+                image.trigger('error');
+            }
+        });
+    }
+
+    // Load a plot image, showing the progress of its computation.
+    function loadPlot(src) {
+        var image = $('#the_image');
+        if (!window.EventSource || !window.fetch) {
+            image.attr('src', src);
+            return;
+        }
+
+        // Drop the previous plot's request, if it's still going.
+        var previous = image.data('request');
+        if (previous) {
+            if (previous.controller) {
+                previous.controller.abort();
+            }
+            if (previous.source) {
+                previous.source.close();
+            }
+        }
+        var request = {
+            controller: window.AbortController ? new AbortController() : null,
+            source: null
+        };
+        image.data('request', request);
+
+        var job = Math.random().toString(36).slice(2) + Date.now().toString(36);
+        var bar = $('#plot_progress');
+        var source = null;
+
+        image.off('load error').one('load error', function () {
+            if (source !== null) {
+                source.close();
+            }
+            bar.addClass('d-none');
+        });
+
+        // Request the image first, so that it isn't queued behind the progress stream.
+        fetchImage(image, src + '?job=' + job, 0, request);
+
+        source = request.source = new EventSource('progress/' + job + '/');
+        source.addEventListener('progress', function (event) {
+            var state = JSON.parse(event.data);
+            if (state === null || state.steps.length === 0) {
+                return;
+            }
+            var done = $.grep(state.steps, function (step) {
+                return step.status === 'done';
+            }).length;
+            var running = $.grep(state.steps, function (step) {
+                return step.status === 'running';
+            });
+
+            bar.removeClass('d-none');
+            bar.find('.progress-bar')
+                .css('width', (100 * done / state.steps.length) + '%')
+                .text(running.length ? running[0].model + ': ' + running[0].label : '');
+        });
+        source.addEventListener('done', function () {
+            source.close();
+        });
+        source.addEventListener('timeout', function () {
+            source.close();
+        });
+    }
+
+    if ($('#the_image').attr('data-src')) {
+        loadPlot($('#the_image').attr('data-src'));
+    }
+
     //Change plotted image to whatever user clicks on
     $('#id_plot_choice').change(function () {
         var src = 'plot/' + $(this).val() + '.svg';
-        $('#the_image').attr('src', src);
+        loadPlot(src);
 
         //Also change download link
         if ($('#id_download_choice').val() === 'pdf-current') {
             var newlink = 'plot/' + $('#id_plot_choice').val() + '.pdf';
             $('a#plot_download').attr('href', newlink);
         }
+        if ($('#id_download_choice').val() === 'ASCII-current') {
+            var newlink = "download/allData.zip?quantities=" + $('#id_plot_choice').val().replace('comparison_', '');
+            $('a#plot_download').attr('href', newlink);
+        }
     });
 
     //Change download link depending on what user wants to download
@@ -140,6 +258,18 @@ $(function () {
             var newlink = "download/allData.zip"
             $('a#plot_download').attr('href', newlink);
         }
+        if ($(this).val() === 'ASCII-current') {
+            var newlink = "download/allData.zip?quantities=" + $('#id_plot_choice').val().replace('comparison_', '')
+            $('a#plot_download').attr('href', newlink);
+        }
+        if ($(this).val() === 'npz') {
+            var newlink = "download/allData.npz"
+            $('a#plot_download').attr('href', newlink);
+        }
+        if ($(this).val() === 'parquet') {
+            var newlink = "download/allData.parquet.zip"
+            $('a#plot_download').attr('href', newlink);
+        }
         if ($(this).val() === 'parameters') {
             var newlink = "download/parameters.txt"
             $('a#plot_download').attr('href', newlink);
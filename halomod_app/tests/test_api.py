@@ -0,0 +1,56 @@
+import json
+
+from asgiref.sync import async_to_sync
+from django.test import RequestFactory, SimpleTestCase
+
+from halomod_app import api, async_views
+
+
+class ParseSpecTest(SimpleTestCase):
+    def parse(self, model):
+        return api.parse_spec({"model": model, "quantities": ["dndm"]})
+
+    def test_defaults(self):
+        cls, params, quantities = self.parse({"z": 1.0})
+        self.assertEqual(cls.__name__, "TracerHaloModel")
+        self.assertEqual(params["z"], 1.0)
+        self.assertIn("hmf_model", params)
+        self.assertEqual(quantities, ["dndm"])
+
+    def test_out_of_bounds(self):
+        with self.assertRaisesRegex(api.APIError, "dlnk"):
+            self.parse({"dlnk": 1e-7})
+
+    def test_unknown_parameter(self):
+        with self.assertRaisesRegex(api.APIError, "not_a_parameter"):
+            self.parse({"not_a_parameter": 1})
+
+    def test_half_range(self):
+        with self.assertRaisesRegex(api.APIError, "lnk_max"):
+            self.parse({"lnk_min": -10})
+
+
+class ComputeViewTest(SimpleTestCase):
+    def test_invalid_model(self):
+        response = self.client.post(
+            "/api/compute/",
+            json.dumps({"model": {"dlnk": 1e-7}, "quantities": ["dndm"]}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("dlnk", response.json()["error"])
+
+
+class AsyncBatchTest(SimpleTestCase):
+    def test_computed_in_thread(self):
+        request = RequestFactory().post(
+            "/api/batch/",
+            b'{"id": "a", "model": 1}\nnot json\n',
+            "application/x-ndjson",
+        )
+        response = async_to_sync(async_views.batch)(request)
+
+        lines = [json.loads(line) for line in response.content.splitlines()]
+        self.assertEqual([line["index"] for line in lines], [0, 1])
+        self.assertEqual(lines[0]["id"], "a")
+        self.assertTrue(all("error" in line for line in lines))
@@ -0,0 +1,72 @@
+import threading
+import time
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from halomod_app import circuit, utils
+
+
+@override_settings(CIRCUIT_FAILURES=3, CIRCUIT_COMPUTE_TIMEOUT=60)
+class CircuitTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_queued_computations(self):
+        def compute():
+            with utils.compute_lock, circuit.guard("fp"):
+                time.sleep(0.05)
+
+        threads = [threading.Thread(target=compute) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        circuit.check("fp")
+        self.assertIsNone(cache.get(circuit._failures_key("fp")))
+
+    def test_in_progress(self):
+        tokens = [circuit.begin("fp") for _ in range(5)]
+        for token in tokens:
+            circuit.end("fp", token)
+        circuit.check("fp")
+
+    def test_concurrent_attempts(self):
+        tokens = []
+
+        def begin():
+            tokens.append(circuit.begin("fp"))
+
+        threads = [threading.Thread(target=begin) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(cache.get(circuit._attempts_key("fp")), set(tokens))
+
+    def test_crashes(self):
+        for _ in range(3):
+            with self.assertRaises(MemoryError):
+                with circuit.guard("fp"):
+                    raise MemoryError
+
+        with self.assertRaises(circuit.CircuitOpen):
+            circuit.begin("fp")
+
+    def test_model_errors(self):
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                with circuit.guard("fp"):
+                    raise ValueError
+        circuit.check("fp")
+
+    def test_timed_out(self):
+        for _ in range(3):
+            token = circuit.begin("fp")
+            # As if its worker was killed long ago.
+            cache.set(circuit._attempt_key("fp", token), time.time() - 61)
+
+        with self.assertRaises(circuit.CircuitOpen):
+            circuit.begin("fp")
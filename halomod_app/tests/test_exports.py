@@ -0,0 +1,61 @@
+import io
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from halomod_app import exports
+
+
+def _parse(rows) -> np.ndarray:
+    return np.array([float(row.tobytes()) for row in rows])
+
+
+class FormatSciTest(SimpleTestCase):
+    def setUp(self):
+        # Doubles from their bits, so every exponent and mantissa turns up.
+        bits = np.random.default_rng(42).integers(0, 2**63, 100_000, dtype=np.uint64)
+        x = bits.view(np.float64)
+        self.x = np.concatenate([x[np.isfinite(x)], -x[:1000][np.isfinite(x[:1000])]])
+
+    def test_round_trip(self):
+        rows = exports.format_sci(self.x)
+        np.testing.assert_array_equal(_parse(rows), self.x)
+
+    def test_matches_printf(self):
+        for precision in (exports.DEFAULT_PRECISION, exports.MAX_PRECISION):
+            rows = exports.format_sci(self.x[:2000], precision)
+            for row, value in zip(rows, self.x[:2000]):
+                self.assertEqual(
+                    row.tobytes().decode().strip(), f"{value:.{precision}e}"
+                )
+
+    def test_powers_of_ten(self):
+        # Where log10 rounds to the wrong exponent, and where rounding carries to it.
+        x = 10.0 ** np.arange(-323, 309)
+        x = np.concatenate([x, np.nextafter(x, 0), np.nextafter(x, np.inf), [-0.0]])
+        for precision in (15, exports.DEFAULT_PRECISION, exports.MAX_PRECISION):
+            rows = exports.format_sci(x, precision)
+            for row, value in zip(rows, x):
+                self.assertEqual(
+                    row.tobytes().decode().strip(), f"{value:.{precision}e}"
+                )
+
+    def test_vectorized_precision(self):
+        scales = 10.0 ** np.arange(-50, 50).repeat(100)
+        x = np.random.default_rng(0).normal(size=len(scales)) * scales
+        rows = exports.format_sci(x, 10)
+        np.testing.assert_allclose(_parse(rows), x, rtol=1e-10)
+
+    def test_exponents(self):
+        rows = exports.format_sci(np.array([1.0, 1e100, -2.5e-7]), 3)
+        self.assertEqual(
+            [row.tobytes() for row in rows],
+            [b"   1.000e+00", b"  1.000e+100", b"  -2.500e-07"],
+        )
+
+    def test_loadtxt(self):
+        columns = [self.x[:5000], self.x[5000:10000]]
+        f = io.BytesIO()
+        exports.write_columns(f, columns)
+        f.seek(0)
+        np.testing.assert_array_equal(np.loadtxt(f).T, columns)
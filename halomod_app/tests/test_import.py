@@ -0,0 +1,40 @@
+import io
+import zipfile
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from django.utils.datastructures import MultiValueDict
+
+from halomod_app.forms import ImportForm
+
+
+def _zip(files: dict) -> SimpleUploadedFile:
+    buff = io.BytesIO()
+    with zipfile.ZipFile(buff, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return SimpleUploadedFile("models.zip", buff.getvalue())
+
+
+def _form(*uploads) -> ImportForm:
+    return ImportForm(data={}, files=MultiValueDict({"files": list(uploads)}))
+
+
+class ImportFormTest(SimpleTestCase):
+    def test_reads_zip(self):
+        form = _form(_zip({"a.toml": "z = 1.0\n", "b.toml": "[params]\nz = 2.0\n"}))
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.bundles, {"a": {"z": 1.0}, "b": {"z": 2.0}})
+
+    @override_settings(IMPORT_MAX_FILE_BYTES=1000)
+    def test_rejects_large_member(self):
+        # Compresses to almost nothing.
+        form = _form(_zip({"a.toml": "#" * 10**6}))
+        self.assertFalse(form.is_valid())
+        self.assertIn("too large", str(form.errors))
+
+    @override_settings(IMPORT_MAX_FILES=3)
+    def test_rejects_many_files(self):
+        form = _form(_zip({f"m{i}.toml": "z = 1.0\n" for i in range(4)}))
+        self.assertFalse(form.is_valid())
+        self.assertIn("At most 3 files", str(form.errors))
@@ -0,0 +1,51 @@
+import threading
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from halomod_app import profiling, results, utils
+
+
+class ComputeSharedTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_keeps_lock_of_other_worker(self):
+        lock = results._lock_key("fp", "dndm")
+
+        def compute():
+            # As if our lock expired, and another worker took it.
+            cache.set(lock, "other")
+            return [1.0]
+
+        results._compute_shared("fp", "dndm", compute)
+        self.assertEqual(cache.get(lock), "other")
+
+    def test_releases_own_lock(self):
+        results._compute_shared("fp", "dndm", lambda: [1.0])
+        self.assertIsNone(cache.get(results._lock_key("fp", "dndm")))
+
+
+class ProfileTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_recorded_without_compute_lock(self):
+        locked = []
+
+        def record(obj, quantity, seconds):
+            # The lock is only free to another thread if this one doesn't hold it.
+            def check():
+                free = utils.compute_lock.acquire(blocking=False)
+                if free:
+                    utils.compute_lock.release()
+                locked.append(not free)
+
+            thread = threading.Thread(target=check)
+            thread.start()
+            thread.join()
+
+        with mock.patch.object(profiling, "record", record):
+            results.get_quantities(object(), ["__class__"], fingerprint="fp")
+        self.assertEqual(locked, [False])
@@ -0,0 +1,69 @@
+from django.core.cache import cache
+from django.http import StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from halomod_app import scheduling
+from halomod_app.middleware import AdmissionControlMiddleware, ComputeQuotaMiddleware
+
+
+@override_settings(ADMISSION_CAPACITY=1)
+class AdmissionTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_full(self):
+        lease = scheduling.admit(scheduling.INTERACTIVE)
+        self.assertIsNotNone(lease)
+        self.assertIsNone(scheduling.admit(scheduling.INTERACTIVE))
+
+        scheduling.release(lease)
+        self.assertIsNotNone(scheduling.admit(scheduling.INTERACTIVE))
+
+    def test_release_expired(self):
+        key, token = scheduling.admit(scheduling.INTERACTIVE)
+
+        # As if the lease expired, and another request took it.
+        cache.set(key, "other")
+        scheduling.release((key, token))
+        self.assertEqual(cache.get(key), "other")
+
+    def test_streaming_holds_lease(self):
+        middleware = AdmissionControlMiddleware(
+            lambda request: StreamingHttpResponse(iter([b"a"]))
+        )
+
+        response = middleware(RequestFactory().post("/api/batch/"))
+        self.assertIsNone(scheduling.admit(scheduling.BULK))
+
+        response.close()
+        self.assertIsNotNone(scheduling.admit(scheduling.BULK))
+
+
+class ClientTest(SimpleTestCase):
+    def test_spoofed_forwarded_for(self):
+        # The proxy appends the address it saw to what the client sent.
+        request = RequestFactory().get(
+            "/", HTTP_X_FORWARDED_FOR="10.0.0.1, 203.0.113.7"
+        )
+        self.assertEqual(scheduling.client_ip(request), "203.0.113.7")
+
+
+class ComputeQuotaTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_streaming_holds_slot(self):
+        queue = scheduling.get_queue()
+        served = scheduling.stats()["requests"].get(scheduling.BULK, 0)
+        middleware = ComputeQuotaMiddleware(
+            lambda request: StreamingHttpResponse(iter([b"a", b"b"]))
+        )
+
+        response = middleware(RequestFactory().post("/api/batch/"))
+        self.assertEqual(queue.load(), (0, 1))
+        self.assertEqual(b"".join(response), b"ab")
+        self.assertEqual(queue.load(), (0, 1))
+
+        response.close()
+        self.assertEqual(queue.load(), (0, 0))
+        self.assertEqual(scheduling.stats()["requests"][scheduling.BULK], served + 1)
@@ -0,0 +1,28 @@
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+
+@override_settings(RENDER_WORKERS=0)
+class SessionTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_reload_after_tracer_plot(self):
+        self.assertEqual(self.client.get("/").status_code, 200)
+
+        # Computing tracer quantities gives the model attributes that plain pickle
+        # can't serialize.
+        response = self.client.get("/plot/power_auto_tracer.svg")
+        self.assertEqual(response.status_code, 200)
+
+        self.assertIn("default", self.client.session["objects"])
+        self.assertEqual(self.client.get("/").status_code, 200)
+        self.assertEqual(
+            self.client.get("/plot/power_auto_tracer.svg").status_code, 200
+        )
+
+    def test_timings(self):
+        self.client.get("/")
+        response = self.client.get("/timings")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("image-page", response.json())
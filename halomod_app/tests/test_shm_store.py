@@ -0,0 +1,33 @@
+from unittest import mock
+
+import numpy as np
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from halomod_app import results, shm_store
+
+
+@override_settings(RESULT_STORE="shm")
+class ShmStoreTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_put_get(self):
+        arr = np.arange(10.0)
+        refs = shm_store.put({"x": arr})
+        np.testing.assert_array_equal(shm_store.get(refs["x"]), arr)
+        self.assertIsNone(cache.get(shm_store._REGISTRY_LOCK))
+
+    @mock.patch.object(shm_store, "_LOCK_TIMEOUT", 0.05)
+    def test_registry_busy(self):
+        cache.set(shm_store._REGISTRY_LOCK, "other")
+
+        with self.assertRaises(shm_store.RegistryBusy):
+            shm_store.put({"x": np.arange(10.0)})
+        self.assertEqual(cache.get(shm_store._REGISTRY_LOCK), "other")
+
+        # The results are kept in the cache itself instead.
+        results.store("fp", {"dndm": np.arange(10.0)})
+        np.testing.assert_array_equal(
+            results.get_cached("fp", ["dndm"])["dndm"], np.arange(10.0)
+        )
@@ -0,0 +1,34 @@
+import tempfile
+
+import numpy as np
+from django.test import SimpleTestCase, override_settings
+
+from halomod_app import transfer, utils
+
+
+class HMFDriverTest(SimpleTestCase):
+    def test_edit_keeps_params(self):
+        base = utils.hmf_driver()
+        edited = utils.hmf_driver(
+            previous=base, hmf_model="Tinker10", hmf_params={"max_z": 2.0}
+        )
+        self.assertEqual(edited.hmf_params, {"max_z": 2.0})
+
+    def test_changed_model_resets_params(self):
+        base = utils.hmf_driver(hmf_model="ST", hmf_params={"a": 0.8})
+        edited = utils.hmf_driver(previous=base, hmf_model="SMT")
+        self.assertEqual(edited.hmf_params, {})
+
+    def test_edit_keeps_transfer_key(self):
+        # Models with an uploaded transfer function refer to it by its key alone.
+        with tempfile.TemporaryDirectory() as store:
+            with override_settings(TRANSFER_STORE_DIR=store):
+                k = np.logspace(-5, 5, 50)
+                params = {"key": transfer.store_table(np.array([k, np.ones_like(k)]))}
+                base = utils.hmf_driver(
+                    transfer_model=transfer.FromStore, transfer_params=params
+                )
+                edited = utils.hmf_driver(
+                    previous=base, transfer_model=transfer.FromStore, z=1.0
+                )
+                self.assertEqual(edited.transfer_params, params)
@@ -0,0 +1,52 @@
+import tempfile
+from pathlib import Path
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+
+from halomod_app import transfer
+from halomod_app.forms import FrameworkInput
+
+
+class ValidateModelTest(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store = Path(tmp.name)
+
+        override = override_settings(TRANSFER_STORE_DIR=str(self.store))
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_does_not_store_upload(self):
+        data = FrameworkInput.data_from_framework_dict({}, "upload")
+        data["transfer_model"] = "FromStore"
+        upload = SimpleUploadedFile(
+            "transfer.dat",
+            b"".join(b"%g %g\n" % (10 ** (i / 10), 1) for i in range(50)),
+        )
+
+        response = self.client.post(
+            "/validate/", {**data, "transfer_FromStore_key": upload}
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+
+        key = response.json()["params"]["transfer_params"]["key"]
+        self.assertFalse(transfer.has_table(key))
+        self.assertEqual(list(self.store.iterdir()), [])
+
+    def test_reports_every_error(self):
+        data = FrameworkInput.data_from_framework_dict({}, "invalid")
+        data["z"] = -1
+        data["lnk_range"] = "0 - 0.5"
+        data["dlnk"] = 0.4
+
+        response = self.client.post("/validate/", data)
+        self.assertEqual(response.status_code, 400, response.content)
+
+        errors = response.json()["errors"]
+        self.assertIn("z", errors)
+        self.assertEqual(
+            [error["message"] for error in errors["__all__"]],
+            ["Wavenumber step-size must be less than the k-range."],
+        )
@@ -0,0 +1,176 @@
+"""Breakdown of the time spent serving each request, by phase.
+
+Code doing something slow marks it with :func:`timed` (eg. ``with
+timing.timed("render"):``), which adds the seconds it takes to the timings of the
+request being served, if any. The :class:`~halomod_app.middleware.TimingMiddleware`
+starts the timings of each request, and when it is served:
+
+* sends them to the client in a ``Server-Timing`` header (shown by the network tab
+  of browsers' developer tools), if ``SERVER_TIMING`` is set,
+* logs them as a line of JSON, and
+* adds them to the recent timings of its endpoint (the name of its URL), kept in
+  this process, from which percentiles are computed (see :func:`summary`, served
+  as JSON at ``/timings``), and to the histograms served at ``/metrics`` (see
+  :mod:`~halomod_app.metrics`).
+
+The phases are:
+
+``session-fetch``, ``session-unpickle``, ``session-pickle``, ``session-store``
+    Loading and saving the session (see :mod:`~halomod_app.sessions`).
+``hmf``
+    Building models (see :func:`~halomod_app.utils.hmf_driver`).
+``compute``
+    Computing quantities of models that aren't in the result cache.
+``render``
+    Drawing plots (see :mod:`~halomod_app.render`).
+``export``
+    Writing downloadable archives (see :mod:`~halomod_app.exports`).
+
+Phases can be nested (eg. models are built while computing), and overlap when
+work is done concurrently, so they don't add up to the total.
+"""
+import contextvars
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# The timings of the request being served.
+_current = contextvars.ContextVar("timings", default=None)
+
+# The recent timings of each endpoint, in this process.
+_recent = {}
+_recent_lock = threading.Lock()
+
+PERCENTILES = (50, 90, 99)
+
+
+class Timings:
+    """The seconds spent in each phase of serving a request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def add(self, phase: str, seconds: float):
+        # Phases may be timed in several threads at once (eg. by async views).
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def total(self) -> float:
+        return time.perf_counter() - self.start
+
+
+@contextmanager
+def timed(phase: str):
+    """Add the time spent in the block to a phase of the current request."""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(phase, time.perf_counter() - t0)
+
+
+def start() -> tuple:
+    """Start timing a request.
+
+    Returns
+    -------
+    The timings, and a token to give to :func:`finish`.
+    """
+    timings = Timings()
+    return timings, _current.set(timings)
+
+
+def finish(request, response, timings: Timings, token):
+    """Stop timing a request, and report its timings."""
+    _current.reset(token)
+    total = timings.total()
+
+    match = getattr(request, "resolver_match", None)
+    endpoint = match.url_name if match is not None and match.url_name else "other"
+
+    if settings.SERVER_TIMING:
+        response["Server-Timing"] = ", ".join(
+            f"{phase};dur={1000 * seconds:.1f}"
+            for phase, seconds in {**timings.phases, "total": total}.items()
+        )
+
+    logger.info(
+        json.dumps(
+            {
+                "event": "request",
+                "endpoint": endpoint,
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "ms": round(1000 * total, 1),
+                "phases": {
+                    phase: round(1000 * seconds, 1)
+                    for phase, seconds in timings.phases.items()
+                },
+            }
+        )
+    )
+
+    metrics.REQUEST_SECONDS.observe(total, view=endpoint)
+    metrics.REQUESTS.inc(view=endpoint, status=response.status_code)
+    for phase, seconds in timings.phases.items():
+        metrics.PHASE_SECONDS.observe(seconds, phase=phase)
+
+    with _recent_lock:
+        if endpoint not in _recent:
+            _recent[endpoint] = deque(maxlen=settings.TIMING_SAMPLES)
+        _recent[endpoint].append({**timings.phases, "total": total})
+
+
+def _percentiles(values: list) -> dict:
+    values = sorted(values)
+    return {
+        f"p{p}": values[min(len(values) - 1, int(p / 100 * len(values)))]
+        for p in PERCENTILES
+    }
+
+
+def summary() -> dict:
+    """Percentiles of the recent timings of each endpoint, in this process.
+
+    Returns
+    -------
+    dict
+        For each endpoint: the number of recent requests (``count``), and for the
+        total and each phase, its percentiles (in seconds) over the requests that
+        spent time in it (and their number).
+    """
+    with _recent_lock:
+        recent = {endpoint: list(samples) for endpoint, samples in _recent.items()}
+
+    out = {}
+    for endpoint, samples in recent.items():
+        phases = defaultdict(list)
+        for sample in samples:
+            for phase, seconds in sample.items():
+                phases[phase].append(seconds)
+
+        out[endpoint] = {
+            "count": len(samples),
+            **{
+                phase: {"count": len(values), **_percentiles(values)}
+                for phase, values in phases.items()
+            },
+        }
+    return out
@@ -0,0 +1,160 @@
+"""Storage of uploaded transfer functions, and the transfer model that uses them.
+
+An uploaded transfer file is parsed once, as it is streamed in, into a table of
+``(k, T)``, which is saved on disk under the hash of its contents. Models then only
+carry that key (in the parameters of the :class:`FromStore` transfer model), so that
+identical uploads are stored once, and the session never holds the file itself.
+"""
+import hashlib
+import io
+import logging
+import os
+import re
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from hmf.density_field.transfer_models import FromFile
+from scipy.interpolate import InterpolatedUnivariateSpline as spline
+
+logger = logging.getLogger(__name__)
+
+_KEY = re.compile(r"^[0-9a-f]{64}$")
+
+
+def _rows(lines: list) -> np.ndarray:
+    """The (k, T) columns of a batch of lines of a transfer file."""
+    table = np.loadtxt(io.StringIO("".join(lines)), ndmin=2)
+
+    # Same columns as hmf's FromFile: CAMB output, or else two-column (k, T).
+    if table.shape[1] > 6:
+        return table[:, [0, 6]]
+    elif table.shape[1] > 1:
+        return table[:, [0, 1]]
+    else:
+        raise ValueError("the file must have at least two columns")
+
+
+def read_table(upload, max_bytes: int) -> np.ndarray:
+    """Parse an uploaded transfer file into a ``(2, n)`` array of ``(k, T)``.
+
+    The file is parsed chunk by chunk as it is read, and no more than ``max_bytes``
+    of it are read.
+
+    Raises
+    ------
+    ValueError
+        If the file is too large, or is not a valid transfer function.
+    """
+    if upload.size is not None and upload.size > max_bytes:
+        raise ValueError(f"the file must be smaller than {max_bytes // 1024} KiB")
+
+    nbytes = 0
+    remainder = b""
+    batches = []
+    for chunk in upload.chunks():
+        nbytes += len(chunk)
+        if nbytes > max_bytes:
+            raise ValueError(f"the file must be smaller than {max_bytes // 1024} KiB")
+
+        # Only parse whole lines, keeping the last partial one for the next chunk.
+        lines = (remainder + chunk).split(b"\n")
+        remainder = lines.pop()
+        lines = [line.decode() + "\n" for line in lines if line.strip()[:1] not in b"#"]
+        if lines:
+            batches.append(_rows(lines))
+
+    if remainder.strip() and not remainder.strip().startswith(b"#"):
+        batches.append(_rows([remainder.decode()]))
+
+    if not batches:
+        raise ValueError("the file is empty")
+
+    table = np.ascontiguousarray(np.concatenate(batches).T, dtype=float)
+
+    if table.shape[1] < 2:
+        raise ValueError("the file must have at least two rows")
+    if not np.all(np.isfinite(table)) or np.any(table <= 0):
+        raise ValueError("k and T must be finite and positive")
+    if np.any(np.diff(table[0]) <= 0):
+        raise ValueError("k must be increasing")
+
+    return table
+
+
+def _path(key: str) -> Path:
+    if not _KEY.match(key or ""):
+        raise ValueError(f"'{key}' is not a valid transfer function key")
+    return Path(settings.TRANSFER_STORE_DIR) / f"{key}.npy"
+
+
+def table_key(table: np.ndarray) -> str:
+    """The key under which a transfer table is (or would be) stored."""
+    return hashlib.sha256(
+        np.ascontiguousarray(table, dtype=float).tobytes()
+    ).hexdigest()
+
+
+def store_table(table: np.ndarray) -> str:
+    """Save a transfer table (if it isn't already), returning its key."""
+    table = np.ascontiguousarray(table, dtype=float)
+    key = table_key(table)
+    path = _path(key)
+
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first, so a partly-written table is never read.
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".npy")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, table)
+        os.replace(tmp, path)
+        logger.info(f"Stored new transfer function {key}")
+
+    return key
+
+
+def has_table(key: str) -> bool:
+    """Whether a transfer table with the given key is stored."""
+    try:
+        return _path(key).exists()
+    except ValueError:
+        return False
+
+
+@lru_cache(maxsize=32)
+def load_table(key: str) -> np.ndarray:
+    """Load a stored transfer table, as a read-only ``(2, n)`` array of ``(k, T)``."""
+    return np.load(_path(key), mmap_mode="r")
+
+
+class FromStore(FromFile):
+    r"""
+    A transfer function uploaded to TheHaloMod, referenced by its key in the store.
+
+    Parameters
+    ----------
+    cosmo : :class:`astropy.cosmology.FLRW` instance
+        The cosmology used in the calculation
+    \*\*model_parameters : unpack-dict
+        Parameters specific to this model. In this case, available
+        parameters are the following. To see their default values,
+        check the :attr:`_defaults` class attribute.
+
+        :key: str
+            The key of the transfer function, as returned by :func:`store_table`.
+    """
+
+    _defaults = {"key": ""}
+
+    def lnt(self, lnk):
+        k, T = load_table(self.params["key"])
+
+        if lnk[0] < np.log(k[0]):
+            lnkout, lnT = self._check_low_k(np.log(k), np.log(T), lnk[0])
+        else:
+            lnkout = np.log(k)
+            lnT = np.log(T)
+        return spline(lnkout, lnT, k=1)(lnk)
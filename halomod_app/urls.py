@@ -1,8 +1,12 @@
+from django.conf import settings
 from django.urls import path
 from django.views.generic.base import RedirectView
 from django.contrib.staticfiles.storage import staticfiles_storage
 
-from . import views
+from . import api, async_views, views
+
+# Under ASGI, the compute-heavy views are served by their async versions.
+heavy = async_views if settings.ASYNC_VIEWS else views
 
 urlpatterns = [
     path(
@@ -19,6 +23,15 @@ urlpatterns = [
         name="calculate",
     ),
     path("edit/<label>/", views.CalculatorInputEdit.as_view(), name="calculate"),
+    path("import/", views.ImportModels.as_view(), name="import"),
+    path("schema.json", views.form_schema, name="form-schema"),
+    path("validate/", views.validate_model, name="validate"),
+    path("api/compute/", api.compute_view, name="api-compute"),
+    path(
+        "api/batch/",
+        async_views.batch if settings.ASYNC_VIEWS else api.batch_view,
+        name="api-batch",
+    ),
     path("delete/<label>/", views.delete_plot, name="delete"),
     path("restart/", views.complete_reset, name="restart"),
     path("help/", views.help.as_view(), name="help"),
@@ -33,13 +46,22 @@ urlpatterns = [
     #     name='acknowledgments'
     # ),
     path("", views.ViewPlots.as_view(), name="image-page"),
-    path("plot/<plottype>.<filetype>", views.plots, name="images"),
-    path("download/allData.zip", views.data_output, name="data-output"),
-    path("download/parameters.txt", views.header_txt, name="header-txt"),
-    path("download/halogen.zip", views.halogen, name="halogen-output"),
+    path("plot/<plottype>.<filetype>", heavy.plots, name="images"),
+    path("progress/<job_id>/", views.progress_events, name="progress"),
+    path("download/allData.zip", heavy.data_output, name="data-output"),
+    path("download/allData.npz", views.data_output_npz, name="data-output-npz"),
+    path(
+        "download/allData.parquet.zip",
+        views.data_output_parquet,
+        name="data-output-parquet",
+    ),
+    path("download/parameters.txt", heavy.header_txt, name="header-txt"),
+    path("download/halogen.zip", heavy.halogen, name="halogen-output"),
     path("contact/", views.ContactFormView.as_view(), name="contact-email"),
     path("email-sent/", views.EmailSuccess.as_view(), name="email-success"),
     path("report/", views.UserErrorReport.as_view(), name="report_model"),
     path("report/<model>/", views.UserErrorReport.as_view(), name="report_model"),
     path("about/", views.about.as_view(), name="about"),
+    path("metrics", views.prometheus_metrics, name="metrics"),
+    path("timings", views.request_timings, name="timings"),
 ]
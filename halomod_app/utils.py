@@ -1,21 +1,37 @@
 """Plotting and driving utilities for halomod."""
+import hashlib
 import io
+import json
 import logging
+import threading
+from functools import lru_cache
 
-import matplotlib.ticker as tick
+import numpy as np
 from halomod import TracerHaloModel
+from astropy.cosmology import FLRW
 from halomod.wdm import HaloModelWDM
-from matplotlib.backends.backend_agg import FigureCanvasAgg
-from matplotlib.backends.backend_pdf import FigureCanvasPdf
-from matplotlib.backends.backend_svg import FigureCanvasSVG
-from matplotlib.figure import Figure
 import re
 
+from . import render, timing
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
 
 logger = logging.getLogger(__name__)
 
+# Columnar downloads (Parquet) are only offered if pyarrow is installed.
+HAVE_PYARROW = pyarrow is not None
+
 
 def hmf_driver(cls=TracerHaloModel, previous: [None, TracerHaloModel] = None, **kwargs):
+    with timing.timed("hmf"):
+        return _hmf_driver(cls, previous, **kwargs)
+
+
+def _hmf_driver(cls, previous, **kwargs):
     if previous is None:
         return cls(**kwargs)
     elif "wdm_model" in kwargs and not isinstance(previous, HaloModelWDM):
@@ -23,27 +39,119 @@ def hmf_driver(cls=TracerHaloModel, previous: [None, TracerHaloModel] = None, **
     elif "wdm_model" not in kwargs and isinstance(previous, HaloModelWDM):
         return TracerHaloModel(**kwargs)
     else:
-        this = previous.clone(**kwargs)
-
         # TODO: this is a hack, and should be fixed in hmf
-        # we have to set all _params whose model has been changed to {}
+        # we have to reset all _params whose model has been changed
         # so that they don't get carry-over parameters from other models.
-        for k, v in kwargs.items():
-            if k.endswith("model") and v != getattr(this, k).__class__.__name__:
-                this.update(**{k.replace("model", "params"): {}})
+        kwargs = dict(kwargs)
+        for k, v in list(kwargs.items()):
+            if k.endswith("model") and _model_name(v) != _model_name(
+                getattr(previous, k)
+            ):
+                kwargs.setdefault(k.replace("model", "params"), {})
+
+        return previous.clone(**kwargs)
+
+
+def _model_name(model) -> str:
+    """Name of a model, which may be given as a class (or instance) or its name."""
+    if model is None or isinstance(model, str):
+        return model
+    return getattr(model, "__name__", getattr(model, "name", repr(model)))
+
+
+# Computing models isn't safe in several threads at once (eg. CAMB isn't thread-safe),
+# so it's done by one thread of a process at a time. Getting the defaults of a
+# framework builds an instance of it, so it counts too.
+compute_lock = threading.RLock()
+
+
+@lru_cache()
+def _input_defaults(cls) -> dict:
+    """Default (input) values of every parameter of a framework class."""
+    with compute_lock:
+        return cls.get_all_parameter_defaults(recursive=False)
+
+
+def _canonical(val):
+    """Convert a parameter value into a JSON-able form that is stable between runs."""
+    if isinstance(val, dict):
+        return {str(k): _canonical(v) for k, v in sorted(val.items())}
+    elif isinstance(val, (list, tuple)):
+        return [_canonical(v) for v in val]
+    elif isinstance(val, type):
+        return val.__name__
+    elif isinstance(val, FLRW):
+        return val.name
+    elif isinstance(val, np.ndarray):
+        return _canonical(val.tolist())
+    elif isinstance(val, (bool, np.bool_)):
+        return bool(val)
+    elif isinstance(val, (int, float, np.number)):
+        return float(val)
+    elif val is None or isinstance(val, str):
+        return val
+    else:
+        return repr(val)
 
-        return this
 
+def canonical_framework_dict(cls, params: dict) -> dict:
+    """The full, JSON-able set of parameters of the framework ``cls(**params)``.
 
-def create_canvas(objects, q: str, d: dict, plot_format: str = "png"):
-    # TODO: make log scaling automatic
-    fig = Figure(figsize=(10, 6), edgecolor="white", facecolor="white", dpi=100)
-    ax = fig.add_subplot(111)
-    ax.grid(True)
-    ax.set_xlabel(d["xlab"], fontsize=15)
-    ax.set_ylabel(d["ylab"], fontsize=15)
+    Parameters that are not given are filled in with the defaults of ``cls``.
+    """
+    full = {**_input_defaults(cls), **params}
 
-    lines = ["-", "--", "-.", ":"]
+    # Frameworks take either None or "None" for a model that isn't used.
+    full = {
+        k: None if k.endswith("_model") and isinstance(v, str) and v == "None" else v
+        for k, v in full.items()
+    }
+    return _canonical(full)
+
+
+def framework_fingerprint(cls, params: dict) -> str:
+    """A hash uniquely identifying the framework built from ``cls(**params)``.
+
+    Parameters that are not given are filled in with the defaults of ``cls``, so that
+    the fingerprint of a parameter dictionary is the same as that of the model it
+    creates (see :func:`model_fingerprint`).
+    """
+    payload = json.dumps(
+        {"cls": cls.__name__, "params": canonical_framework_dict(cls, params)},
+        sort_keys=True,
+    )
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def model_fingerprint(obj) -> str:
+    """A hash uniquely identifying the parameters of a framework instance.
+
+    This is cheap: it does not compute any of the model's quantities.
+    """
+    return framework_fingerprint(obj.__class__, obj.parameter_values)
+
+
+def plot_lines(objects, q: str, getter=getattr) -> tuple:
+    """The lines of a plot of a quantity of each model, ready to be drawn.
+
+    Parameters
+    ----------
+    objects
+        The models to plot, by label.
+    q
+        The quantity to plot, optionally prefixed with ``comparison_`` to plot its
+        ratio to that of the first model.
+    getter
+        Function getting a quantity of a model (eg. from the result cache).
+
+    Returns
+    -------
+    lines : list
+        The lines to draw (see :func:`~halomod_app.render.draw`).
+    errors : dict
+        The errors raised while getting the quantity, by model label.
+    """
+    linestyles = ["-", "--", "-.", ":"]
 
     if q.startswith("comparison"):
         compare = True
@@ -59,21 +167,21 @@ def create_canvas(objects, q: str, d: dict, plot_format: str = "png"):
         raise ValueError(f"The quantity {q} is not found in KEYMAP")
 
     errors = {}
-    ys = {}
+    lines = []
     for i, (l, o) in enumerate(objects.items()):
         if not compare:
             try:
-                y = getattr(o, q)
+                y = getter(o, q)
                 if y is not None:
                     mask = y > 1e-40 * y.max()
-                    ys[l] = y[mask]
-
-                    ax.plot(
-                        getattr(o, x)[mask],
-                        y[mask],
-                        color=f"C{i % 7}",
-                        linestyle=lines[(i // 7) % 4],
-                        label=l,
+                    lines.append(
+                        {
+                            "x": getter(o, x)[mask],
+                            "y": y[mask],
+                            "color": f"C{i % 7}",
+                            "linestyle": linestyles[(i // 7) % 4],
+                            "label": l,
+                        }
                     )
             except Exception as e:
                 logger.exception(f"Error encountered getting {q} for model called {l}.")
@@ -84,55 +192,37 @@ def create_canvas(objects, q: str, d: dict, plot_format: str = "png"):
                 continue
 
             try:
-                ynum = getattr(o, q)
+                ynum = getter(o, q)
             except Exception as e:
                 logger.exception(f"Error encountered getting {q} for model called {l}.")
                 errors[l] = e
+                continue
 
-            yden = getattr(comp_obj, q)
+            yden = getter(comp_obj, q)
             mask = yden > 0
 
             if ynum is not None and yden is not None:
-                y = ynum[mask] / yden[mask]
-                ys[l] = y
-                ax.plot(
-                    getattr(o, x)[mask],
-                    y,
-                    color=f"C{(i+1) % 7}",
-                    linestyle=lines[((i + 1) // 7) % 4],
-                    label=l,
+                lines.append(
+                    {
+                        "x": getter(o, x)[mask],
+                        "y": ynum[mask] / yden[mask],
+                        "color": f"C{(i+1) % 7}",
+                        "linestyle": linestyles[((i + 1) // 7) % 4],
+                        "label": l,
+                    }
                 )
 
-    try:
-        # Shrink current axis by 30%
-        ax.set_xscale("log")
-
-        ax.set_yscale(d["yscale"], base=d.get("basey", 10))
-        if d["yscale"] == "log" and d.get("basey", 10) == 2:
-            ax.yaxis.set_major_formatter(tick.ScalarFormatter())
+    return lines, errors
 
-        box = ax.get_position()
-        ax.set_position([box.x0, box.y0, box.width * 0.6, box.height])
 
-        # Put a legend to the right of the current axis
-        ax.legend(loc="center left", bbox_to_anchor=(1, 0.5), fontsize=15)
-
-        buf = io.BytesIO()
-
-        if plot_format == "pdf":
-            FigureCanvasPdf(fig).print_pdf(buf)
-        elif plot_format == "png":
-            FigureCanvasAgg(fig).print_png(buf)
-        elif plot_format == "svg":
-            FigureCanvasSVG(fig).print_svg(buf)
-        else:
-            raise ValueError("plot_format should be png, pdf or svg!")
-    except Exception:
-        logger.info(f"y-axis data: {ys}")
-        logger.exception("Something went wrong in creating the image itself")
-        raise
+def create_canvas(objects, q: str, d: dict, plot_format: str = "png", getter=getattr):
+    """Plot a quantity of each model, returning the image and any errors.
 
-    return buf, errors
+    The quantities are got in this process, and the image is drawn in the renderer
+    pool (see :mod:`~halomod_app.render`).
+    """
+    lines, errors = plot_lines(objects, q, getter=getter)
+    return io.BytesIO(render.render(lines, d, plot_format)), errors
 
 
 MLABEL = r"Mass $(M_{\odot}h^{-1})$"
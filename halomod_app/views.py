@@ -6,19 +6,34 @@ import logging
 import zipfile
 from collections import OrderedDict
 
-import numpy as np
 from django.conf import settings
 from django.core.mail import send_mail
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import (
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.views.decorators.cache import cache_control
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.views.generic.base import TemplateView
 from django.views.generic.edit import FormView
 from django.http import Http404
 
-from halomod import TracerHaloModel
 from tabination.views import TabView
 from hmf.helpers.cfg_utils import framework_to_dict
 import toml
+from . import circuit
+from . import compute
+from . import exports
 from . import forms
+from . import metrics
+from . import progress
+from . import results
+from . import schema
+from . import timing
 from . import utils
 
 logger = logging.getLogger(__name__)
@@ -61,6 +76,11 @@ class CalculatorInputBase(FormView):
     success_url = "/"
     template_name = "calculator_form.html"
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["form_cache_timeout"] = settings.FORM_CACHE_TIMEOUT
+        return context
+
     def form_valid(self, form):
         """Define what to do if the form is valid."""
         label = form.cleaned_data["label"]
@@ -143,6 +163,110 @@ class CalculatorInputEdit(CalculatorInputCreate):
         return result
 
 
+@csrf_exempt
+@require_POST
+def validate_model(request):
+    """Validate input-form data, without building the model.
+
+    This runs all the validation of the input form, and responds with the framework
+    that the data defines (its class, full canonical parameters, and fingerprint), and
+    which of its quantities are already cached. Give ``?edit=<label>`` to validate an
+    edit of an existing model rather than a new one. Nothing is stored.
+    """
+    edit = request.GET.get("edit", None)
+    form = forms.FrameworkInput(
+        data=request.POST,
+        files=request.FILES,
+        current_models=request.session.get("objects", None),
+        model_label=edit,
+        edit=edit is not None,
+        compute_model=False,
+        store_uploads=False,
+    )
+
+    if not form.is_valid():
+        return JsonResponse(
+            {"valid": False, "errors": form.errors.get_json_data()}, status=400
+        )
+
+    cls, params = form.halomod_cls, form.halomod_dct
+    fingerprint = utils.framework_fingerprint(cls, params)
+    cached = results.cached_quantities(fingerprint)
+
+    return JsonResponse(
+        {
+            "valid": True,
+            "cls": cls.__name__,
+            "params": utils.canonical_framework_dict(cls, params),
+            "fingerprint": fingerprint,
+            "cached": bool(cached),
+            "cached_quantities": sorted(cached),
+        }
+    )
+
+
+@cache_control(max_age=3600)
+def form_schema(request):
+    """The schema of the input form, used to validate it in the browser."""
+    return JsonResponse(schema.form_schema())
+
+
+class ImportModels(FormView):
+    """Recreate models from uploaded parameter files.
+
+    Each file is validated with the same rules as the calculator form, and then all
+    the models are built concurrently in the compute pool. The import is all or
+    nothing: if any model is invalid or fails to build, none are added.
+    """
+
+    form_class = forms.ImportForm
+    template_name = "import_form.html"
+    success_url = "/"
+
+    def form_valid(self, form):
+        objects = self.request.session.get("objects", OrderedDict())
+
+        inputs = OrderedDict()
+        errors = {}
+        for label, params in form.bundles.items():
+            model_form = forms.FrameworkInput(
+                data=forms.FrameworkInput.data_from_framework_dict(params, label),
+                current_models={**objects, **inputs},
+                compute_model=False,
+            )
+            if model_form.is_valid():
+                inputs[model_form.cleaned_data["label"]] = model_form
+            else:
+                errors[label] = model_form.errors.as_text()
+
+        if not errors:
+            built = compute.build_models(
+                {
+                    label: (model_form.halomod_cls, model_form.halomod_dct)
+                    for label, model_form in inputs.items()
+                }
+            )
+            errors = {
+                label: str(obj)
+                for label, obj in built.items()
+                if isinstance(obj, Exception)
+            }
+
+        if errors:
+            for label, error in errors.items():
+                form.add_error(None, f"{label}: {error}")
+            form.add_error(None, "No models were imported.")
+            return self.form_invalid(form)
+
+        session_forms = self.request.session.get("forms", OrderedDict())
+        for label, obj in built.items():
+            objects[label] = obj
+            session_forms[label] = inputs[label].data
+        self.request.session["objects"] = objects
+        self.request.session["forms"] = session_forms
+        return super().form_valid(form)
+
+
 def delete_plot(request, label):
     if len(request.session.get("objects", {})) > 1:
 
@@ -179,7 +303,7 @@ class ViewPlots(BaseTab):
     def get(self, request, *args, **kwargs):
         # Create a default TracerHaloModel object that displays upon opening.
         if "objects" not in request.session:
-            default_obj = TracerHaloModel(hod_params={"central": True})
+            default_obj = utils.hmf_driver(hod_params={"central": True})
 
             request.session["objects"] = OrderedDict(default=default_obj)
             request.session["forms"] = OrderedDict()
@@ -210,55 +334,50 @@ class ViewPlots(BaseTab):
     top = True
 
 
-def plots(request, filetype, plottype):
-    """
-    Chooses the type of plot needed and the filetype (pdf or png) and outputs it
-    """
-    objects = request.session.get("objects", {})
-
-    if filetype not in ["png", "svg", "pdf", "zip"]:
-        logger.error(f"Strange 'filetype' extension requested: {filetype}. 404ing...")
-        raise Http404
-
-    if not objects:
-        return HttpResponseRedirect("/")
-    elif len(objects) > 1:
-        keymap = {
-            **utils.KEYMAP,
-            "comparison_dndm": {
-                "xlab": utils.MLABEL,
-                "ylab": r"Ratio of Mass Functions $ \left(\frac{dn}{dM}\right) / \left( \frac{dn}{dM} \right)_{%s} $"
-                % list(objects.keys())[0],
-                "yscale": "log",
-                "basey": 2,
-            },
-            "comparison_fsigma": {
-                "xlab": utils.MLABEL,
-                "ylab": r"Ratio of Fitting Functions $f(\sigma)/ f(\sigma)_{%s}$"
-                % list(objects.keys())[0],
-                "yscale": "log",
-                "basey": 2,
-            },
-        }
-    else:
-        keymap = utils.KEYMAP
-
-    # Save the current plottype to the session for use elsewhere
-    if filetype == "svg":
-        # only save it when svg, which is what actually shows.
-        request.session["current_plot"] = plottype
+def plot_keymap(objects: dict) -> dict:
+    """The axis settings of each plot, including comparisons if there are models to
+    compare."""
+    if len(objects) <= 1:
+        return utils.KEYMAP
+
+    return {
+        **utils.KEYMAP,
+        "comparison_dndm": {
+            "xlab": utils.MLABEL,
+            "ylab": r"Ratio of Mass Functions $ \left(\frac{dn}{dM}\right) / \left( \frac{dn}{dM} \right)_{%s} $"
+            % list(objects.keys())[0],
+            "yscale": "log",
+            "basey": 2,
+        },
+        "comparison_fsigma": {
+            "xlab": utils.MLABEL,
+            "ylab": r"Ratio of Fitting Functions $f(\sigma)/ f(\sigma)_{%s}$"
+            % list(objects.keys())[0],
+            "yscale": "log",
+            "basey": 2,
+        },
+    }
+
+
+def plot_job(request, objects: dict, plottype: str, keymap: dict):
+    """The progress job of a plot, if the client is following its progress."""
+    job_id = request.GET.get("job", None)
+    if progress.valid_job_id(job_id) and plottype in keymap:
+        return progress.Job(
+            job_id, plottype.replace("comparison_", ""), list(objects.keys())
+        )
+    return None
 
-    figure_buf, errors = utils.create_canvas(
-        objects, plottype, keymap[plottype], plot_format=filetype
-    )
 
+def plot_response(request, image: bytes, errors: dict, filetype, plottype):
+    """The response of an image of a plot, recording its errors in the session."""
     # How to output the image
     if filetype == "png":
-        response = HttpResponse(figure_buf.getvalue(), content_type="image/png")
+        response = HttpResponse(image, content_type="image/png")
     elif filetype == "svg":
-        response = HttpResponse(figure_buf.getvalue(), content_type="image/svg+xml")
+        response = HttpResponse(image, content_type="image/svg+xml")
     elif filetype == "pdf":
-        response = HttpResponse(figure_buf.getvalue(), content_type="application/pdf")
+        response = HttpResponse(image, content_type="application/pdf")
         response["Content-Disposition"] = "attachment;filename=" + plottype + ".pdf"
     elif filetype == "zip":
         response = io.StringIO()
@@ -280,16 +399,84 @@ def plots(request, filetype, plottype):
     return response
 
 
-def header_txt(request):
-    # Import all the input form data so it can be written to file
-    try:
-        objects = request.session["objects"]
-    except KeyError:
+def plots(request, filetype, plottype):
+    """
+    Chooses the type of plot needed and the filetype (pdf or png) and outputs it
+    """
+    objects = request.session.get("objects", {})
+
+    if filetype not in ["png", "svg", "pdf", "zip"]:
+        logger.error(f"Strange 'filetype' extension requested: {filetype}. 404ing...")
+        raise Http404
+
+    if not objects:
         return HttpResponseRedirect("/")
+    keymap = plot_keymap(objects)
 
-    # Open up file-like objects for response
-    response = HttpResponse(content_type="application/zip")
-    response["Content-Disposition"] = "attachment; filename=THM-parameters.zip"
+    # Save the current plottype to the session for use elsewhere
+    if filetype == "svg":
+        # only save it when svg, which is what actually shows.
+        request.session["current_plot"] = plottype
+
+    # If the client is following the progress of this plot, compute it stage by
+    # stage (the canvas below then uses the computed quantities).
+    job = plot_job(request, objects, plottype, keymap)
+    if job is not None:
+        progress.compute(job, objects)
+
+    try:
+        figure_buf, errors = utils.create_canvas(
+            objects,
+            plottype,
+            keymap[plottype],
+            plot_format=filetype,
+            getter=results.get_quantity,
+        )
+    except Exception as e:
+        if job is not None:
+            job.finish(error=str(e))
+        raise
+
+    if job is not None:
+        job.finish(error="; ".join(f"{k}: {v}" for k, v in errors.items()) or None)
+
+    return plot_response(request, figure_buf.getvalue(), errors, filetype, plottype)
+
+
+def progress_events(request, job_id):
+    """Stream the progress of a computation as server-sent events."""
+    if not progress.valid_job_id(job_id):
+        raise Http404
+
+    response = StreamingHttpResponse(
+        progress.events(job_id), content_type="text/event-stream"
+    )
+    response["Cache-Control"] = "no-cache"
+    # Don't let nginx buffer the stream.
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def prometheus_metrics(request):
+    """The metrics of the site, for Prometheus to scrape (see :mod:`.metrics`)."""
+    response = HttpResponse(metrics.exposition(), content_type=metrics.CONTENT_TYPE)
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
+def request_timings(request):
+    """Percentiles of the recent timings of each endpoint (see :func:`.timing.summary`).
+
+    Timings are kept per process, so this only covers the worker serving it. Like the
+    metrics, it isn't served to the public (see ``nginx/default.conf``).
+    """
+    response = JsonResponse(timing.summary())
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
+def parameters_archive(objects: dict) -> bytes:
+    """A zip of the parameters of each model, as TOML files."""
     buff = io.BytesIO()
     archive = zipfile.ZipFile(buff, "w", zipfile.ZIP_DEFLATED)
 
@@ -305,105 +492,93 @@ def header_txt(request):
     buff.flush()
     ret_zip = buff.getvalue()
     buff.close()
-    response.write(ret_zip)
+    return ret_zip
+
+
+def parameters_response(content: bytes) -> HttpResponse:
+    response = HttpResponse(content, content_type="application/zip")
+    response["Content-Disposition"] = "attachment; filename=THM-parameters.zip"
     return response
 
 
-def data_output(request):
-    # TODO: output HDF5 format
-    # Import all the data we need
+def header_txt(request):
+    # Import all the input form data so it can be written to file
     try:
         objects = request.session["objects"]
     except KeyError:
         return HttpResponseRedirect("/")
 
-    labels = list(objects.keys())
-    objects = list(objects.values())
+    return parameters_response(parameters_archive(objects))
 
-    # Open up file-like objects for response
-    response = HttpResponse(content_type="application/zip")
-    response["Content-Disposition"] = "attachment; filename=THM-output-data.zip"
-    buff = io.BytesIO()
-    archive = zipfile.ZipFile(buff, "w", zipfile.ZIP_DEFLATED)
-
-    # Write out mass-based, k-based and r-based data files
-    for i, o in enumerate(objects):
-        for kind in utils.XLABELS:
 
-            s = io.BytesIO()
+def export_choice(request):
+    """The quantities chosen for a download, or a response if the choice is invalid."""
+    choice = forms.ExportChoice(request.GET)
+    if not choice.is_valid():
+        return None, HttpResponseBadRequest(
+            choice.errors.as_text(), content_type="text/plain"
+        )
+    return choice, None
 
-            s.write(f"# [0] {utils.XLABELS[kind]} ".encode())
 
-            items = {
-                k: utils.KEYMAP[k]["ylab"]
-                for k in utils.KEYMAP
-                if utils.KEYMAP[k]["xlab"] == utils.XLABELS[kind]
-            }
+def circuit_open_response(e: circuit.CircuitOpen) -> HttpResponse:
+    response = HttpResponse(str(e), content_type="text/plain", status=503)
+    response["Retry-After"] = str(e.retry_after)
+    return response
 
-            for j, (label, ylab) in enumerate(items.items()):
-                if getattr(o, label) is not None:
-                    s.write(f"[{j+1}] {ylab}\t".encode())
-            s.write("\n".encode())
 
-            out = np.array(
-                [getattr(o, kind)]
-                + [
-                    getattr(o, label)
-                    for label in items
-                    if getattr(o, label) is not None
-                ]
-            ).T
-            np.savetxt(s, out)
+def _data_download(request, fmt):
+    """Respond with an archive of the requested quantities of all session models.
 
-            archive.writestr(f"{kind}Vector_{labels[i]}.txt", s.getvalue())
+    The quantities can be restricted with the ``quantities`` and ``groups`` GET
+    parameters (see :class:`forms.ExportChoice`), so that only those are computed.
+    The ``precision`` of text downloads can also be set.
+    """
+    try:
+        objects = request.session["objects"]
+    except KeyError:
+        return HttpResponseRedirect("/")
 
-            s.close()
+    choice, invalid = export_choice(request)
+    if invalid is not None:
+        return invalid
 
-    archive.close()
-    buff.flush()
-    ret_zip = buff.getvalue()
-    buff.close()
-    response.write(ret_zip)
-    return response
+    try:
+        return exports.archive_response(
+            fmt,
+            objects,
+            selected=choice.selected_quantities(),
+            precision=choice.cleaned_data["precision"],
+        )
+    except circuit.CircuitOpen as e:
+        return circuit_open_response(e)
 
 
-def halogen(request):
-    # Import all the data we need
-    objects = request.session["objects"]
+def data_output(request):
+    # TODO: output HDF5 format
+    return _data_download(request, "ascii")
 
-    labels = list(objects.keys())
-    objects = list(objects.values())
 
-    # Open up file-like objects for response
-    response = HttpResponse(content_type="application/zip")
-    response["Content-Disposition"] = "attachment; filename=halogen.zip"
-    buff = io.BytesIO()
-    archive = zipfile.ZipFile(buff, "w", zipfile.ZIP_DEFLATED)
+def data_output_npz(request):
+    """Output data as a single numpy .npz file, with one table per axis family.
 
-    # Write out ngtm and lnP data files
-    for i, o in enumerate(objects):
-        s = io.BytesIO()
+    Arrays are stored under keys of the form ``<axis>/<column>``, eg. ``m/dndm``.
+    """
+    return _data_download(request, "npz")
 
-        # MASS BASED
-        out = np.array([o.m, o.ngtm]).T
-        np.savetxt(s, out)
 
-        archive.writestr("ngtm_%s.txt" % labels[i], s.getvalue())
+def data_output_parquet(request):
+    """Output data as a zip of Parquet files, one per axis family."""
+    if not utils.HAVE_PYARROW:
+        logger.error("Parquet output requested, but pyarrow is not installed.")
+        raise Http404
 
-        s.close()
-        s = io.StringIO()
+    return _data_download(request, "parquet")
 
-        # K BASED
-        out = np.array([o.k, o.power]).T
-        np.savetxt(s, out)
-        archive.writestr("matterpower_%s.txt" % labels[i], s.getvalue())
 
-    archive.close()
-    buff.flush()
-    ret_zip = buff.getvalue()
-    buff.close()
-    response.write(ret_zip)
-    return response
+def halogen(request):
+    # Quantities can't be selected here, since HALOgen needs exactly n(>m) and P(k).
+    return _data_download(request, "halogen")
 
 
 class ContactFormView(FormView):